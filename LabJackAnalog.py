@@ -1,9 +1,65 @@
 import numpy as np
 import time
 import os
+import re
+import threading
+from collections import namedtuple
 
 from labjack import ljm
 
+from instrumentation import INSTRUMENTATION, instrumented
+
+
+# Readings at or above this magnitude are overflow garbage, the ADC range
+# tops out at +-10 V and LJM fills skipped scans with -9999.
+OVERFLOW_LIMIT = 20
+
+# Pin names passed to LJM unchanged
+AIN_NAME = re.compile(r"AIN\d+$")
+
+StreamChunk = namedtuple("StreamChunk", ["data", "device_backlog", "ljm_backlog"])
+StreamStats = namedtuple("StreamStats", [
+    "scan_rate", "scans", "overflows", "max_device_backlog", "max_ljm_backlog"
+])
+
+# Largest stream-out buffer in bytes, each sample takes two bytes
+MAX_STREAM_OUT_BUFFER = 16384
+
+WAVEFORMS = ("triangle", "ramp", "sine", "square")
+
+
+def unit_waveform(shape, phase):
+    """
+    Values of a 1 V peak to peak waveform with 0 offset at the given
+    phases in degrees, an array. shape is one of WAVEFORMS: "triangle"
+    rises from 0 to +0.5 V at 90 degrees like ramp_analog_out, "ramp"
+    rises linearly from -0.5 V to +0.5 V through each period and crosses
+    0 at 0 degrees, "sine" is a sine and "square" is +0.5 V during the
+    first half of each period.
+    """
+    cycles = np.asarray(phase, dtype=float) / 360.
+    fraction = cycles % 1.
+    if shape == "triangle":
+        return 2*np.abs(((cycles - 0.25) % 1.) - 0.5) - 0.5
+    if shape == "ramp":
+        return ((cycles + 0.5) % 1.) - 0.5
+    if shape == "sine":
+        return 0.5*np.sin(2*np.pi*cycles)
+    if shape == "square":
+        return np.where(fraction < 0.5, 0.5, -0.5)
+    raise ValueError("Unknown waveform {!r}, choose from {}".format(
+        shape, ", ".join(WAVEFORMS)))
+
+
+def waveform(shape, amplitude, offset=0., init_phase=0., samples_per_cycle=100):
+    """
+    One period of a waveform as an array of samples_per_cycle voltages,
+    amplitude [V] peak to peak around offset [V], starting at init_phase
+    [degrees]. See unit_waveform for the shapes.
+    """
+    phase = init_phase + 360.*np.arange(samples_per_cycle) / samples_per_cycle
+    return amplitude*unit_waveform(shape, phase) + offset
+
 
 ##
 class LabJackAnalog:
@@ -13,22 +69,112 @@ class LabJackAnalog:
     digital IO blocks.
     """
 
-    def __init__(self, model="ANY", connection="ANY", identifier="ANY"):
-        self.device = ljm.openS(model, connection, identifier)
+    def __init__(self, model="ANY", connection="ANY", identifier="ANY", backend=None):
+        """
+        backend is the module used to talk to the device, the labjack
+        ljm module by default. Anything providing the same functions
+        can be used instead, e.g. simulation.SimulatedLJM.
+
+        Command-response reads and writes hold self.lock, so one handle
+        can be shared by several threads, e.g. couplers aligned in
+        parallel or a CouplingMonitor.
+        """
+        self.ljm = ljm if backend is None else backend
+        self.lock = threading.RLock()
+        self.device = self.ljm.openS(model, connection, identifier)
+        # tuple of names -> (addresses, data types), resolved once
+        self._addresses = {}
+
+    def stream_chunks(self, pin_names, scanrate, scans_per_read=None, n_chunks=None):
+        """
+        Generator that streams one or more analog inputs and yields a
+        StreamChunk per eStreamRead call. chunk.data is an array of shape
+        (scans_per_read, n_channels) with overflow readings replaced by
+        NaN, so the channels of a scan stay aligned. The backlog fields
+        are the device and LJM scan backlogs reported with that chunk;
+        if they keep growing, the reader is not keeping up.
+
+        pin_names can be a single pin or a list, each given as a name
+        (e.g. "AIN1") or a number (e.g. 1). scans_per_read defaults to
+        a tenth of a second worth of scans. Streams until n_chunks
+        chunks have been read, or forever if n_chunks is None. The
+        stream is stopped when the generator is closed. The scan rate
+        actually set by the device is kept in self.stream_scan_rate.
+        """
+        names = self.__ain_names(pin_names)
+        return self.__stream(names, [], scanrate, scans_per_read, n_chunks)
 
-    def stream_read_single(self, pin_name, scanrate, period):
-        num_samples = int(period * scanrate)
+    def __stream(self, names, out_addresses, scanrate, scans_per_read, n_chunks):
+        """
+        stream_chunks for the inputs names, with the stream-out
+        addresses out_addresses added to the scan list.
+        """
+        n_channels = len(names)
+        if scans_per_read is None:
+            scans_per_read = max(1, int(scanrate / 10))
 
-        ljm.eStreamStart(self.device, 1, 1, ljm.namesToAddresses(1, [pin_name])[0], scanrate)
+        addresses = list(self.ljm.namesToAddresses(n_channels, names)[0]) + list(out_addresses)
+        self.stream_scan_rate = self.ljm.eStreamStart(
+            self.device, scans_per_read, len(addresses), addresses, scanrate
+        )
+        try:
+            count = 0
+            while n_chunks is None or count < n_chunks:
+                if INSTRUMENTATION.enabled:
+                    with INSTRUMENTATION.timed("labjack.stream_read", ",".join(names)):
+                        raw, device_backlog, ljm_backlog = self.ljm.eStreamRead(self.device)
+                else:
+                    raw, device_backlog, ljm_backlog = self.ljm.eStreamRead(self.device)
+                data = np.array(raw, dtype=float).reshape(-1, n_channels)
+                data[np.abs(data) >= OVERFLOW_LIMIT] = np.nan
+                yield StreamChunk(data, device_backlog, ljm_backlog)
+                count += 1
+        finally:
+            self.ljm.eStreamStop(self.device)
 
-        data = []
-        for i in range(0, num_samples, 1):
-            measurement = ljm.eStreamRead(self.device)[0][0]
-            if abs(measurement) < 20: ## Accounts for overflow garbage
-                data.append(measurement)
-        ljm.eStreamStop(self.device)
+    def stream_read(self, pin_names, scanrate, period, scans_per_read=None):
+        """
+        Stream one or more analog inputs for period seconds. Returns
+        (data, stats), where data is an array of shape
+        (n_scans, n_channels) with overflow readings replaced by NaN,
+        and stats is a StreamStats with the overflow count and the
+        largest device/LJM backlog seen during the read.
+        """
+        names = self.__ain_names(pin_names)
+        n_scans = int(period * scanrate)
+        if scans_per_read is None:
+            scans_per_read = max(1, min(n_scans, int(scanrate / 10)))
+        n_chunks = -(-n_scans // scans_per_read)
+
+        data = np.empty((n_scans, len(names)))
+        filled = 0
+        max_device_backlog = 0
+        max_ljm_backlog = 0
+        for chunk in self.stream_chunks(names, scanrate, scans_per_read, n_chunks):
+            n = min(len(chunk.data), n_scans - filled)
+            data[filled:filled + n] = chunk.data[:n]
+            filled += n
+            max_device_backlog = max(max_device_backlog, chunk.device_backlog)
+            max_ljm_backlog = max(max_ljm_backlog, chunk.ljm_backlog)
 
-        return data
+        stats = StreamStats(
+            scan_rate=self.stream_scan_rate,
+            scans=n_scans,
+            overflows=int(np.count_nonzero(np.isnan(data))),
+            max_device_backlog=max_device_backlog,
+            max_ljm_backlog=max_ljm_backlog,
+        )
+        return data, stats
+
+    @instrumented("labjack.stream_read_single", key=lambda self, pin_name, *args, **kwargs: str(pin_name))
+    def stream_read_single(self, pin_name, scanrate, period, scans_per_read=None):
+        """
+        Stream a single analog input for period seconds and return the
+        valid readings as a 1-D array, with overflow readings dropped.
+        """
+        data, _ = self.stream_read(pin_name, scanrate, period, scans_per_read)
+        data = data[:, 0]
+        return data[~np.isnan(data)]
 
     def analog_out(self, block_num, dac_num, val):
         """
@@ -49,22 +195,27 @@ class LabJackAnalog:
         if isinstance(dac_num, str):
             dac_num = dac_num[-1]
 
-        ljm.eWriteName(self.device, "TDAC{}".format(block_num*2+dac_num), val)
+        with self.lock:
+            self.ljm.eWriteName(self.device, "TDAC{}".format(block_num*2+dac_num), val)
 
     def dac_out(self, analog_pin, val):
         #Writes a voltage to DAC1 or DAC2
 
-        ljm.eWriteName(self.device, "DAC{}".format(analog_pin), val)
+        with self.lock:
+            self.ljm.eWriteName(self.device, "DAC{}".format(analog_pin), val)
 
     def mio_out(self, analog_pin, val):
         #Writes a voltage to MIO# pins
 
-        ljm.eWriteName(self.device, "MIO{}".format(analog_pin), val)
+        with self.lock:
+            self.ljm.eWriteName(self.device, "MIO{}".format(analog_pin), val)
 
     def fio_out(self, analog_pin, val):
         #Writes a voltage to FIO# pins
-        ljm.eWriteName(self.device, "FIO{}".format(analog_pin), val)
+        with self.lock:
+            self.ljm.eWriteName(self.device, "FIO{}".format(analog_pin), val)
 
+    @instrumented("labjack.analog_in", key=lambda self, pin: pin if isinstance(pin, str) else "AIN{}".format(pin))
     def analog_in(self, analog_pin):
         """
         Read a voltage from the builtin ADCs. analog_pin can be either
@@ -72,15 +223,63 @@ class LabJackAnalog:
         1). Returns the voltage currently applied to the ADC as a
         float.
         """
+        return self.__read(self.__ain_names(analog_pin))[0]
 
-        # Extract the pin number from the name, if given in that
-        # form. This assumes that the name is of the form
-        # "BlahBlahBlah<pin number>" where <pin number> is a single
-        # digit.
-        if isinstance(analog_pin, str):
-            analog_pin = int(analog_pin[-1])
+    @instrumented("labjack.analog_in", key=lambda self, pins: ",".join(str(p) for p in pins))
+    def analog_in_many(self, analog_pins):
+        """
+        Read several builtin ADCs in a single LJM call, so they are
+        sampled in the same scan. analog_pins is a list of names or
+        numbers as for analog_in. Returns the voltages as a list in the
+        same order.
+        """
+        return self.__read(self.__ain_names(analog_pins))
+
+    def ratio_in(self, signal_pin, reference_pin):
+        """
+        Read two ADCs in the same scan and return signal / reference,
+        e.g. the fiber output photodiode over a pickoff of the source,
+        which cancels source power fluctuations. Raises RuntimeError if
+        the reference reads zero or less, rather than passing a dead
+        reference photodiode off as no coupling.
+        """
+        signal, reference = self.analog_in_many([signal_pin, reference_pin])
+        if reference <= 0:
+            raise RuntimeError("Reference input {} reads {} V, is its photodiode "
+                               "lit?".format(reference_pin, reference))
+        return signal / reference
 
-        return ljm.eReadName(self.device, "AIN{}".format(analog_pin))
+    def configure_ain(self, analog_pins, ain_range=None, resolution_index=None,
+                      settling_us=None):
+        """
+        Set the range [+-V], resolution index and settling time [us] of
+        several analog inputs in a single LJM call. Settings left at None
+        are not changed.
+        """
+        names, values = [], []
+        for pin in self.__ain_names(analog_pins):
+            for setting, value in (("RANGE", ain_range),
+                                   ("RESOLUTION_INDEX", resolution_index),
+                                   ("SETTLING_US", settling_us)):
+                if value is not None:
+                    names.append("{}_{}".format(pin, setting))
+                    values.append(value)
+        if names:
+            with self.lock:
+                self.ljm.eWriteNames(self.device, len(names), names, values)
+
+    def __read(self, names):
+        """
+        Read the named registers with one eReadAddresses call, resolving
+        the names to addresses only the first time.
+        """
+        key = tuple(names)
+        if key not in self._addresses:
+            self._addresses[key] = self.ljm.namesToAddresses(len(names), names)
+        addresses, data_types = self._addresses[key]
+        with self.lock:
+            return list(self.ljm.eReadAddresses(self.device, len(names), addresses,
+                                                data_types))
 
     def ramp_analog_out(self, block_num, dac_num, amplitude, frequency, offset, init_phase, n_cycles, step_size):
         """
@@ -94,34 +293,130 @@ class LabJackAnalog:
         The output would begin at +0.5 V, decrease linearly to -0.5 V during
         500 ms and increase linearly to +0.5 V during another 500 ms. This would
         then repeat 2 more times.
+
+        The LJTick-DAC is written one sample at a time, timed by sleeping
+        until each sample is due. For accurate frequencies use
+        function_out on DAC0 or DAC1, which is timed by the device.
         """
-        n_steps = amplitude / step_size * 2
-        period = 1 / frequency
-        step_time = period / n_steps
+        n_steps = int(round(amplitude / step_size * 2))
+        step_time = 1. / frequency / n_steps
 
-        for phase in np.linspace(init_phase, 360 * n_cycles + init_phase, n_cycles * n_steps):
-            val = amplitude * self.__unit_ramp(phase) + offset
-            start = time.time()
-            self.analog_out(block_num, dac_num, val)
-            now = time.time()
-            while (now - start) < step_time:
-                now = time.time()
+        phases = np.linspace(init_phase, 360 * n_cycles + init_phase, n_cycles * n_steps)
+        values = amplitude * unit_waveform("triangle", phases) + offset
+        start = time.time()
+        for i, val in enumerate(values):
+            self.analog_out(block_num, dac_num, float(val))
+            # sleep until the next sample is due, without accumulating delays
+            delay = start + (i + 1) * step_time - time.time()
+            if delay > 0:
+                time.sleep(delay)
 
-    def __unit_ramp(self, phase):
+    def __setup_stream_out(self, dac_num, values):
         """
-        Returns the value corresponding to the input phase of the 1 V ramp
-        function (0 offset, 0 degrees starting phase)
+        Load values into stream-out buffer 0, looping, with DAC<dac_num>
+        as its target. Returns the scan list address of the stream-out.
         """
-        reduced_phase = phase % 360
+        values = np.asarray(values, dtype=float)
+        n = len(values)
+        if not n:
+            raise ValueError("Empty waveform")
+        # power of 2 bytes, with room for one sample more than the loop
+        size = max(2, 2**int(np.ceil(np.log2(2*(n + 1)))))
+        if size > MAX_STREAM_OUT_BUFFER:
+            raise ValueError("Waveform of {} samples exceeds the {} byte stream-out buffer".format(
+                n, MAX_STREAM_OUT_BUFFER))
+        names = ["DAC{}".format(dac_num), "STREAM_OUT0"]
+        target, out_address = self.ljm.namesToAddresses(2, names)[0]
 
-        if reduced_phase <= 90:
-            return (reduced_phase / 90) * 0.5
-        elif reduced_phase <= 180:
-            return ((180 - reduced_phase) / 90) * 0.5
-        elif reduced_phase <= 270:
-            return ((reduced_phase - 180) / 90) * -0.5
-        elif reduced_phase <= 360:
-            return ((360 - reduced_phase) / 90) * -0.5
+        with self.lock:
+            self.ljm.eWriteName(self.device, "STREAM_OUT0_ENABLE", 0)
+            self.ljm.eWriteName(self.device, "STREAM_OUT0_TARGET", target)
+            self.ljm.eWriteName(self.device, "STREAM_OUT0_BUFFER_SIZE", size)
+            self.ljm.eWriteName(self.device, "STREAM_OUT0_ENABLE", 1)
+            self.ljm.eWriteNameArray(self.device, "STREAM_OUT0_BUFFER_F32", n,
+                                     values.tolist())
+            self.ljm.eWriteName(self.device, "STREAM_OUT0_LOOP_SIZE", n)
+            self.ljm.eWriteName(self.device, "STREAM_OUT0_SET_LOOP", 1)
+        return out_address
+
+    def waveform_chunks(self, dac_num, values, scanrate, pin_names, scans_per_read=None,
+                        n_chunks=None):
+        """
+        Like stream_chunks, while DAC<dac_num> (0 or 1) loops through
+        values, one per scan. The waveform is played from the device's
+        stream-out buffer, so it is timed by the device clock and stays
+        synchronized with the input scans: row i of the concatenated
+        chunks is read while values[i % len(values)] is output.
+        """
+        names = self.__ain_names(pin_names)
+        out_address = self.__setup_stream_out(dac_num, values)
+        return self.__stream(names, [out_address], scanrate, scans_per_read, n_chunks)
+
+    def play_waveform(self, dac_num, values, scanrate, loops=1, pin_names=None,
+                      scans_per_read=None):
+        """
+        Output values on DAC<dac_num> (0 or 1) at scanrate samples per
+        second, loops times over, timed by the device. The DAC is left at
+        the last value. If pin_names are given, those inputs are streamed
+        in sync and returned as an array of shape (n_scans, n_channels),
+        one row per output sample, otherwise returns None.
+        """
+        values = np.asarray(values, dtype=float)
+        n_scans = len(values) * loops
+        if pin_names is None:
+            out_address = self.__setup_stream_out(dac_num, values)
+            self.stream_scan_rate = self.ljm.eStreamStart(
+                self.device, max(1, int(scanrate / 10)), 1, [out_address], scanrate)
+            try:
+                time.sleep(n_scans / self.stream_scan_rate)
+            finally:
+                self.ljm.eStreamStop(self.device)
+            self.dac_out(dac_num, float(values[-1]))
+            return None
+
+        names = self.__ain_names(pin_names)
+        if scans_per_read is None:
+            scans_per_read = max(1, min(n_scans, int(scanrate / 10)))
+        n_chunks = -(-n_scans // scans_per_read)
+        chunks = [chunk.data for chunk in self.waveform_chunks(
+            dac_num, values, scanrate, names, scans_per_read, n_chunks)]
+        self.dac_out(dac_num, float(values[-1]))
+        return np.concatenate(chunks)[:n_scans]
+
+    def function_out(self, dac_num, shape, amplitude, frequency, offset=0., init_phase=0.,
+                     n_cycles=1, samples_per_cycle=100, pin_names=None):
+        """
+        Output n_cycles periods of a waveform on DAC<dac_num> (0 or 1),
+        timed by the device: shape is one of WAVEFORMS, amplitude [V]
+        peak to peak around offset [V], frequency [Hz], init_phase
+        [degrees]. The scan rate is samples_per_cycle times frequency, so
+        the frequency is exact. See play_waveform for pin_names and the
+        return value.
+
+        Example: amplitude 1, frequency 1000, shape "triangle", n_cycles 3
+        does what ramp_analog_out does, at a rate it can't reach.
+        """
+        values = waveform(shape, amplitude, offset, init_phase, samples_per_cycle)
+        return self.play_waveform(dac_num, values, frequency * samples_per_cycle,
+                                  loops=n_cycles, pin_names=pin_names)
+
+    def __ain_names(self, pin_names):
+        """
+        Normalize a pin or list of pins, given as names or numbers, to
+        a list of "AIN<n>" names. A string that isn't an AIN name
+        already is taken by its trailing number, e.g. "2" or "BlahAIN2"
+        becomes "AIN2".
+        """
+        if isinstance(pin_names, (str, int)):
+            pin_names = [pin_names]
+        names = []
+        for pin in pin_names:
+            if isinstance(pin, str) and not AIN_NAME.match(pin):
+                number = re.search(r"\d+$", pin)
+                if number is not None:
+                    pin = int(number.group())
+            names.append(pin if isinstance(pin, str) else "AIN{}".format(pin))
+        return names
 
     def close(self):
         """
@@ -130,8 +425,8 @@ class LabJackAnalog:
         """
 
         try:
-            ljm.close(self.device)
-        except ljm.LJMError as e:
+            self.ljm.close(self.device)
+        except self.ljm.LJMError as e:
             # Silently ignore the error if it's due to the LabJack
             # already being closed. Otherwise, something else went
             # wrong so pass it on the the calling program.
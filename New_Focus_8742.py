@@ -17,28 +17,28 @@ Further Information:
 
 Notes:
     1) Only tested with 1 8742 Model Open Loop Picomotor Controller.
-    2) Current code will not support multiple controllers
+    2) Several controllers are supported either on their own USB ports,
+        picked by serial number (see find_controllers), or daisy-chained
+        behind one USB controller, addressed with Controller.at_address
 
 TODO:
-    1) Add in multi controller functionality
-    2) Block illegal commands, not just commands with an invalid format
-    3) Develop GUI
-    4) Add in connection check.
-        Execute the following commands ever .5 s
-            1>1 MD?\r
-            1>1 TP?\r
-            1>2 TP?\r
-            1>3 TP?\r
-            1>4 TP?\r
-            1>ERRSTR?\r
-        Use http://stackoverflow.com/questions/6357850/how-do-i-run-some-python-code-in-another-process
+    1) Block illegal commands, not just commands with an invalid format
+    2) Develop GUI
 """
 
+import codecs
 import copy
+import threading
+import time
 import usb.core
 import usb.util
 import re
+from collections import namedtuple
 
+from instrumentation import instrumented
+
+# byte values stripped from the end of a reply
+WHITESPACE = frozenset(b' \t\r\n')
 NEWFOCUS_COMMAND_REGEX = re.compile("([0-9]{0,1})([a-zA-Z?]{2,})([0-9+-]*)")
 MOTOR_TYPE = {
     "0": "No motor connected",
@@ -47,6 +47,44 @@ MOTOR_TYPE = {
     "3": "'Standard' Motor"
 }
 
+# longest USB transfer the controller accepts, pipelined queries are packed
+# into transfers of at most this many bytes
+MAX_PACKET = 64
+# compiled commands kept per Controller, enough for every query on every axis
+# plus recent move targets
+COMMAND_CACHE_SIZE = 256
+
+# a validated command ready to send: usb_command is the encoded bytes and
+# get_reply tells whether the controller answers it
+CompiledCommand = namedtuple("CompiledCommand", ["command", "usb_command", "get_reply"])
+
+
+def _serial_number(dev):
+    """Serial number string of a USB device, None if it can't be read"""
+    try:
+        return dev.serial_number
+    except (usb.core.USBError, ValueError, NotImplementedError):
+        return None
+
+
+def find_controllers(idProduct=0x4000, idVendor=0x104d):
+    """Serial numbers of all controllers attached over USB
+
+    Pass one to Controller(..., serial_number=...) to open that controller.
+
+    Returns:
+        serial_numbers (list): None for a controller whose serial number
+            can't be read, e.g. for lack of permissions
+    """
+    devices = usb.core.find(find_all=True, idProduct=idProduct, idVendor=idVendor)
+    return [_serial_number(dev) for dev in devices]
+
+
+def _mnemonic(newfocus_command):
+    """Command mnemonic used to key instrumentation statistics"""
+    m = NEWFOCUS_COMMAND_REGEX.match(newfocus_command)
+    return m.group(2).upper() if m else "invalid"
+
 
 class Controller(object):
     """Picomotor Controller
@@ -59,7 +97,11 @@ class Controller(object):
         >>> controller.start_console()
     """
 
-    def __init__(self, idProduct, idVendor):
+    # milliseconds to wait for a reply before usb.core.USBTimeoutError
+    read_timeout = 1000
+
+    def __init__(self, idProduct, idVendor, dev=None, clock=time, verbose=True,
+                 serial_number=None, address=1):
         """Initialize the Picomotor class with the spec's of the attached device
 
         Call self._connect to set up communication with usb device and endpoints
@@ -67,15 +109,36 @@ class Controller(object):
         Args:
             idProduct (hex): Product ID of picomotor controller
             idVendor (hex): Vendor ID of picomotor controller
+            dev (usb.core.Device): Use this device instead of looking it up
+                by Vendor ID and Product ID, e.g. a
+                simulation.SimulatedPicomotorDevice
+            clock: Provides time() and sleep() for motion polling, the time
+                module or a simulated clock
+            verbose (bool): Print the controller and motor info on connect
+            serial_number (str): Open the controller with this serial number,
+                see find_controllers. The first one found if None
+            address (int): RS-485 address of the controller the commands go
+                to, cite [2 - 6.1.3]. 1 is the one on the USB port
         """
         self.idProduct = idProduct
         self.idVendor = idVendor
+        self.serial_number = serial_number
+        self.address = address
+        self.dev = dev
+        self.clock = clock
+        self.verbose = verbose
+        # serializes access to the endpoints, so a query's reply can't be
+        # read by another thread, e.g. health.ControllerHealthMonitor
+        self.lock = threading.RLock()
+        self._find_device = dev is None
+        self._master = None
+        self._compiled = {}
         self._connect()
 
     def _connect(self):
         """Connect class to USB device
 
-        Find device from Vendor ID and Product ID
+        Find device from Vendor ID, Product ID and, if given, serial number
         Setup taken from [1]
 
         Raises:
@@ -84,10 +147,17 @@ class Controller(object):
             Assert False: if the input and outgoing endpoints can't be established
         """
         # find the device
-        self.dev = usb.core.find(
-            idProduct=self.idProduct,
-            idVendor=self.idVendor
-        )
+        if self.dev is None and self.serial_number is not None:
+            self.dev = usb.core.find(
+                idProduct=self.idProduct,
+                idVendor=self.idVendor,
+                custom_match=lambda d: _serial_number(d) == self.serial_number
+            )
+        elif self.dev is None:
+            self.dev = usb.core.find(
+                idProduct=self.idProduct,
+                idVendor=self.idVendor
+            )
 
         if self.dev is None:
             raise ValueError('Device not found')
@@ -115,18 +185,89 @@ class Controller(object):
             usb.util.ENDPOINT_IN)
 
         assert (self.ep_out and self.ep_in) is not None
+        self._received = bytearray()
+        self._identify()
 
+    def _identify(self):
         # Confirm connection to user
         resp = self.command('VE?')
-        print("Connected to Motor Controller Model {}. Firmware {} {} {}\n".format(
-            *resp.split(' ')
-        ))
+        self.version = resp
+        if self.verbose:
+            print("Connected to Motor Controller Model {}. Firmware {} {} {}\n".format(
+                *resp.split(' ')
+            ))
+        self.motor_types = {}
         for m in range(1, 5):
             resp = self.command("{}QM?".format(m))
-            print("Motor #{motor_number}: {status}".format(
-                motor_number=m,
-                status=MOTOR_TYPE[resp[-1]]
-            ))
+            self.motor_types[m] = resp[-1]
+            if self.verbose:
+                print("Motor #{motor_number}: {status}".format(
+                    motor_number=m,
+                    status=MOTOR_TYPE[resp[-1]]
+                ))
+
+    def reconnect(self):
+        """Re-establish the USB connection, e.g. after the cable was pulled
+
+        Raises:
+            ValueError: if the device cannot be found
+            usb.core.USBError: if it is still not reachable
+        """
+        with self.lock:
+            if self._master is not None:
+                # daisy-chained controllers share the USB controller's link
+                self._master.reconnect()
+                self._identify()
+                return
+            if self._find_device and self.dev is not None:
+                usb.util.dispose_resources(self.dev)
+                self.dev = None
+            self._connect()
+
+    def close(self):
+        """Release the USB device, e.g. before another program opens it
+
+        A daisy-chained view leaves the shared link open, and a device
+        passed in as dev is left to its owner. reconnect() opens it again.
+        """
+        with self.lock:
+            if self._master is None and self._find_device and self.dev is not None:
+                usb.util.dispose_resources(self.dev)
+                self.dev = None
+
+    def at_address(self, address):
+        """Controller for another 8742 daisy-chained behind this one
+
+        The slave is reached through this controller's USB link, by
+        prefixing every command with its RS-485 address, cite [2 - 6.1.3].
+        Both objects share the lock, so they can be used from different
+        threads. The slave has no endpoints of its own, it always goes
+        through the master's, also after the master reconnects.
+
+        Args:
+            address (int): RS-485 address of the slave, see
+                network_addresses
+
+        Returns:
+            controller (Controller)
+        """
+        slave = copy.copy(self)
+        slave.address = address
+        slave._master = self if self._master is None else self._master
+        slave._compiled = {}
+        del slave.dev, slave.ep_out, slave.ep_in, slave._received
+        slave._identify()
+        return slave
+
+    def network_addresses(self):
+        """Addresses of the controllers on the RS-485 network (SC?)
+
+        Returns:
+            addresses (list): Addresses of the controllers found by the last
+                scan, cite [2 - 6.2 SC?]
+        """
+        mask = int(self.command("SC?"))
+        return [address for address in range(1, 32) if mask >> address & 1]
 
     def send_command(self, usb_command, get_reply=False):
         """Send command to USB device endpoint
@@ -140,9 +281,27 @@ class Controller(object):
             Character representation of returned hex values if a reply is
                 requested
         """
-        self.ep_out.write(usb_command)
-        if get_reply:
-            return self.ep_in.read(100)
+        with self.lock:
+            self._write(usb_command)
+            if get_reply:
+                return self._read()
+
+    @property
+    def _link(self):
+        """The controller owning the USB endpoints and the receive buffer"""
+        return self if self._master is None else self._master
+
+    @instrumented("usb.write")
+    def _write(self, usb_command):
+        self._link.ep_out.write(usb_command)
+
+    @instrumented("usb.read")
+    def _read(self, size=100):
+        return self._link.ep_in.read(size, self.read_timeout)
+
+    @instrumented("controller.sleep", key=lambda self, seconds, reason: reason)
+    def _sleep(self, seconds, reason):
+        self.clock.sleep(seconds)
 
     def parse_command(self, newfocus_command):
         """Convert a NewFocus style command into a USB command
@@ -167,10 +326,18 @@ class Controller(object):
 
             # Construct USB safe command
             if driver_number:
-                usb_command = '1>{driver_number} {command}'.format(
+                usb_command = '{address}>{driver_number} {command}'.format(
+                    address=self.address,
                     driver_number=driver_number,
                     command=usb_command
                 )
+            elif self.address != 1:
+                # the controller on the USB port also takes unaddressed
+                # commands, the others have to be addressed
+                usb_command = '{address}>{command}'.format(
+                    address=self.address,
+                    command=usb_command
+                )
             if parameter:
                 usb_command = '{command} {parameter}'.format(
                     command=usb_command,
@@ -195,10 +362,47 @@ class Controller(object):
             reply (str): Cleaned string of controller reply
         """
 
-        # convert hex to characters
-        reply = ''.join([chr(x) for x in reply])
-        return reply.rstrip()
+        # decode a view of the USB buffer without the line end, so the str
+        # is the only copy
+        with memoryview(reply) as view:
+            n = len(view)
+            while n and view[n - 1] in WHITESPACE:
+                n -= 1
+            return codecs.decode(view[:n], 'ascii')
+
+    def compile(self, newfocus_command):
+        """Validate and encode a NewFocus formated command once
+
+        The result is cached, so repeated commands such as xMD? or xTP? skip
+        the parsing and formatting on later calls.
+
+        Args:
+            newfocus_command (str): Legal command listed in usermanual [2 - 6.2]
+
+        Returns:
+            compiled (CompiledCommand): None if the command is not a valid
+                format
+        """
+        compiled = self._compiled.get(newfocus_command)
+        if compiled is not None:
+            return compiled
+
+        usb_command = self.parse_command(newfocus_command)
+        if usb_command is None:
+            return None
+        compiled = CompiledCommand(
+            command=newfocus_command,
+            usb_command=usb_command.encode('ascii'),
+            # if there is a '?' in the command, the user expects a response
+            # from the driver
+            get_reply='?' in newfocus_command,
+        )
+        if len(self._compiled) >= COMMAND_CACHE_SIZE:
+            self._compiled.clear()
+        self._compiled[newfocus_command] = compiled
+        return compiled
 
+    @instrumented("controller.command", key=lambda self, c: _mnemonic(c))
     def command(self, newfocus_command):
         """Send NewFocus formated command
 
@@ -208,21 +412,246 @@ class Controller(object):
         Returns:
             reply (str): Human readable reply from controller
         """
-        usb_command = self.parse_command(newfocus_command)
-
-        # if there is a '?' in the command, the user expects a response from
-        # the driver
-        if '?' in newfocus_command:
-            get_reply = True
-        else:
-            get_reply = False
+        compiled = self.compile(newfocus_command)
+        if compiled is None:
+            return None
 
-        reply = self.send_command(usb_command, get_reply)
+        reply = self.send_command(compiled.usb_command, compiled.get_reply)
 
         # if a reply is expected, parse it
+        if compiled.get_reply:
+            return self.parse_reply(reply)
+
+    @instrumented("controller.command_batch")
+    def command_batch(self, newfocus_commands):
+        """Send several NewFocus formated commands in one USB transaction
+
+        The commands are joined with ';' on a single line, which the
+        controller executes in order, cite [2 - 6.1.2]
+
+        Args:
+            newfocus_commands (list): Legal commands listed in usermanual
+                [2 - 6.2]
+
+        Returns:
+            reply (str): Human readable reply from controller if any of the
+                commands is a query, otherwise None
+
+        Raises:
+            ValueError: if any of the commands is not a valid format, in which
+                case nothing is sent
+        """
+        compiled = self._compile_all(newfocus_commands)
+        get_reply = any(c.get_reply for c in compiled)
+        reply = self.send_command(
+            b';'.join(c.usb_command.rstrip(b'\r') for c in compiled) + b'\r',
+            get_reply
+        )
+
         if get_reply:
             return self.parse_reply(reply)
 
+    def _compile_all(self, newfocus_commands):
+        compiled = []
+        for newfocus_command in newfocus_commands:
+            c = self.compile(newfocus_command)
+            if c is None:
+                raise ValueError("Batch rejected, command {} was not a valid "
+                                 "format".format(newfocus_command))
+            compiled.append(c)
+        return compiled
+
+    @instrumented("controller.query_pipelined")
+    def query_pipelined(self, newfocus_commands):
+        """Send several queries back to back, then collect the replies
+
+        The queries are packed ';' separated into as few USB transfers as
+        fit in MAX_PACKET bytes and all written before the first read. The
+        replies, one line per query, are then drained in order, so N queries
+        cost a couple of transfers instead of 2N.
+
+        Args:
+            newfocus_commands (list): Queries such as "1MD?" or "2TP?"
+
+        Returns:
+            replies (list): Human readable reply to each query, in order
+
+        Raises:
+            ValueError: if a command is not a valid query, in which case
+                nothing is sent
+            usb.core.USBTimeoutError: if a reply doesn't arrive within
+                read_timeout milliseconds. Replies still in flight are
+                discarded, so the next command starts in sync
+        """
+        compiled = self._compile_all(newfocus_commands)
+        for c in compiled:
+            if not c.get_reply:
+                raise ValueError("Command {} is not a query".format(c.command))
+        if not compiled:
+            return []
+
+        packets = []
+        packet = b''
+        for c in compiled:
+            query = c.usb_command.rstrip(b'\r')
+            if packet and len(packet) + len(query) + 2 > MAX_PACKET:
+                packets.append(packet + b'\r')
+                packet = b''
+            packet = packet + b';' + query if packet else query
+        packets.append(packet + b'\r')
+
+        with self.lock:
+            for packet in packets:
+                self._write(packet)
+            try:
+                return self._read_lines(len(compiled))
+            except Exception:
+                del self._link._received[:]
+                raise
+
+    def _read_lines(self, n):
+        lines = []
+        received = self._link._received
+        while len(lines) < n:
+            end = received.find(b'\r\n')
+            if end < 0:
+                received.extend(self._read(MAX_PACKET))
+                continue
+            # the view has to be released before the buffer shrinks
+            with memoryview(received) as view:
+                lines.append(codecs.decode(view[:end], 'ascii').strip())
+            del received[:end + 2]
+        return lines
+
+    def move_all(self, positions, wait=True, **wait_kwargs):
+        """Move several axes to absolute positions at once
+
+        All xPAnn commands go out in a single USB packet so the motors move
+        in parallel, followed by a single wait for all of them.
+
+        Args:
+            positions (list or dict): Target positions in steps, either in
+                axis order starting at motor 1 or keyed by motor number
+            wait (bool): Block until every moved motor has stopped
+            **wait_kwargs: poll_interval, timeout, settle_time and health,
+                passed on to wait_for_motion_done
+
+        Returns:
+            elapsed (float): Seconds spent waiting for the move, 0 if wait is
+                False
+        """
+        if not isinstance(positions, dict):
+            positions = dict(enumerate(positions, start=1))
+
+        self.command_batch([
+            "{}PA{}".format(axis, int(round(position)))
+            for axis, position in sorted(positions.items())
+        ])
+        if wait:
+            return self.wait_for_motion_done(sorted(positions), **wait_kwargs)
+        return 0.
+
+    def motion_done(self, axis):
+        """Query whether an axis has finished moving
+
+        Args:
+            axis (int): Motor number (1-4)
+
+        Returns:
+            done (bool): True if the motor is stopped, cite [2 - 6.2 MD?]
+        """
+        return self.command("{}MD?".format(axis))[-1] == '1'
+
+    def wait_for_motion_done(self, axes=(1, 2, 3, 4), poll_interval=0.01,
+                             timeout=30., settle_time=0., health=None):
+        """Block until all the given axes report motion done
+
+        Polls xMD? on every axis that is still moving, pipelined into one
+        round trip, so the call returns as soon as the last motor stops
+        instead of after a fixed sleep.
+
+        Args:
+            axes (iterable or int): Motor number(s) to wait on
+            poll_interval (float): Seconds between successive MD? rounds
+            timeout (float): Give up after this many seconds. None waits
+                forever
+            settle_time (float): Extra seconds to wait after the motors stop,
+                e.g. to let the mount stop ringing before a measurement
+            health (ControllerHealthMonitor): Read motion done from its
+                snapshot while one queried since this call is fresh, and
+                only poll MD? when it is stale
+
+        Returns:
+            elapsed (float): Seconds spent waiting, including settle time
+
+        Raises:
+            TimeoutError: if an axis is still moving after timeout seconds
+        """
+        if isinstance(axes, int):
+            axes = (axes,)
+        pending = list(axes)
+        start = self.clock.time()
+
+        while True:
+            done = None if health is None else health.motion_done(pending, since=start)
+            if done is None:
+                replies = self.query_pipelined(["{}MD?".format(axis) for axis in pending])
+                done = [reply[-1:] == '1' for reply in replies]
+            pending = [axis for axis, axis_done in zip(pending, done) if not axis_done]
+            if not pending:
+                break
+            if timeout is not None and self.clock.time() - start > timeout:
+                raise TimeoutError(
+                    "Motion on axis {} not done after {} s".format(
+                        ', '.join(str(axis) for axis in pending), timeout
+                    )
+                )
+            self._sleep(poll_interval, "poll")
+
+        if settle_time:
+            self._sleep(settle_time, "settle")
+        return self.clock.time() - start
+
+    def get_position(self, axis):
+        """Query the position counter of an axis (xTP?)
+
+        Args:
+            axis (int): Motor number (1-4)
+
+        Returns:
+            position (int): Steps from home
+        """
+        return int(self.command("{}TP?".format(axis)))
+
+    def get_positions(self, axes=(1, 2, 3, 4)):
+        """Query the position counters of several axes
+
+        Returns:
+            positions (list): Steps from home, in the order of axes
+        """
+        replies = self.query_pipelined(["{}TP?".format(axis) for axis in axes])
+        return [int(reply) for reply in replies]
+
+    def move_to(self, axis, position, wait=True, **wait_kwargs):
+        """Move an axis to an absolute target position (xPAnn)
+
+        Args:
+            axis (int): Motor number (1-4)
+            position (float): Target position in steps, rounded to the
+                nearest integer step
+            wait (bool): Block until the motor has stopped
+            **wait_kwargs: poll_interval, timeout, settle_time and health,
+                passed on to wait_for_motion_done
+
+        Returns:
+            elapsed (float): Seconds spent waiting for the move, 0 if wait is
+                False
+        """
+        self.command("{}PA{}".format(axis, int(round(position))))
+        if wait:
+            return self.wait_for_motion_done(axis, **wait_kwargs)
+        return 0.
+
     def show_command(self):
         print('''
         Picomotor Command Line
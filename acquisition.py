@@ -0,0 +1,148 @@
+"""
+Signal-lost recovery: raster search for the coupled beam
+
+When the fiber is far off, the photodiode reads only its dark noise at
+every pose and a local optimizer has no gradient to follow. acquire
+searches the tilt plane of one mirror pair with a serpentine raster of fly
+scans: the first axis sweeps continuously across the search width while
+the photodiode streams, the second steps between lines. Lines are visited
+from the current pose outwards, first at a coarse pitch and then at finer
+ones in between, and the search stops as soon as a sample crosses the
+detection threshold. The worst case is a fixed number of lines of known
+length, so the time a failed search takes is bounded and predictable.
+
+Example:
+
+    >>> if not signal_present(lj, 2, threshold=0.1):
+    ...     acquisition = acquire(controller, lj, 2, threshold=0.1)
+    >>> result = minimize(make_optimizer(...), objective)
+"""
+
+from collections import namedtuple
+
+import numpy as np
+
+from fly_scan import fly_scan, move_duration
+
+AcquisitionResult = namedtuple("AcquisitionResult", [
+    "found", "pose", "power", "lines", "elapsed"
+])
+
+
+def signal_present(lj, input_channel, threshold, samples=10):
+    """Whether the mean photodiode reading reaches the detection threshold
+
+    Args:
+        lj (LabJackAnalog): LabJack reading the photodiode
+        input_channel (int or str): Photodiode analog input
+        threshold (float): Detection threshold, a few times the dark noise
+            above the dark level
+        samples (int): Readings averaged
+    """
+    return np.mean([lj.analog_in(input_channel) for _ in range(samples)]) >= threshold
+
+
+def line_offsets(half_width, pitches):
+    """Offsets of the raster lines, centre out and coarse to fine
+
+    Each pitch adds the lines of its grid that a coarser pitch hasn't
+    covered yet.
+
+    Args:
+        half_width (float): Largest offset from the centre, in steps
+        pitches (iterable): Line spacings, coarsest first
+
+    Returns:
+        offsets (list): In the order to scan them
+    """
+    offsets = []
+    for pitch in pitches:
+        n = int(half_width // pitch)
+        for k in sorted(range(-n, n + 1), key=lambda k: (abs(k), -k)):
+            offset = k*pitch
+            if all(abs(offset - o) >= 0.5*pitch for o in offsets):
+                offsets.append(offset)
+    return offsets
+
+
+def acquire(controller, lj, input_channel, threshold, axes=(1, 2), width=2000,
+            pitches=(200, 100), velocity=None, scan_rate=1000., max_lines=None):
+    """Raster the tilt plane of a mirror until the photodiode sees light
+
+    Args:
+        controller (Controller): Controller driving the mirrors
+        lj (LabJackAnalog): LabJack reading the photodiode
+        input_channel (int or str): Photodiode analog input
+        threshold (float): Detection threshold, see signal_present
+        axes (tuple): (swept axis, stepped axis), usually the x and y tilt
+            of one mirror
+        width (int): Side of the square searched around the current pose,
+            in steps
+        pitches (iterable): Line spacings, coarsest first. The finest
+            should be below the width of the coupling peak along the
+            stepped axis
+        velocity (int): Sweep velocity in steps per second, the axis' VA
+            if None
+        scan_rate (float): Photodiode samples per second
+        max_lines (int): Give up after this many lines, all of them if None
+
+    Returns:
+        result (AcquisitionResult): If found, the mirrors are left at the
+            brightest sample of the detecting line. Otherwise they are
+            moved back to where they started. pose is the final position
+            of every axis
+    """
+    clock = controller.clock
+    start = clock.time()
+    sweep_axis, step_axis = axes
+    centre = dict(zip(axes, controller.get_positions(axes)))
+    half = width // 2
+    offsets = line_offsets(half, pitches)
+    if max_lines is not None:
+        offsets = offsets[:max_lines]
+
+    direction = 1
+    for lines, offset in enumerate(offsets, start=1):
+        # serpentine: each line starts where the previous one ended
+        controller.move_all({
+            sweep_axis: centre[sweep_axis] - direction*half,
+            step_axis: centre[step_axis] + offset,
+        })
+        scan = fly_scan(controller, lj, sweep_axis, direction*width, input_channel,
+                        scan_rate=scan_rate, velocity=velocity, stop_above=threshold)
+        direction = -direction
+        if len(scan.power) and np.nanmax(scan.power) >= threshold:
+            best = int(np.nanargmax(scan.power))
+            controller.move_to(sweep_axis, scan.position[best])
+            return AcquisitionResult(
+                found=True,
+                pose=controller.get_positions(),
+                power=float(scan.power[best]),
+                lines=lines,
+                elapsed=clock.time() - start,
+            )
+
+    controller.move_all(centre)
+    return AcquisitionResult(
+        found=False,
+        pose=controller.get_positions(),
+        power=None,
+        lines=len(offsets),
+        elapsed=clock.time() - start,
+    )
+
+
+def worst_case_time(width=2000, pitches=(200, 100), velocity=2000,
+                    acceleration=100000, max_lines=None):
+    """Upper estimate of the motion time of a failed acquire, in seconds
+
+    Counts the sweeps and the moves between lines, not the USB and stream
+    overheads, which add a few percent.
+    """
+    lines = len(line_offsets(width // 2, pitches))
+    if max_lines is not None:
+        lines = min(lines, max_lines)
+    sweep = move_duration(width, velocity, acceleration)
+    # moving to the next line can take up to the full width on the stepped axis
+    step = move_duration(width, velocity, acceleration)
+    return lines*(sweep + step)
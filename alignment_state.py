@@ -0,0 +1,257 @@
+"""
+Alignment state persisted between runs
+
+After an alignment the best pose, the final simplex, per-axis sensitivity
+estimates and the photodiode noise are written to a small versioned JSON
+file. The next run or re-coupling event starts from that state with a
+simplex shaped and sized like the last one, so a small drift costs a
+handful of evaluations instead of a full cold search.
+
+Poses are in the controller's step counter frame. The simplex is stored as
+offsets from the best pose, so it can be placed around wherever the mirrors
+are when the next run starts.
+
+Example:
+
+    >>> state = AlignmentState.from_run(result, optimizer, evaluator)
+    >>> save_state("alignment_state.json", state)
+    >>> state = load_state("alignment_state.json")
+    >>> step, simplex = warm_start(state, controller.get_positions())
+"""
+
+import json
+import os
+import tempfile
+import time
+
+import numpy as np
+
+STATE_VERSION = 1
+# smallest to largest edge extent of a warm start simplex in beam walk
+# coordinates, where a good simplex is about regular
+MIN_WHITENED_ASPECT = 0.05
+
+
+class AlignmentState(object):
+    """What one alignment run learned
+
+    Attributes:
+        best_pose (list): Motor positions of the best coupling
+        best_power (float): Photodiode power at best_pose
+        step (float): Size of the final search pattern, in steps
+        simplex_offsets (list): Final simplex vertices minus best_pose, None
+            if the algorithm had no simplex
+        sensitivity (list): Curvature of the power along each axis, in power
+            per step squared, None if it couldn't be estimated
+        noise (float): Per-sample photodiode noise, None if unknown
+        evaluations (int): Evaluations the run took
+        timestamp (float): time.time() when the state was made
+    """
+
+    def __init__(self, best_pose, best_power, step, simplex_offsets=None,
+                 sensitivity=None, noise=None, evaluations=None, timestamp=None):
+        self.best_pose = [float(x) for x in best_pose]
+        self.best_power = float(best_power)
+        self.step = float(step)
+        self.simplex_offsets = simplex_offsets
+        self.sensitivity = sensitivity
+        self.noise = noise
+        self.evaluations = evaluations
+        self.timestamp = time.time() if timestamp is None else timestamp
+
+    @classmethod
+    def from_run(cls, result, optimizer=None, evaluator=None):
+        """Build the state from a finished optimization
+
+        Args:
+            result (OptimizationResult): From optimizers.minimize
+            optimizer (Optimizer): The optimizer that produced result, for
+                its final simplex or step
+            evaluator (AdaptiveEvaluator): For the noise estimate
+        """
+        best = np.asarray(result.x, dtype=float)
+        simplex_offsets = None
+        step = getattr(optimizer, "current_step", None)
+        if getattr(optimizer, "simplex", None):
+            offsets = np.array([x for x, _ in optimizer.simplex]) - best
+            simplex_offsets = offsets.tolist()
+            step = float(np.max(np.linalg.norm(offsets, axis=1)))
+        if step is None:
+            step = optimizer.step if optimizer is not None else 0.
+
+        sensitivity = estimate_sensitivity(result.history)
+        return cls(
+            best_pose=best,
+            best_power=-result.score,
+            step=step,
+            simplex_offsets=simplex_offsets,
+            sensitivity=None if sensitivity is None else sensitivity.tolist(),
+            noise=None if evaluator is None else evaluator.noise,
+            evaluations=result.evaluations,
+        )
+
+    def to_dict(self):
+        return {
+            "version": STATE_VERSION,
+            "timestamp": self.timestamp,
+            "best_pose": self.best_pose,
+            "best_power": self.best_power,
+            "step": self.step,
+            "simplex_offsets": self.simplex_offsets,
+            "sensitivity": self.sensitivity,
+            "noise": self.noise,
+            "evaluations": self.evaluations,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        version = data.get("version")
+        if version != STATE_VERSION:
+            raise ValueError("Unsupported alignment state version {}, expected {}".format(
+                version, STATE_VERSION))
+        return cls(
+            best_pose=data["best_pose"],
+            best_power=data["best_power"],
+            step=data["step"],
+            simplex_offsets=data.get("simplex_offsets"),
+            sensitivity=data.get("sensitivity"),
+            noise=data.get("noise"),
+            evaluations=data.get("evaluations"),
+            timestamp=data.get("timestamp"),
+        )
+
+
+def write_json_atomic(path, data):
+    """Write data as JSON next to path and rename it over path
+
+    A crash leaves either the old or the new file, never a partial one.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    prefix = "." + os.path.basename(path) + "."
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=prefix, suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f, indent=1)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def save_state(path, state):
+    """Write the state atomically, see write_json_atomic"""
+    write_json_atomic(path, state.to_dict())
+
+
+def load_state(path):
+    """Read a saved state
+
+    Returns:
+        state (AlignmentState): None if there is no file at path
+
+    Raises:
+        ValueError: if the file has an unsupported version
+    """
+    try:
+        with open(path) as f:
+            data = json.load(f)
+    except (IOError, OSError):
+        return None
+    return AlignmentState.from_dict(data)
+
+
+def estimate_sensitivity(history, n_recent=None):
+    """Curvature of the power along each axis near the end of a run
+
+    Fits score = c + g.dx + sum(h_i dx_i**2) by least squares to the most
+    recent evaluations around the best one.
+
+    Args:
+        history (History): From optimizers.minimize
+        n_recent (int): Evaluations used, 3 per fitted parameter if None
+
+    Returns:
+        sensitivity (array): |h_i| in power per step squared, None if there
+            are too few distinct evaluations for the fit
+    """
+    if not len(history):
+        return None
+    x = history.positions()
+    scores = history.scores()
+    dim = x.shape[1]
+    n_params = 2*dim + 1
+    if n_recent is None:
+        n_recent = 3*n_params
+    x, scores = x[-n_recent:], scores[-n_recent:]
+    if len(x) < n_params:
+        return None
+
+    dx = x - x[np.argmin(scores)]
+    design = np.hstack([np.ones((len(dx), 1)), dx, dx**2])
+    coefficients, _, rank, _ = np.linalg.lstsq(design, scores, rcond=None)
+    if rank < n_params:
+        return None
+    return np.abs(coefficients[1 + dim:])
+
+
+def warm_start(state, x0, min_step=2., max_step=None, walk=None):
+    """Step and initial simplex for a run starting from a saved state
+
+    The last simplex is placed around x0 and rescaled so that its size is
+    within [min_step, max_step]. Without a usable simplex, an axis aligned
+    one is built with per-axis steps from the sensitivity estimates, so that
+    each axis changes the power by about the same amount.
+
+    With a BeamWalk, the simplex size and its limits are measured in the
+    whitened coordinates the search will run in, not in motor steps, and
+    there is no axis aligned fallback, which would undo them. A simplex
+    that is flat in those coordinates only keeps its size, the search
+    starts from a regular one.
+
+    Args:
+        state (AlignmentState): From load_state
+        x0 (array): Current motor positions
+        min_step (float): Smallest simplex size, in steps, about the motor
+            resolution times the noise you can live with
+        max_step (float): Largest simplex size, unlimited if None
+        walk (beam_walk.BeamWalk): Coordinates of the search, motor steps
+            if None
+
+    Returns:
+        (step, initial_simplex): step is in the coordinates of the search,
+            initial_simplex in motor steps. initial_simplex is None if
+            neither a simplex nor sensitivities are available, use an axis
+            aligned simplex of size step then
+    """
+    x0 = np.asarray(x0, dtype=float)
+    dim = len(x0)
+    step = max(state.step, min_step)
+    if max_step is not None:
+        step = min(step, max_step)
+
+    if state.simplex_offsets is not None:
+        offsets = np.array(state.simplex_offsets, dtype=float)
+        search = offsets if walk is None else walk.from_pose(offsets)
+        size = np.max(np.linalg.norm(search, axis=1))
+        edges = offsets[1:] - offsets[0]
+        if size > 0 and np.linalg.matrix_rank(edges) == dim:
+            if walk is not None:
+                # state.step is in motor steps, the saved simplex tells the size
+                step = max(size, min_step)
+                if max_step is not None:
+                    step = min(step, max_step)
+                singular = np.linalg.svd(search[1:] - search[0], compute_uv=False)
+                if singular[-1] < MIN_WHITENED_ASPECT*singular[0]:
+                    return step, None
+            return step, x0 + offsets*(step/size)
+
+    if state.sensitivity is not None and walk is None:
+        sensitivity = np.array(state.sensitivity, dtype=float)
+        if np.all(sensitivity > 0):
+            steps = step*np.sqrt(np.mean(sensitivity)/sensitivity)
+            steps = np.clip(steps, min_step, 10*step if max_step is None else max_step)
+            return step, np.vstack([x0, x0 + np.diag(steps)])
+
+    return step, None
@@ -0,0 +1,551 @@
+"""
+Headless entry point: align, monitor and scan from a config file
+
+with_control.py is a script to edit and run by hand. This is the same
+alignment for unattended use, e.g. from cron or a service: every setting
+comes from a JSON config file (keys as in DEFAULT_CONFIG, missing ones
+take the default), the controller and the LabJack are opened once per run
+and closed on exit, nothing is plotted unless asked for, and the exit code
+tells whether the coupling goal was reached. numpy, the device drivers and
+the optimizers are only imported by the subcommand that needs them, so
+--help and a bad config fail fast.
+
+Usage:
+
+    $ python autocoupling.py defaults > coupling.json
+    $ python autocoupling.py align --config coupling.json
+    $ python autocoupling.py monitor --config coupling.json --align
+    $ python autocoupling.py scan --config coupling.json --axis 1 --span 400
+    $ python autocoupling.py calibrate --config coupling.json --axes
+    $ python autocoupling.py simulate --misalignment 300 -200 100 0 --seed 1
+    $ python autocoupling.py align --config coupling.json --set step=30 --set algorithm=spsa
+
+simulate is a single alignment on the simulated bench, to try a config
+without hardware. benchmark.py compares the optimizers over many runs.
+"""
+
+import argparse
+import copy
+import json
+import os
+import signal
+import sys
+import time
+
+EXIT_GOAL_MISSED = 1
+EXIT_NO_SIGNAL = 2
+
+DEFAULT_CONFIG = {
+    "controller": {
+        "id_product": "0x4000",
+        "id_vendor": "0x104d",
+        "serial_number": None,      # pick one of several controllers
+    },
+    "labjack": {
+        "model": "ANY",
+        "connection": "ANY",
+        "identifier": "ANY",
+    },
+    "input_channel": 2,             # photodiode behind the fiber
+    "reference_channel": None,      # photodiode on a pickoff of the laser
+    "reference_level": 1.,          # its reading at the nominal laser power
+    "peak_power": 3.14,             # photodiode reading of perfect coupling
+    "goal_fraction": 0.9,           # stop optimizing above this fraction
+    "threshold_fraction": 0.85,     # monitor re-couples below this fraction
+    "acquisition_fraction": 0.03,   # below this fraction the beam is lost
+    "acquisition_width": 2000,      # side of the square searched, in steps
+    "algorithm": "nelder-mead",     # from optimizers.OPTIMIZERS
+    "step": 50.,
+    "max_iter": 100,
+    "goal_iterations": 3,
+    "algorithm_params": {
+        "nelder-mead": {"alpha": 1., "gamma": 2., "rho": -0.5, "sigma": 0.5,
+                        "surrogate": "gaussian"},
+    },
+    "settle_time": 0.05,
+    "min_samples": 3,
+    "max_samples": 30,
+    "cache_max_age": 60.,
+    "approach_direction": 1,        # None to move straight
+    "output_folder": ".",
+    "state_file": "alignment_state.json",        # None for no warm start
+    "calibration_file": "axis_calibration.json",  # None for no compensation
+    "beam_walk_file": "beam_walk.json",  # None to search in motor steps
+    "beam_walk_loss": 0.2,          # power lost by the initial beam walk step
+    "telemetry_max_bytes": 100*1024**2,
+    "scan": {
+        "axis": 1,
+        "span": 400,
+        "velocity": None,           # the axis' VA if None
+        "scan_rate": 1000.,
+    },
+    "verbose": False,
+}
+
+
+def _merge(defaults, values, prefix=""):
+    merged = copy.deepcopy(defaults)
+    for key, value in values.items():
+        if key not in defaults:
+            raise ValueError("Unknown config key {!r}".format(prefix + key))
+        if isinstance(defaults[key], dict) and key != "algorithm_params":
+            if not isinstance(value, dict):
+                raise ValueError("Config key {!r} takes a mapping".format(prefix + key))
+            value = _merge(defaults[key], value, prefix + key + ".")
+        merged[key] = value
+    return merged
+
+
+def load_config(path=None, overrides=()):
+    """Configuration from a JSON file on top of DEFAULT_CONFIG
+
+    Args:
+        path (str): Config file, only the defaults if None
+        overrides (iterable): "key=value" strings applied last, the key may
+            be dotted for nested settings (scan.span=600) and the value is
+            read as JSON, or taken as a string if it isn't JSON
+
+    Returns:
+        config (dict)
+
+    Raises:
+        ValueError: on a key that isn't in DEFAULT_CONFIG, e.g. a typo
+    """
+    values = {}
+    if path is not None:
+        with open(path) as f:
+            values = json.load(f)
+    config = _merge(DEFAULT_CONFIG, values)
+
+    for override in overrides:
+        key, sep, text = override.partition("=")
+        if not sep:
+            raise ValueError("Override {!r} isn't key=value".format(override))
+        try:
+            value = json.loads(text)
+        except ValueError:
+            value = text
+        for part in reversed(key.split(".")):
+            value = {part: value}
+        config = _merge(config, value)
+    return config
+
+
+def open_devices(config):
+    """Open the controller and the LabJack of a config
+
+    Returns:
+        (controller, lj)
+    """
+    from LabJackAnalog import LabJackAnalog
+    from New_Focus_8742 import Controller
+
+    c = config["controller"]
+    controller = Controller(int(c["id_product"], 16), int(c["id_vendor"], 16),
+                            verbose=config["verbose"], serial_number=c["serial_number"])
+    try:
+        lj = LabJackAnalog(**config["labjack"])
+    except Exception:
+        controller.close()
+        raise
+    return controller, lj
+
+
+def close_devices(controller, lj):
+    """Close what open_devices opened, the LabJack even if the controller
+    fails"""
+    try:
+        controller.close()
+    finally:
+        lj.close()
+
+
+def _mirrors(config, controller):
+    """The controller, behind a CompensatedController if there is a
+    calibration"""
+    from compensation import CompensatedController, load_calibration
+
+    path = config["calibration_file"]
+    calibration = None if path is None else load_calibration(path)
+    if calibration is None:
+        return controller
+    return CompensatedController(controller, calibration,
+                                 approach=config["approach_direction"])
+
+
+def _beam_walk(config):
+    from beam_walk import load_beam_walk
+
+    path = config["beam_walk_file"]
+    return None if path is None else load_beam_walk(path)
+
+
+def _evaluator(config, lj):
+    from evaluation import AdaptiveEvaluator
+
+    return AdaptiveEvaluator(lj, config["input_channel"],
+                             min_samples=config["min_samples"],
+                             max_samples=config["max_samples"],
+                             reference_channel=config["reference_channel"],
+                             reference_level=config["reference_level"])
+
+
+def _set_home(controller, mirrors):
+    for axis in (1, 2, 3, 4):
+        controller.command("{}DH".format(axis))
+    if mirrors is not controller:
+        mirrors.reset()
+
+
+def _open_telemetry(config):
+    from telemetry import TelemetryWriter
+
+    return TelemetryWriter(os.path.join(config["output_folder"], "telemetry.bin"),
+                           max_bytes=config["telemetry_max_bytes"])
+
+
+def run_align(config, controller, lj, telemetry=None, clock=time, walk=None, health=None):
+    """Acquire the beam if it is lost and optimize the coupling
+
+    The pose reached becomes home (DH) and what the run learned is saved to
+    the state file, as in with_control.py.
+
+    Args:
+        config (dict): From load_config
+        controller (Controller): Controller driving the mirrors
+        lj (LabJackAnalog): LabJack reading the photodiode
+        telemetry (TelemetryWriter): Records every evaluation
+        clock: Time source of the run, e.g. a simulation.VirtualClock
+        walk (BeamWalk): Coordinates to search in, read from beam_walk_file
+            if None
+        health (ControllerHealthMonitor): Running monitor of the controller,
+            moves wait on its snapshot instead of polling MD? while it is fresh
+
+    Returns:
+        (result, efficiency): The OptimizationResult, None if the beam
+            couldn't be found, and the final power over peak_power
+    """
+    import numpy as np
+
+    from acquisition import acquire, signal_present
+    from alignment_state import AlignmentState, load_state, save_state, warm_start
+    from beam_walk import make_whitened_optimizer
+    from evaluation import EvaluationCache, HardwareObjective
+    from optimizers import make_optimizer, minimize
+    from scheduling import MotionScheduler
+
+    peak_power = config["peak_power"]
+    goal = config["goal_fraction"]*peak_power
+    input_channel = config["input_channel"]
+    settle_time = config["settle_time"]
+
+    threshold = config["acquisition_fraction"]*peak_power
+    if not signal_present(lj, input_channel, threshold):
+        acquisition = acquire(controller, lj, input_channel, threshold,
+                              width=config["acquisition_width"])
+        print(acquisition)
+        if not acquisition.found:
+            print("no signal within {} steps".format(config["acquisition_width"] // 2))
+            return None, 0.
+
+    mirrors = _mirrors(config, controller)
+    evaluator = _evaluator(config, lj)
+    cache = EvaluationCache(max_age=config["cache_max_age"], clock=clock)
+    objective = HardwareObjective(mirrors, evaluator, cache=cache, health=health,
+                                  settle_time=settle_time)
+    scheduler = MotionScheduler(mirrors, cache=cache)
+
+    algorithm = config["algorithm"]
+    algorithm_params = dict(config["algorithm_params"].get(algorithm, {}))
+    if walk is None:
+        walk = _beam_walk(config)
+    step = config["step"] if walk is None else walk.step_for_loss(config["beam_walk_loss"])
+    state_file = config["state_file"]
+    state = None if state_file is None else load_state(state_file)
+    if state is None:
+        _set_home(controller, mirrors)
+        x_start = np.zeros(4)
+    else:
+        if health is not None and mirrors is controller:
+            x_start = np.array(health.positions(), dtype=float)
+        else:
+            x_start = np.array(mirrors.get_positions(), dtype=float)
+        step, initial_simplex = warm_start(state, x_start, max_step=step, walk=walk)
+        if initial_simplex is not None and algorithm == "nelder-mead":
+            algorithm_params["initial_simplex"] = initial_simplex
+        if state.noise:
+            evaluator.noise_floor = 0.5*state.noise
+        print("warm start from {} with step {:.1f}".format(state_file, step))
+
+    stopping = dict(max_iter=config["max_iter"], goal=-goal,
+                    goal_iterations=config["goal_iterations"])
+    if walk is None:
+        optimizer = make_optimizer(algorithm, x_start, step, **dict(stopping, **algorithm_params))
+    else:
+        optimizer = make_whitened_optimizer(walk, algorithm, x_start, step,
+                                            **dict(stopping, **algorithm_params))
+    result = minimize(optimizer, objective, telemetry=telemetry, scheduler=scheduler,
+                      clock=clock)
+    print(result)
+
+    mirrors.move_all(result.x, settle_time=settle_time, health=health)
+    efficiency = -objective(result.x) / peak_power
+    print("efficiency: initial {:.3f}, final {:.3f}".format(
+        -result.history[0].score / peak_power, efficiency))
+    print("photodiode samples per evaluation:", evaluator.mean_samples)
+    print("evaluation cache:", cache.status())
+
+    _set_home(controller, mirrors)
+    if state_file is not None:
+        state = AlignmentState.from_run(result, optimizer, evaluator)
+        state.best_pose = [0.]*len(x_start)
+        save_state(state_file, state)
+    return result, efficiency
+
+
+def _exit_code(config, result, efficiency):
+    if result is None:
+        return EXIT_NO_SIGNAL
+    return 0 if efficiency >= config["goal_fraction"] else EXIT_GOAL_MISSED
+
+
+def _plot_history(config, result):
+    import matplotlib.pyplot as plt
+
+    plt.plot(result.history.times(), -result.history.best_scores() / config["peak_power"],
+             "b.-")
+    plt.axhline(y=config["goal_fraction"], color="r", linestyle="-")
+    plt.ylabel("normalized coupling efficiency")
+    plt.xlabel("time/s")
+    plt.show()
+
+
+def command_align(config, args):
+    from health import ControllerHealthMonitor
+
+    controller, lj = open_devices(config)
+    telemetry = _open_telemetry(config)
+    health = ControllerHealthMonitor(controller)
+    health.start()
+    try:
+        result, efficiency = run_align(config, controller, lj, telemetry=telemetry,
+                                       health=health)
+    finally:
+        health.stop()
+        telemetry.close()
+        close_devices(controller, lj)
+    if args.plot and result is not None:
+        _plot_history(config, result)
+    return _exit_code(config, result, efficiency)
+
+
+def command_monitor(config, args):
+    from health import ControllerHealthMonitor
+    from monitor import CouplingMonitor
+
+    controller, lj = open_devices(config)
+    telemetry = _open_telemetry(config)
+    health = ControllerHealthMonitor(controller)
+    health.start()
+    try:
+        if args.align:
+            result, efficiency = run_align(config, controller, lj, telemetry=telemetry,
+                                           health=health)
+            if result is None:
+                return EXIT_NO_SIGNAL
+        mirrors = _mirrors(config, controller)
+        peak_power = config["peak_power"]
+        monitor = CouplingMonitor(
+            mirrors, lj, config["input_channel"],
+            threshold=config["threshold_fraction"]*peak_power,
+            goal=config["goal_fraction"]*peak_power,
+            evaluator=_evaluator(config, lj), settle_time=config["settle_time"],
+            state_path=config["state_file"], telemetry=telemetry,
+            # the health monitor's positions are raw step counters
+            health=health if mirrors is controller else None,
+            walk=_beam_walk(config))
+        # a service manager stops with SIGTERM, leave as on Ctrl-C
+        signal.signal(signal.SIGTERM, lambda signum, frame: monitor.stop())
+        try:
+            monitor.run()
+        except KeyboardInterrupt:
+            pass
+        print(monitor.status())
+    finally:
+        health.stop()
+        telemetry.close()
+        close_devices(controller, lj)
+    return 0
+
+
+def command_scan(config, args):
+    import numpy as np
+
+    from fly_scan import align_axis, find_peak, fly_scan
+
+    scan_config = config["scan"]
+    axis = scan_config["axis"]
+    span = scan_config["span"]
+    scan_kwargs = dict(velocity=scan_config["velocity"], scan_rate=scan_config["scan_rate"])
+    controller, lj = open_devices(config)
+    try:
+        if args.stay:
+            start = controller.get_position(axis)
+            controller.move_to(axis, start - span // 2)
+            scan = fly_scan(controller, lj, axis, span, config["input_channel"],
+                            **scan_kwargs)
+            peak = find_peak(scan)
+            controller.move_to(axis, start)
+        else:
+            peak, scan = align_axis(controller, lj, axis, span, config["input_channel"],
+                                    **scan_kwargs)
+    finally:
+        close_devices(controller, lj)
+
+    filename = os.path.join(config["output_folder"], "scan_axis{}.txt".format(axis))
+    np.savetxt(filename, np.column_stack(scan), header="time position power")
+    print("peak of axis {}: {}".format(axis, peak))
+    if args.plot:
+        import matplotlib.pyplot as plt
+
+        plt.plot(scan.position, scan.power, "b.")
+        plt.xlabel("axis {} position/steps".format(axis))
+        plt.ylabel("power")
+        plt.show()
+    return 0 if peak is not None else EXIT_GOAL_MISSED
+
+
+def command_calibrate(config, args):
+    """Measure the beam walk coordinates around the current pose, which
+    should be on the peak, e.g. right after align. With --axes, the
+    backlash and step sizes of every axis are measured first"""
+    from beam_walk import calibrate_beam_walk, save_beam_walk
+    from compensation import calibrate, save_calibration
+    from evaluation import HardwareObjective
+
+    if args.axes and config["calibration_file"] is None:
+        raise ValueError("calibrate --axes needs a calibration_file")
+    controller, lj = open_devices(config)
+    try:
+        if args.axes:
+            scan_config = config["scan"]
+            calibration = calibrate(controller, lj, config["input_channel"],
+                                    velocity=scan_config["velocity"],
+                                    scan_rate=scan_config["scan_rate"])
+            save_calibration(config["calibration_file"], calibration)
+            for axis, c in sorted(calibration.items()):
+                print("axis {}: {}".format(axis, c))
+        walk = None
+        if config["beam_walk_file"] is not None:
+            # read back, so the beam walk is measured in compensated positions
+            mirrors = _mirrors(config, controller)
+            objective = HardwareObjective(mirrors, _evaluator(config, lj),
+                                          settle_time=config["settle_time"])
+            walk = calibrate_beam_walk(objective, mirrors.get_positions(),
+                                       step=config["step"])
+    finally:
+        close_devices(controller, lj)
+    if walk is not None:
+        save_beam_walk(config["beam_walk_file"], walk)
+        print("curvature condition number {:.0f}, beam walk moves per unit:".format(
+            walk.condition()))
+        print(walk.basis)
+    return 0
+
+
+def command_simulate(config, args):
+    """run_align on a SimulatedBench, with the config's settings but no
+    state or calibration files"""
+    import numpy as np
+
+    from beam_walk import calibrate_beam_walk
+    from evaluation import HardwareObjective
+    from simulation import SimulatedBench
+
+    config = dict(config, state_file=None, calibration_file=None, beam_walk_file=None)
+
+    def make_bench(misalignment):
+        return SimulatedBench(misalignment=np.array(misalignment, dtype=float),
+                              input_channel=config["input_channel"], noise=args.noise,
+                              seed=args.seed, peak=config["peak_power"],
+                              reference_channel=config["reference_channel"],
+                              reference_level=config["reference_level"])
+
+    walk = None
+    if args.beam_walk:
+        # calibrated on the peak of an identical bench
+        aligned = make_bench([0., 0., 0., 0.])
+        objective = HardwareObjective(aligned.controller, _evaluator(config, aligned.lj),
+                                      settle_time=config["settle_time"])
+        walk = calibrate_beam_walk(objective, np.zeros(4), step=config["step"])
+    bench = make_bench(args.misalignment)
+    result, efficiency = run_align(config, bench.controller, bench.lj, clock=bench.clock,
+                                   walk=walk)
+    print("simulated time {:.1f} s, coupling efficiency {:.3f}".format(
+        bench.clock.time(), bench.efficiency()))
+    return _exit_code(config, result, efficiency)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("--config", default=None, help="JSON file, see DEFAULT_CONFIG")
+    common.add_argument("--set", action="append", default=[], metavar="KEY=VALUE",
+                        help="override a config setting, may be repeated")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    subparsers.add_parser("defaults", help="print the default config")
+    align = subparsers.add_parser("align", parents=[common],
+                                  help="optimize the coupling once")
+    align.add_argument("--plot", action="store_true")
+    monitor = subparsers.add_parser("monitor", parents=[common],
+                                    help="re-couple whenever the power drops")
+    monitor.add_argument("--align", action="store_true", help="optimize first")
+    scan = subparsers.add_parser("scan", parents=[common],
+                                 help="fly scan one axis and move to the peak")
+    scan.add_argument("--axis", type=int, default=None)
+    scan.add_argument("--span", type=int, default=None)
+    scan.add_argument("--stay", action="store_true",
+                      help="return to the starting position instead")
+    scan.add_argument("--plot", action="store_true")
+    calibrate = subparsers.add_parser("calibrate", parents=[common],
+                                      help="measure the beam walk coordinates on the peak")
+    calibrate.add_argument("--axes", action="store_true",
+                           help="measure backlash and step sizes first")
+    simulate = subparsers.add_parser("simulate", parents=[common],
+                                     help="align once on the simulated bench")
+    simulate.add_argument("--misalignment", type=float, nargs=4,
+                          default=[300., -200., 0., 0.])
+    simulate.add_argument("--noise", type=float, default=0.005)
+    simulate.add_argument("--seed", type=int, default=None)
+    simulate.add_argument("--beam-walk", action="store_true",
+                          help="search in beam walk coordinates")
+    args = parser.parse_args(argv)
+
+    if args.command == "defaults":
+        json.dump(DEFAULT_CONFIG, sys.stdout, indent=2)
+        print()
+        return 0
+    try:
+        overrides = list(args.set)
+        if args.command == "scan":
+            overrides += ["scan.{}={}".format(key, value)
+                          for key, value in (("axis", args.axis), ("span", args.span))
+                          if value is not None]
+        config = load_config(args.config, overrides)
+    except (IOError, OSError, ValueError) as e:
+        parser.error(str(e))
+
+    commands = {
+        "align": command_align,
+        "monitor": command_monitor,
+        "scan": command_scan,
+        "calibrate": command_calibrate,
+        "simulate": command_simulate,
+    }
+    return commands[args.command](config, args)
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,346 @@
+"""
+Mirror pair calibration and whitened beam walk coordinates
+
+The four axes aren't independent directions of equal weight. Axes 1 and 3
+tilt the far and the near mirror in x, 2 and 4 in y, and the coupled power
+depends on the beam angle and offset at the fiber, which are different
+mixtures of both mirrors of a pair. Tilting both the same way changes the
+angle, a stiff direction. Tilting them against each other walks the beam
+across the fiber at almost constant angle, a soft one. The power falls
+hundreds of times faster along the first. Tiny and Standard picomotors
+differ in step size on top of that. A simplex with one isotropic step
+spends most of its evaluations finding that valley.
+
+calibrate_beam_walk measures the curvature of log(power) around a pose
+(Gaussian peak: log(power) is quadratic) in the plane of each mirror pair,
+by a least squares fit to a few probes, and refines it by probing again
+along the directions found. BeamWalk turns the curvature into whitened
+coordinates: the basis moves are the eigenvectors of each pair, combined
+moves of both mirrors, scaled so every one costs the same power.
+WhitenedOptimizer runs any optimizer of optimizers.OPTIMIZERS in those
+coordinates while the objective, the scheduler, the cache and the history
+keep seeing motor steps. The basis has unit determinant, so whitened units
+are motor steps on geometric average, but a step costs the same power in
+every direction. step_for_loss sizes it by that power, about 0.2 for an
+initial simplex, where an isotropic step of 50 would be far too small
+along the beam walk directions.
+
+Example:
+
+    >>> objective = HardwareObjective(mirrors, evaluator)
+    >>> walk = calibrate_beam_walk(objective, mirrors.get_positions())
+    >>> save_beam_walk("beam_walk.json", walk)
+    >>> optimizer = make_whitened_optimizer(walk, "nelder-mead", x0,
+    ...                                     walk.step_for_loss(0.2))
+"""
+
+import json
+import math
+
+import numpy as np
+
+from alignment_state import write_json_atomic
+from optimizers import make_optimizer
+from surrogate import fit_quadratic
+
+BEAM_WALK_VERSION = 1
+# motor numbers of the far and the near mirror's x axes, and of their y axes
+MIRROR_PAIRS = ((1, 3), (2, 4))
+
+
+def whitening(hessian, max_condition=1e4):
+    """Basis in which a curvature becomes the identity
+
+    Args:
+        hessian (array): (k, k) second derivatives of -log(power), in
+            1/steps**2
+        max_condition (float): Largest ratio of eigenvalues kept. Smaller
+            ones, and negative ones from a noisy fit, are raised to
+            largest/max_condition
+
+    Returns:
+        basis (array): (k, k), columns are the moves in steps along which
+            -log(power) grows by u**2/2, stiffest first
+    """
+    curvature, vectors = np.linalg.eigh(np.asarray(hessian, dtype=float))
+    curvature, vectors = curvature[::-1], vectors[:, ::-1]
+    if curvature[0] <= 0:
+        raise ValueError("Curvature without a peak, eigenvalues {}".format(curvature))
+    curvature = np.maximum(curvature, curvature[0] / max_condition)
+    # fix the sign of each move so the far mirror moves forward
+    vectors = vectors * np.where(vectors[0] < 0, -1., 1.)
+    return vectors / np.sqrt(curvature)
+
+
+class BeamWalk(object):
+    """Linear map between whitened coordinates and motor steps
+
+    pose = basis @ u. The map has no offset, so it stays valid when the
+    step counters are set to home (DH).
+    """
+
+    def __init__(self, hessian, groups=MIRROR_PAIRS, max_condition=1e4):
+        """
+        Args:
+            hessian (array): (dim, dim) curvature of -log(power) in
+                1/steps**2, only the blocks of groups are used
+            groups (tuple): Motor numbers (pose coordinate + 1) whitened
+                together, e.g. MIRROR_PAIRS. Other axes keep their direction
+            max_condition (float): See whitening
+        """
+        self.hessian = np.array(hessian, dtype=float)
+        self.groups = tuple(tuple(group) for group in groups)
+        self.max_condition = max_condition
+        dim = len(self.hessian)
+
+        basis = np.zeros((dim, dim))
+        scales = []
+        grouped = set()
+        for group in self.groups:
+            index = [axis - 1 for axis in group]
+            block = whitening(self.hessian[np.ix_(index, index)], max_condition)
+            basis[np.ix_(index, index)] = block
+            scales.extend(np.linalg.norm(block, axis=0))
+            grouped.update(index)
+        # ungrouped axes move by the typical whitened step length
+        typical = float(np.exp(np.mean(np.log(scales)))) if scales else 1.
+        for i in range(dim):
+            if i not in grouped:
+                basis[i, i] = typical
+        # unit determinant keeps the step sizes of the optimizers meaningful
+        self.unit = abs(np.linalg.det(basis))**(1. / dim)
+        self.basis = basis / self.unit
+        self._inverse = np.linalg.inv(self.basis)
+
+    def to_pose(self, u):
+        """Motor positions of whitened coordinates"""
+        return self.basis @ np.asarray(u, dtype=float)
+
+    def from_pose(self, x):
+        """Whitened coordinates of motor positions (..., dim)"""
+        return np.asarray(x, dtype=float) @ self._inverse.T
+
+    def step_for_loss(self, loss):
+        """Whitened step that loses the fraction loss of the peak power"""
+        return self.unit*math.sqrt(-2*math.log(1. - loss))
+
+    def loss(self, dx):
+        """Relative power loss predicted for a move of dx steps from the
+        peak"""
+        dx = np.asarray(dx, dtype=float)
+        return 1. - math.exp(-0.5*float(dx @ self.hessian @ dx))
+
+    def condition(self):
+        """Condition number of the curvature in steps, how much harder the
+        unwhitened search is"""
+        curvature = np.linalg.eigvalsh(self.hessian)
+        if curvature[0] <= 0:
+            return np.inf
+        return float(curvature[-1] / curvature[0])
+
+
+def _probe_offsets(k, radius):
+    """Centre, +-radius along each axis and along each diagonal pair, enough
+    to fit a full quadratic in k dimensions"""
+    offsets = [np.zeros(k)]
+    eye = np.eye(k)
+    for i in range(k):
+        offsets += [radius*eye[i], -radius*eye[i]]
+    diagonal = radius / math.sqrt(2.)
+    for i in range(k):
+        for j in range(i + 1, k):
+            for si, sj in ((1, 1), (-1, -1), (1, -1), (-1, 1)):
+                offsets.append(diagonal*(si*eye[i] + sj*eye[j]))
+    return offsets
+
+
+def measure_curvature(objective, x0, group, block, target_loss=0.2, max_probe=None):
+    """Curvature of -log(power) in the plane of one group of axes
+
+    Args:
+        objective (callable): objective(x) -> score, the negative power
+        x0 (array): Pose to probe around, in steps
+        group (tuple): Motor numbers (pose coordinate + 1) probed together
+        block (array): Current estimate of the group's curvature, the probes
+            are placed along its eigenvectors so each loses about
+            target_loss of the power
+        target_loss (float): Relative power loss aimed for at each probe
+        max_probe (float): Longest probe move per axis in steps, unlimited
+            if None
+
+    Returns:
+        block (array): (k, k) new estimate, in 1/steps**2
+
+    Raises:
+        RuntimeError: if the probes don't determine the curvature
+    """
+    x0 = np.asarray(x0, dtype=float)
+    index = [axis - 1 for axis in group]
+    local = whitening(block)
+    radius = math.sqrt(-2*math.log(1. - target_loss))
+    offsets = np.array([local @ u for u in _probe_offsets(len(index), radius)])
+    if max_probe is not None:
+        longest = np.max(np.abs(offsets))
+        if longest > max_probe:
+            offsets *= max_probe / longest
+
+    power = []
+    for offset in offsets:
+        x = x0.copy()
+        x[index] += offset
+        power.append(-objective(x))
+    power = np.array(power)
+
+    keep = power > 0
+    fit = None
+    if np.any(keep):
+        fit = fit_quadratic(offsets[keep], np.log(power[keep]), np.zeros(len(index)),
+                            weights=power[keep]**2)
+    if fit is None:
+        raise RuntimeError("Probes of axes {} don't determine the curvature".format(group))
+    return -fit.hessian
+
+
+def calibrate_beam_walk(objective, x0, groups=MIRROR_PAIRS, step=50., rounds=2,
+                        target_loss=0.2, max_probe=None, max_condition=1e4):
+    """Measure the curvature of the coupling peak around a pose
+
+    The first round probes step away along each axis and the diagonals of
+    every group. The later rounds probe along the eigenvectors of the last
+    estimate, far enough to lose about target_loss of the power, which
+    resolves the soft beam walk directions that the first round barely
+    sees. Calibrate near the peak, after aligning: each group takes
+    1 + 2k + 2k(k - 1) evaluations per round, 9 for a mirror pair. The
+    mirrors are left at x0.
+
+    Args:
+        objective (callable): objective(x) -> score, e.g. HardwareObjective
+            without a cache
+        x0 (array): Pose to calibrate around, in steps
+        groups (tuple): Motor numbers (pose coordinate + 1) whose
+            cross-coupling is measured, MIRROR_PAIRS or ((1, 2, 3, 4),) for
+            the full curvature from 33 evaluations per round
+        step (float or array): Probe distance of the first round, in steps,
+            per axis if an array
+        rounds (int): Probe rounds, at least 1
+        target_loss (float): Relative power loss aimed for at each probe
+            after the first round
+        max_probe (float): Longest probe move per axis in steps, 20*step if
+            None
+        max_condition (float): See whitening
+
+    Returns:
+        walk (BeamWalk)
+    """
+    x0 = np.asarray(x0, dtype=float)
+    steps = np.broadcast_to(np.asarray(step, dtype=float), x0.shape)
+    if max_probe is None:
+        max_probe = 20*float(np.max(steps))
+    radius = math.sqrt(-2*math.log(1. - target_loss))
+
+    hessian = np.zeros((len(x0), len(x0)))
+    for group in groups:
+        index = [axis - 1 for axis in group]
+        # a first guess that puts the probes step away
+        block = np.diag((radius / steps[index])**2)
+        for _ in range(rounds):
+            block = measure_curvature(objective, x0, group, block, target_loss,
+                                      max_probe)
+            # keep the next probes finite if the fit came out flat
+            curvature, vectors = np.linalg.eigh(block)
+            curvature = np.maximum(curvature, np.max(curvature) / max_condition)
+            block = (vectors * curvature) @ vectors.T
+        hessian[np.ix_(index, index)] = block
+    objective(x0)
+    return BeamWalk(hessian, groups, max_condition)
+
+
+def save_beam_walk(path, walk):
+    """Write a BeamWalk atomically as JSON"""
+    write_json_atomic(path, {
+        "version": BEAM_WALK_VERSION,
+        "hessian": walk.hessian.tolist(),
+        "groups": [list(group) for group in walk.groups],
+        "max_condition": walk.max_condition,
+    })
+
+
+def load_beam_walk(path):
+    """Read a saved BeamWalk
+
+    Returns:
+        walk (BeamWalk): None if there is no file at path
+
+    Raises:
+        ValueError: if the file has an unsupported version
+    """
+    try:
+        with open(path) as f:
+            data = json.load(f)
+    except (IOError, OSError):
+        return None
+    if data.get("version") != BEAM_WALK_VERSION:
+        raise ValueError("Unsupported beam walk version {}, expected {}".format(
+            data.get("version"), BEAM_WALK_VERSION))
+    return BeamWalk(data["hessian"], data["groups"], data["max_condition"])
+
+
+class WhitenedOptimizer(object):
+    """Optimizer front end that searches in whitened coordinates
+
+    ask() returns and best_x is in motor steps, the wrapped optimizer works
+    on whitened coordinates. simplex is converted too, so
+    AlignmentState.from_run saves it in steps. Every other attribute is
+    passed through to the wrapped optimizer.
+    """
+
+    def __init__(self, optimizer, walk):
+        """
+        Args:
+            optimizer (Optimizer): Fresh optimizer started from whitened
+                coordinates, see make_whitened_optimizer
+            walk (BeamWalk): The coordinate map
+        """
+        self.optimizer = optimizer
+        self.walk = walk
+
+    def __getattr__(self, name):
+        return getattr(self.optimizer, name)
+
+    def ask(self):
+        """Poses to evaluate next, in motor steps"""
+        return [self.walk.to_pose(u) for u in self.optimizer.ask()]
+
+    @property
+    def best_x(self):
+        u = self.optimizer.best_x
+        return None if u is None else self.walk.to_pose(u)
+
+    @property
+    def simplex(self):
+        simplex = getattr(self.optimizer, "simplex", None)
+        if not simplex:
+            return simplex
+        return [[self.walk.to_pose(u), score] for u, score in simplex]
+
+
+def make_whitened_optimizer(walk, algorithm, x0, step, initial_simplex=None, **kwargs):
+    """make_optimizer searching the whitened coordinates of walk
+
+    Args:
+        walk (BeamWalk): From calibrate_beam_walk or load_beam_walk
+        algorithm (str): One of optimizers.OPTIMIZERS
+        x0 (array): Starting pose in motor steps
+        step (float): Initial step in whitened units, see
+            BeamWalk.step_for_loss
+        initial_simplex (array): Vertices in motor steps, e.g. from
+            alignment_state.warm_start
+        **kwargs: Passed on to make_optimizer
+
+    Returns:
+        optimizer (WhitenedOptimizer)
+    """
+    if initial_simplex is not None:
+        kwargs["initial_simplex"] = walk.from_pose(initial_simplex)
+    return WhitenedOptimizer(
+        make_optimizer(algorithm, walk.from_pose(x0), step, **kwargs), walk)
@@ -0,0 +1,338 @@
+"""
+Alignment benchmark on the simulated bench
+
+Runs the optimizers over a matrix of scenarios (starting misalignment,
+photodiode noise, drift rate, initial step and algorithm parameters) in a
+process pool and reports, per scenario, the distribution of evaluations,
+motor travel and simulated time needed to reach the coupling goal, and the
+final coupling efficiency. Results are saved as JSON so a later run can be
+compared against them to catch regressions when tuning step, alpha, gamma,
+rho and sigma.
+
+Usage:
+
+    $ python benchmark.py --repeats 20 --output bench.json
+    $ python benchmark.py --baseline bench.json
+    $ python benchmark.py --algorithms nelder-mead --alpha 1 1.5 --rho 0.5 0.7
+    $ python benchmark.py --surrogate quadratic --scheduler --cache-max-age 60
+"""
+
+import argparse
+import itertools
+import json
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from evaluation import AdaptiveEvaluator, EvaluationCache, HardwareObjective
+from optimizers import make_optimizer, minimize
+from scheduling import MotionScheduler
+from simulation import SimulatedBench
+from surrogate import SURROGATE_MODELS
+
+DEFAULT_ALGORITHMS = [
+    ("nelder-mead", {}),
+    ("pattern", {}),
+    ("spsa", {}),
+]
+METRICS = ["evaluations", "evaluations_to_goal", "time_to_goal", "travel",
+           "reversals", "final_efficiency"]
+NELDER_MEAD_PARAMETERS = ["alpha", "gamma", "rho", "sigma"]
+
+
+def parameter_sweep(algorithms, **values):
+    """Expand Nelder-Mead parameter values into (name, params) pairs
+
+    Args:
+        algorithms (iterable): (name, params) pairs
+        **values: Parameter -> values to try, e.g. alpha=[1., 1.5]. None
+            leaves the parameter at its default
+
+    Returns:
+        algorithms (list): Every nelder-mead pair once per combination of
+            the values, added to its params. Other algorithms unchanged
+    """
+    names = sorted(name for name, v in values.items() if v)
+    combinations = list(itertools.product(*[values[name] for name in names]))
+    swept = []
+    for algorithm, params in algorithms:
+        if algorithm != "nelder-mead" or not names:
+            swept.append((algorithm, params))
+            continue
+        for combination in combinations:
+            swept.append((algorithm, dict(params, **dict(zip(names, combination)))))
+    return swept
+
+
+def scenario_matrix(misalignments=(300., 1000.), noises=(0.005, 0.02),
+                    drift_rates=(0.,), steps=(50.,), algorithms=DEFAULT_ALGORITHMS,
+                    repeats=10, goal=0.9, seed=0, **settings):
+    """Every combination of the given conditions, repeated
+
+    Args:
+        misalignments (iterable): Distance in steps of the optimum from the
+            starting pose, in a random direction per repeat
+        noises (iterable): Photodiode noise in volts
+        drift_rates (iterable): Drift of the optimum in steps per second, in
+            a random direction per repeat
+        steps (iterable): Initial optimizer step
+        algorithms (iterable): (name, params) pairs, see optimizers.OPTIMIZERS
+        repeats (int): Runs per combination
+        goal (float): Coupling efficiency counted as coupled
+        seed (int): Base seed, every run gets its own
+        **settings: Stored in every scenario and passed on to run_scenario,
+            e.g. max_iter, settle_time, surrogate, scheduler or
+            cache_max_age
+
+    Returns:
+        scenarios (list): Dictionaries accepted by run_scenario
+    """
+    scenarios = []
+    combinations = itertools.product(misalignments, noises, drift_rates, steps,
+                                     algorithms)
+    for index, (misalignment, noise, drift_rate, step, (algorithm, params)) \
+            in enumerate(combinations):
+        name = "{}{} mis={} noise={} drift={} step={}".format(
+            algorithm, json.dumps(params, sort_keys=True) if params else "",
+            misalignment, noise, drift_rate, step)
+        for repeat in range(repeats):
+            scenario = dict(settings)
+            scenario.update(
+                name=name,
+                algorithm=algorithm,
+                params=dict(params),
+                misalignment=misalignment,
+                noise=noise,
+                drift_rate=drift_rate,
+                step=step,
+                goal=goal,
+                seed=seed + 1000*index + repeat,
+            )
+            scenarios.append(scenario)
+    return scenarios
+
+
+def _random_direction(rng, dim=4):
+    v = rng.normal(size=dim)
+    return v / np.linalg.norm(v)
+
+
+def run_scenario(scenario):
+    """Run one alignment on a fresh simulated bench
+
+    The optional keys surrogate (model name for Nelder-Mead), scheduler
+    (True to order batches with a MotionScheduler) and cache_max_age
+    (seconds, to score revisited poses from an EvaluationCache) turn on
+    the features with_control.py and autocoupling.py run with.
+
+    Args:
+        scenario (dict): One entry of scenario_matrix
+
+    Returns:
+        record (dict): The scenario plus its metrics
+    """
+    rng = np.random.default_rng(scenario["seed"])
+    bench = SimulatedBench(
+        misalignment=scenario["misalignment"] * _random_direction(rng),
+        noise=scenario["noise"],
+        drift_rate=scenario["drift_rate"] * _random_direction(rng),
+        seed=scenario["seed"],
+    )
+    peak = bench.model.peak
+    evaluator = AdaptiveEvaluator(bench.lj, bench.input_channel,
+                                  **scenario.get("evaluator", {}))
+    cache = None
+    if scenario.get("cache_max_age") is not None:
+        cache = EvaluationCache(max_age=scenario["cache_max_age"], clock=bench.clock)
+    settle_time = scenario.get("settle_time", 0.05)
+    objective = HardwareObjective(bench.controller, evaluator, cache=cache,
+                                  settle_time=settle_time)
+    scheduler = None
+    if scenario.get("scheduler"):
+        scheduler = MotionScheduler(bench.controller, cache=cache)
+    params = dict(scenario["params"])
+    if scenario.get("surrogate") and scenario["algorithm"] == "nelder-mead":
+        params["surrogate"] = scenario["surrogate"]
+    optimizer = make_optimizer(
+        scenario["algorithm"], np.zeros(4), scenario["step"],
+        max_iter=scenario.get("max_iter", 100),
+        goal=-scenario["goal"]*peak,
+        **params
+    )
+
+    start = time.time()
+    result = minimize(optimizer, objective, clock=bench.clock, scheduler=scheduler)
+    wall_time = time.time() - start
+    # the cache would score result.x without moving there
+    bench.controller.move_all(result.x, settle_time=settle_time)
+
+    goal_score = -scenario["goal"]*peak
+    motors = bench.device.motors.values()
+    record = dict(scenario)
+    record.update(
+        evaluations=result.evaluations,
+        iterations=result.iterations,
+        stop_reason=result.stop_reason,
+        evaluations_to_goal=result.history.evaluations_to_reach(goal_score),
+        time_to_goal=result.history.time_to_reach(goal_score),
+        virtual_time=result.elapsed,
+        wall_time=wall_time,
+        travel=sum(m.travel for m in motors),
+        reversals=sum(m.reversals for m in motors),
+        samples=evaluator.samples_taken,
+        cache_hits=0 if cache is None else cache.hits,
+        final_efficiency=bench.efficiency(),
+    )
+    return record
+
+
+def run_benchmark(scenarios, workers=None):
+    """Run scenarios in a process pool
+
+    Args:
+        scenarios (list): From scenario_matrix
+        workers (int): Processes, one per CPU if None. 1 runs in this process
+
+    Returns:
+        records (list): One per scenario, in order
+    """
+    if workers == 1:
+        return [run_scenario(s) for s in scenarios]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(run_scenario, scenarios, chunksize=4))
+
+
+def summarize(records):
+    """Distribution of each metric per scenario name
+
+    Runs that never reached the goal count in success_rate and are left out
+    of the *_to_goal statistics.
+
+    Returns:
+        summary (dict): name -> {"runs", "success_rate", metric -> stats}
+    """
+    groups = {}
+    for record in records:
+        groups.setdefault(record["name"], []).append(record)
+
+    summary = {}
+    for name, group in groups.items():
+        entry = {
+            "runs": len(group),
+            "success_rate": np.mean([r["evaluations_to_goal"] is not None
+                                     for r in group]),
+        }
+        for metric in METRICS:
+            values = np.array([r[metric] for r in group if r[metric] is not None],
+                              dtype=float)
+            if not len(values):
+                entry[metric] = None
+                continue
+            entry[metric] = {
+                "mean": float(values.mean()),
+                "median": float(np.median(values)),
+                "p10": float(np.percentile(values, 10)),
+                "p90": float(np.percentile(values, 90)),
+            }
+        summary[name] = entry
+    return summary
+
+
+def compare(baseline, summary, tolerance=0.1):
+    """Scenarios that got worse than the baseline summary
+
+    A scenario regresses if its success rate dropped, or the median
+    evaluations or simulated time to the goal grew by more than tolerance.
+
+    Returns:
+        regressions (list): (name, metric, baseline value, new value)
+    """
+    regressions = []
+    for name, entry in summary.items():
+        old = baseline.get(name)
+        if old is None:
+            continue
+        if entry["success_rate"] < old["success_rate"]:
+            regressions.append((name, "success_rate", old["success_rate"],
+                                entry["success_rate"]))
+        for metric in ("evaluations_to_goal", "time_to_goal"):
+            if not old.get(metric) or not entry.get(metric):
+                continue
+            before, after = old[metric]["median"], entry[metric]["median"]
+            if after > before*(1 + tolerance):
+                regressions.append((name, metric, before, after))
+    return regressions
+
+
+def save_results(path, records, summary):
+    with open(path, 'w') as f:
+        json.dump({"records": records, "summary": summary}, f, indent=1,
+                  default=float)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument("--repeats", type=int, default=10)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--algorithms", nargs="+", default=None,
+                        help="names from optimizers.OPTIMIZERS")
+    parser.add_argument("--misalignments", type=float, nargs="+", default=[300., 1000.])
+    parser.add_argument("--noises", type=float, nargs="+", default=[0.005, 0.02])
+    parser.add_argument("--drift-rates", type=float, nargs="+", default=[0.])
+    parser.add_argument("--steps", type=float, nargs="+", default=[50.])
+    for name in NELDER_MEAD_PARAMETERS:
+        parser.add_argument("--" + name, type=float, nargs="+", default=None,
+                            help="Nelder-Mead {} values to sweep".format(name))
+    parser.add_argument("--surrogate", choices=sorted(SURROGATE_MODELS), default=None,
+                        help="surrogate model of Nelder-Mead")
+    parser.add_argument("--scheduler", action="store_true",
+                        help="order each batch of poses with a MotionScheduler")
+    parser.add_argument("--cache-max-age", type=float, default=None,
+                        help="score poses seen within this many seconds from a cache")
+    parser.add_argument("--output", default="bench_output.json")
+    parser.add_argument("--baseline", default=None,
+                        help="earlier output to check for regressions")
+    args = parser.parse_args(argv)
+
+    # read before the run, --output may overwrite the same file
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["summary"]
+
+    algorithms = DEFAULT_ALGORITHMS
+    if args.algorithms:
+        algorithms = [(name, {}) for name in args.algorithms]
+    algorithms = parameter_sweep(algorithms, **dict(
+        (name, getattr(args, name)) for name in NELDER_MEAD_PARAMETERS))
+    scenarios = scenario_matrix(
+        misalignments=args.misalignments, noises=args.noises,
+        drift_rates=args.drift_rates, steps=args.steps,
+        algorithms=algorithms, repeats=args.repeats,
+        surrogate=args.surrogate, scheduler=args.scheduler,
+        cache_max_age=args.cache_max_age,
+    )
+
+    start = time.time()
+    records = run_benchmark(scenarios, workers=args.workers)
+    summary = summarize(records)
+    print("{} runs in {:.1f} s".format(len(records), time.time() - start))
+    for name, entry in sorted(summary.items()):
+        evals = entry["evaluations_to_goal"]
+        print("{:60s} success {:4.0%}  evaluations to goal {}  final {:.3f}".format(
+            name, entry["success_rate"],
+            "{:.0f}".format(evals["median"]) if evals else "-",
+            entry["final_efficiency"]["median"]))
+    save_results(args.output, records, summary)
+
+    if baseline is not None:
+        regressions = compare(baseline, summary)
+        for name, metric, before, after in regressions:
+            print("REGRESSION {}: {} {} -> {}".format(name, metric, before, after))
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,332 @@
+"""
+Backlash and step size compensation for the open-loop picomotors
+
+The 8742 counts steps, not distance: a reverse step moves the mirror by a
+different amount than a forward step, and after every change of direction
+the first steps only take up mechanical play. An optimizer that takes the
+step counter for the mirror position then revisits poses that aren't where
+it thinks they are.
+
+calibrate_axis measures both effects with the coupling peak as a physical
+marker. It fly scans an axis back and forth across the peak and fits the
+reverse/forward step size ratio and the backlash that make the peak appear
+at the same physical position in every scan. CompensatedController then
+sits in front of Controller: it takes positions in forward steps from a
+reference point, tracks where each mirror physically is, and converts every
+move to the step counts that get it there, adding the backlash after a
+reversal. Optionally every target is approached from the same direction,
+which makes the final position independent of the backlash estimate.
+
+Example:
+
+    >>> calibration = calibrate(controller, lj, input_channel=2)
+    >>> save_calibration("axis_calibration.json", calibration)
+    >>> mirrors = CompensatedController(controller, calibration, approach=1)
+    >>> objective = HardwareObjective(mirrors, evaluator)
+"""
+
+import json
+from collections import namedtuple
+
+import numpy as np
+
+from alignment_state import write_json_atomic
+from fly_scan import find_peak, fly_scan
+
+CALIBRATION_VERSION = 1
+
+# reverse_scale: mirror travel of a reverse step relative to a forward step.
+# backlash: steps lost after a change of direction. residual: rms misfit of
+# the peak positions in steps, a measure of the calibration's quality
+AxisCalibration = namedtuple("AxisCalibration", ["reverse_scale", "backlash", "residual"])
+
+
+def _travel(moves, backlash):
+    """Forward and reverse travel in effective steps from the start of the
+    first move to the peak of every scan, and to the end of the last move
+
+    Args:
+        moves (list): (start counter, end counter, peak counter or None)
+            per move, each starting where the previous one ended, the first
+            preceded by a move in its direction
+        backlash (int): Steps lost after a change of direction
+
+    Returns:
+        (forward, reverse, total): Arrays with one entry per scan with a
+            peak, and a dict of the direction (1 or -1) -> travel at the end
+    """
+    forward, reverse = [], []
+    total = {1: 0., -1: 0.}
+    last = None
+    for start, end, peak in moves:
+        if end == start:
+            continue
+        direction = 1 if end > start else -1
+        lost = backlash if last is not None and direction != last else 0
+        if peak is not None:
+            travel = dict(total)
+            travel[direction] += max(0., abs(peak - start) - lost)
+            forward.append(travel[1])
+            reverse.append(travel[-1])
+        total[direction] += max(0., abs(end - start) - lost)
+        last = direction
+    return np.array(forward), np.array(reverse), total
+
+
+def fit_calibration(moves, max_backlash=200):
+    """Reverse step scale and backlash from the peak positions of scans
+
+    With the forward step as unit, the physical position of the peak is
+    forward - reverse_scale*reverse travel for every scan, linear in the
+    peak position and reverse_scale for a given backlash. The backlash is
+    found by a search over whole steps.
+
+    Args:
+        moves (list): (start counter, end counter, peak counter or None)
+            per move in the order they were made, see calibrate_axis. At
+            least two scans in each direction
+        max_backlash (int): Largest backlash tried
+
+    Returns:
+        calibration (AxisCalibration)
+    """
+    best = None
+    for backlash in range(max_backlash + 1):
+        forward, reverse, _ = _travel(moves, backlash)
+        design = np.column_stack([np.ones(len(forward)), reverse])
+        (peak, reverse_scale), _, rank, _ = np.linalg.lstsq(design, forward, rcond=None)
+        if rank < 2:
+            continue
+        residual = float(np.sqrt(np.mean((design @ (peak, reverse_scale) - forward)**2)))
+        if best is None or residual < best.residual:
+            best = AxisCalibration(float(reverse_scale), backlash, residual)
+    return best
+
+
+def calibrate_axis(controller, lj, axis, input_channel, span=800, round_trips=2,
+                   max_backlash=200, **scan_kwargs):
+    """Measure the reverse step scale and backlash of one axis
+
+    Scans alternate between the two directions, each centred on the peak of
+    the previous one, and every move is recorded for fit_calibration. The
+    coupling peak has to be within span/2 steps of the current position
+    along the axis, so calibrate after aligning. The axis is left on the
+    peak, approached in the forward direction.
+
+    Args:
+        controller (Controller): Controller driving the axis
+        lj (LabJackAnalog): LabJack reading the photodiode
+        axis (int): Motor number (1-4)
+        input_channel (int or str): Photodiode analog input
+        span (int): Length of every scan in steps, at least a few times the
+            backlash
+        round_trips (int): Forward and reverse scan pairs, at least 2
+        max_backlash (int): Largest backlash considered
+        **scan_kwargs: Passed on to fly_scan, e.g. velocity
+
+    Returns:
+        calibration (AxisCalibration)
+
+    Raises:
+        RuntimeError: if a scan doesn't show the peak, or the scans don't
+            determine the calibration
+    """
+    position = controller.get_position(axis) - span // 2
+    # take up the play in the forward direction, so the first scan starts
+    # without slack
+    controller.move_to(axis, position - max_backlash - span // 4)
+    controller.move_to(axis, position)
+
+    moves = []
+    for i in range(2*round_trips):
+        direction = 1 if i % 2 == 0 else -1
+        if moves:
+            # centre the scan on the last peak, as far as the counter tells
+            start = int(round(moves[-1][2])) - direction*(span // 2)
+            controller.move_to(axis, start)
+            moves.append((position, start, None))
+            position = start
+        scan = fly_scan(controller, lj, axis, direction*span, input_channel,
+                        **scan_kwargs)
+        peak = find_peak(scan)
+        if peak is None:
+            raise RuntimeError("No peak in calibration scan {} of axis {}".format(i, axis))
+        moves.append((position, position + direction*span, peak))
+        position += direction*span
+
+    calibration = fit_calibration(moves, max_backlash)
+    if calibration is None:
+        raise RuntimeError("Calibration scans of axis {} don't determine the reverse step "
+                           "scale, the peak was at the same counter in every scan".format(axis))
+    forward, reverse, total = _travel(moves, calibration.backlash)
+    scale = calibration.reverse_scale
+    mirrors = CompensatedController(controller, {axis: calibration}, approach=1)
+    mirrors.reset([axis], [total[1] - scale*total[-1]], [-1])
+    mirrors.move_to(axis, float(np.mean(forward - scale*reverse)))
+    return calibration
+
+
+def calibrate(controller, lj, input_channel, axes=(1, 2, 3, 4), **kwargs):
+    """calibrate_axis for several axes
+
+    Returns:
+        calibration (dict): Axis -> AxisCalibration
+    """
+    return dict((axis, calibrate_axis(controller, lj, axis, input_channel, **kwargs))
+                for axis in axes)
+
+
+def save_calibration(path, calibration):
+    """Write a calibration from calibrate atomically as JSON"""
+    write_json_atomic(path, {
+        "version": CALIBRATION_VERSION,
+        "axes": dict((str(axis), c._asdict()) for axis, c in calibration.items()),
+    })
+
+
+def load_calibration(path):
+    """Read a saved calibration
+
+    Returns:
+        calibration (dict): Axis -> AxisCalibration, None if there is no
+            file at path
+
+    Raises:
+        ValueError: if the file has an unsupported version
+    """
+    try:
+        with open(path) as f:
+            data = json.load(f)
+    except (IOError, OSError):
+        return None
+    if data.get("version") != CALIBRATION_VERSION:
+        raise ValueError("Unsupported calibration version {}, expected {}".format(
+            data.get("version"), CALIBRATION_VERSION))
+    return dict((int(axis), AxisCalibration(**c)) for axis, c in data["axes"].items())
+
+
+class CompensatedController(object):
+    """Controller front end that moves in compensated physical units
+
+    Positions are in forward steps from where the axis was at the last
+    reset(). Every other attribute is passed through to the controller, so
+    this can stand in for it, e.g. in HardwareObjective or CouplingMonitor.
+    """
+
+    def __init__(self, controller, calibration, approach=None, approach_distance=None):
+        """
+        Args:
+            controller (Controller): Controller driving the mirrors
+            calibration (dict): Axis -> AxisCalibration, axes missing from it
+                are moved uncompensated
+            approach (int): 1 or -1 to end every move in that direction, by
+                overshooting first if needed. None moves straight
+            approach_distance (int): Overshoot in steps, twice the largest
+                backlash plus 10 if None
+        """
+        self.controller = controller
+        self.calibration = calibration
+        self.approach = approach
+        if approach_distance is None:
+            approach_distance = 2*max([c.backlash for c in calibration.values()] or [0]) + 10
+        self.approach_distance = approach_distance
+        self._counter = {}
+        self._physical = {}
+        self._direction = {}
+        self.reset()
+
+    def __getattr__(self, name):
+        return getattr(self.controller, name)
+
+    def reset(self, axes=(1, 2, 3, 4), positions=None, directions=None):
+        """Set the physical positions of axes, e.g. after DH
+
+        Args:
+            axes (iterable): Motor numbers
+            positions (list): Physical position of each axis, the current
+                step counters if None
+            directions (list): Direction (1 or -1) of each axis' last move.
+                Unknown if None, then the first move of each axis isn't
+                corrected for backlash
+        """
+        axes = list(axes)
+        counters = self.controller.get_positions(axes)
+        if positions is None:
+            positions = counters
+        if directions is None:
+            directions = [None]*len(axes)
+        for axis, counter, position, direction in zip(axes, counters, positions, directions):
+            self._counter[axis] = counter
+            self._physical[axis] = float(position)
+            self._direction[axis] = direction
+
+    def _plan(self, axis, target):
+        """Counter target and resulting physical position of a move"""
+        physical = self._physical[axis]
+        counter = self._counter[axis]
+        calibration = self.calibration.get(axis)
+        delta = target - physical
+        if calibration is None or not delta:
+            steps = int(round(delta))
+            return counter + steps, physical + steps, self._direction[axis]
+
+        direction = 1 if delta > 0 else -1
+        scale = 1. if direction > 0 else calibration.reverse_scale
+        steps = int(round(abs(delta) / scale))
+        lost = 0
+        if self._direction[axis] is not None and direction != self._direction[axis]:
+            lost = calibration.backlash
+        steps += lost
+        return (counter + direction*steps,
+                physical + direction*(steps - lost)*scale,
+                direction)
+
+    def _move(self, targets, wait, wait_kwargs):
+        counters = {}
+        for axis, target in targets.items():
+            counters[axis], self._physical[axis], self._direction[axis] = \
+                self._plan(axis, target)
+            self._counter[axis] = counters[axis]
+        return self.controller.move_all(counters, wait=wait, **wait_kwargs)
+
+    def move_all(self, positions, wait=True, **wait_kwargs):
+        """Move several axes to compensated positions at once
+
+        Args:
+            positions (list or dict): Targets in forward steps, in axis order
+                starting at motor 1 or keyed by motor number
+            wait (bool): Block until every moved motor has stopped. Always
+                waits for the overshoot of an approach move
+            **wait_kwargs: Passed on to Controller.move_all
+
+        Returns:
+            elapsed (float): Seconds spent waiting for the move
+        """
+        if not isinstance(positions, dict):
+            positions = dict(enumerate(positions, start=1))
+        positions = dict((axis, float(p)) for axis, p in positions.items())
+
+        elapsed = 0.
+        if self.approach is not None:
+            overshoot = dict(
+                (axis, p - self.approach*self.approach_distance)
+                for axis, p in positions.items()
+                if axis in self.calibration
+                and (p - self._physical[axis])*self.approach < 0
+            )
+            if overshoot:
+                settle = dict(wait_kwargs, settle_time=0.)
+                elapsed += self._move(overshoot, True, settle)
+        return elapsed + self._move(positions, wait, wait_kwargs)
+
+    def move_to(self, axis, position, wait=True, **wait_kwargs):
+        """Move one axis to a compensated position, see move_all"""
+        return self.move_all({axis: position}, wait=wait, **wait_kwargs)
+
+    def get_position(self, axis):
+        """Estimated physical position of an axis, in forward steps"""
+        return self._physical[axis]
+
+    def get_positions(self, axes=(1, 2, 3, 4)):
+        """Estimated physical positions, in forward steps"""
+        return [self._physical[axis] for axis in axes]
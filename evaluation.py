@@ -0,0 +1,314 @@
+"""
+Noise-aware power evaluation on top of LabJackAnalog
+
+A single ADC sample of the photodiode is noisy enough near the optimum to
+make the simplex rank vertices wrongly. AdaptiveEvaluator samples
+sequentially and stops as soon as the candidate can be ranked against the
+scores it is compared to, so clearly good or clearly bad poses cost only a
+few samples and only close calls are averaged longer.
+
+Example:
+
+    >>> lj = LabJackAnalog(identifier="ANY")
+    >>> evaluator = AdaptiveEvaluator(lj, input_channel=2)
+    >>> m = evaluator.measure(references=[2.71, 2.85, 3.02])
+    >>> m.mean, m.sem, m.n
+
+HardwareObjective turns a Controller and an evaluator into the objective
+expected by the optimizers module. Given an EvaluationCache it skips the
+move and the read for a pose measured recently, e.g. the best vertex that
+Nelder-Mead's reduction step asks for again.
+"""
+
+import math
+import time
+from collections import OrderedDict, namedtuple
+
+Measurement = namedtuple("Measurement", ["mean", "sem", "n"])
+
+
+class AdaptiveEvaluator(object):
+    """Sequential sampling of one analog input
+
+    Samples are taken one at a time. After min_samples, sampling stops as
+    soon as the confidence interval mean +- z*sem excludes every reference
+    value, or is narrower than tolerance, or max_samples is reached.
+    """
+
+    def __init__(self, lj, input_channel, min_samples=3, max_samples=30,
+                 z=2., tolerance=0., noise_floor=0., reference_channel=None,
+                 reference_level=1.):
+        """
+        Args:
+            lj (LabJackAnalog): Open LabJack used to read the photodiode
+            input_channel (int or str): Analog input, e.g. 2 or "AIN2"
+            min_samples (int): Samples always taken, at least 2 so that a
+                standard error can be estimated
+            max_samples (int): Never take more samples than this
+            z (float): Width of the confidence interval in standard errors
+            tolerance (float): Stop once z*sem is below this, differences
+                smaller than it are not worth resolving
+            noise_floor (float): Lower bound on the per-sample standard
+                deviation, guards against a zero spread from ADC
+                quantization on the first few samples
+            reference_channel (int or str): Analog input of a photodiode on
+                a pickoff of the source. If given, every sample reads both
+                inputs in the same scan and returns
+                input * reference_level / reference, so source power
+                fluctuations cancel
+            reference_level (float): Reference reading of the nominal source
+                power, which keeps the samples in volts at that power
+        """
+        self.lj = lj
+        self.input_channel = input_channel
+        self.min_samples = max(2, min_samples)
+        self.max_samples = max(self.min_samples, max_samples)
+        self.z = z
+        self.tolerance = tolerance
+        self.noise_floor = noise_floor
+        self.reference_channel = reference_channel
+        self.reference_level = reference_level
+
+        self.evaluations = 0
+        self.samples_taken = 0
+        self._pooled_ss = 0.
+        self._pooled_dof = 0
+
+    def sample(self):
+        """Take a single reading, normalized to the reference if there is
+        one"""
+        if self.reference_channel is None:
+            return self.lj.analog_in(self.input_channel)
+        return self.reference_level*self.lj.ratio_in(self.input_channel,
+                                                     self.reference_channel)
+
+    def measure(self, references=()):
+        """Sample until the mean can be ranked against the references
+
+        Args:
+            references (iterable): Power values the candidate will be
+                compared with, e.g. the current simplex vertices
+
+        Returns:
+            Measurement: mean, standard error of the mean and sample count
+        """
+        references = list(references)
+        n = 0
+        mean = 0.
+        m2 = 0.
+        while True:
+            # Welford's running mean and variance
+            x = self.sample()
+            n += 1
+            delta = x - mean
+            mean += delta / n
+            m2 += delta * (x - mean)
+
+            if n < self.min_samples:
+                continue
+            std = max(math.sqrt(m2 / (n - 1)), self.noise_floor)
+            sem = std / math.sqrt(n)
+            half_width = self.z * sem
+            if n >= self.max_samples or half_width <= self.tolerance:
+                break
+            if all(abs(mean - r) > half_width for r in references):
+                break
+
+        self.evaluations += 1
+        self.samples_taken += n
+        self._pooled_ss += m2
+        self._pooled_dof += n - 1
+        return Measurement(mean, sem, n)
+
+    @property
+    def mean_samples(self):
+        """Average number of samples per evaluation so far"""
+        if not self.evaluations:
+            return 0.
+        return self.samples_taken / float(self.evaluations)
+
+    @property
+    def noise(self):
+        """Per-sample standard deviation pooled over all evaluations so far,
+        None before the first one"""
+        if not self._pooled_dof:
+            return None
+        return math.sqrt(self._pooled_ss / self._pooled_dof)
+
+
+class EvaluationCache(object):
+    """Recent measurements keyed by pose
+
+    Poses are rounded to the motor resolution, so two poses that put the
+    motors on the same steps share an entry. An entry expires after max_age
+    seconds, or earlier once the power drift expected since it was measured,
+    drift_rate times its age, exceeds its standard error. drift_rate is
+    estimated from the change seen whenever a pose is measured again after
+    its entry expired.
+    """
+
+    # weight of the newest drift rate estimate in the running average
+    drift_smoothing = 0.3
+
+    def __init__(self, resolution=1., max_age=60., drift_rate=0., max_entries=1000,
+                 clock=time):
+        """
+        Args:
+            resolution (float): Pose tolerance in steps, the motor resolution
+            max_age (float): Seconds an entry is used at most
+            drift_rate (float): Initial estimate of the power drift, in power
+                per second
+            max_entries (int): The oldest entries are dropped beyond this
+            clock: Provides time(), the time module or a simulated clock
+        """
+        self.resolution = resolution
+        self.max_age = max_age
+        self.drift_rate = drift_rate
+        self.max_entries = max_entries
+        self.clock = clock
+
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        # key -> (time, Measurement), oldest first
+        self._entries = OrderedDict()
+
+    def _key(self, x):
+        return tuple(int(round(float(p) / self.resolution)) for p in x)
+
+    def lifetime(self, measurement):
+        """Seconds a measurement stays valid"""
+        if self.drift_rate <= 0:
+            return self.max_age
+        return min(self.max_age, measurement.sem / self.drift_rate)
+
+    def get(self, x):
+        """The measurement at pose x, None on a miss or if it expired"""
+        entry = self._entries.get(self._key(x))
+        if entry is not None:
+            t, measurement = entry
+            if self.clock.time() - t <= self.lifetime(measurement):
+                self.hits += 1
+                return measurement
+            self.expired += 1
+        self.misses += 1
+        return None
+
+    def __contains__(self, x):
+        """Whether get(x) would hit, without counting a lookup"""
+        entry = self._entries.get(self._key(x))
+        return (entry is not None
+                and self.clock.time() - entry[0] <= self.lifetime(entry[1]))
+
+    def put(self, x, measurement):
+        """Store a new measurement at pose x"""
+        key = self._key(x)
+        now = self.clock.time()
+        old = self._entries.pop(key, None)
+        if old is not None and now > old[0]:
+            # the part of the change that the noise doesn't explain
+            t, previous = old
+            noise = math.hypot(measurement.sem, previous.sem)
+            change = max(0., abs(measurement.mean - previous.mean) - noise)
+            rate = change / (now - t)
+            self.drift_rate += self.drift_smoothing*(rate - self.drift_rate)
+        self._entries[key] = (now, measurement)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        """Drop all entries, e.g. after redefining home with DH"""
+        self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def hit_rate(self):
+        """Fraction of lookups answered from the cache, None before the
+        first one"""
+        lookups = self.hits + self.misses
+        if not lookups:
+            return None
+        return self.hits / float(lookups)
+
+    def status(self):
+        """Counters for a supervisor
+
+        Returns:
+            status (dict)
+        """
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "expired": self.expired,
+            "hit_rate": self.hit_rate,
+            "drift_rate": self.drift_rate,
+        }
+
+
+class HardwareObjective(object):
+    """Move the mirrors to a pose and score the coupled power there
+
+    Scores are the negative mean power so that the optimizers, which
+    minimize, maximize the coupling.
+    """
+
+    def __init__(self, controller, evaluator, axes=None, cache=None, health=None,
+                 **wait_kwargs):
+        """
+        Args:
+            controller (Controller): Picomotor controller driving the mirrors
+            evaluator (AdaptiveEvaluator): Reads the coupled power
+            axes (iterable): Motor numbers the pose coordinates drive, e.g.
+                when one controller serves several couplers. Motors 1 to
+                len(x) if None
+            cache (EvaluationCache): Scores poses measured recently without
+                moving there. After a hit the mirrors are still wherever the
+                previous evaluation left them
+            health (ControllerHealthMonitor): Monitor polling the controller,
+                moves wait on its motion done snapshot while it is fresh
+                instead of polling MD? themselves
+            **wait_kwargs: poll_interval, timeout and settle_time, passed on
+                to Controller.move_all
+        """
+        self.controller = controller
+        self.evaluator = evaluator
+        self.axes = None if axes is None else tuple(axes)
+        self.cache = cache
+        self.wait_kwargs = wait_kwargs
+        if health is not None:
+            self.wait_kwargs["health"] = health
+        self.clock = controller.clock
+        self.last_measurement = None
+        self.last_move_latency = None
+        self.last_read_latency = None
+
+    def __call__(self, x, references=()):
+        """
+        Args:
+            x (array): Motor positions, in the order of axes
+            references (iterable): Scores the result will be ranked against
+
+        Returns:
+            score (float): Negative mean power at x
+        """
+        if self.cache is not None:
+            measurement = self.cache.get(x)
+            if measurement is not None:
+                self.last_measurement = measurement
+                self.last_move_latency = 0.
+                self.last_read_latency = 0.
+                return -measurement.mean
+
+        start = self.clock.time()
+        positions = x if self.axes is None else dict(zip(self.axes, x))
+        self.controller.move_all(positions, **self.wait_kwargs)
+        moved = self.clock.time()
+        self.last_measurement = self.evaluator.measure([-r for r in references])
+        self.last_move_latency = moved - start
+        self.last_read_latency = self.clock.time() - moved
+        if self.cache is not None:
+            self.cache.put(x, self.last_measurement)
+        return -self.last_measurement.mean
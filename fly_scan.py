@@ -0,0 +1,252 @@
+"""
+Fly scans: one continuous move of an axis while the photodiode streams
+
+Instead of stepping, settling and reading at every point, fly_scan starts
+a single relative move (xPRnn) and streams the photodiode throughout it.
+Every sample is timestamped on the controller's clock and mapped to the
+step counter through the trapezoidal velocity profile set by the axis'
+velocity (VA) and acceleration (AC). TP? checkpoints taken during the move
+correct the estimated start of the motion for USB latency. The result is
+a dense power profile along the axis from one motion, in about the time
+of a single step-and-settle evaluation per few hundred steps.
+
+Example:
+
+    >>> scan = fly_scan(controller, lj, axis=1, distance=400, input_channel=2)
+    >>> find_peak(scan)
+
+    or scan an axis around its current position and move to the peak:
+
+    >>> peak, scan = align_axis(controller, lj, axis=1, span=400, input_channel=2)
+"""
+
+from collections import namedtuple
+
+import numpy as np
+
+FlyScan = namedtuple("FlyScan", ["time", "position", "power"])
+
+
+def trapezoid(t, distance, velocity, acceleration):
+    """Steps done t seconds after the start of a move
+
+    The 8742 accelerates at acceleration up to velocity, or to less for a
+    short move, and decelerates symmetrically into the target.
+
+    Args:
+        t (array): Seconds since the start of the move
+        distance (float): Length of the move in steps, positive
+        velocity (float): Steps per second (VA)
+        acceleration (float): Steps per second squared (AC)
+
+    Returns:
+        steps (array): Between 0 and distance
+    """
+    d, v, a = float(distance), float(velocity), float(acceleration)
+    t = np.asarray(t, dtype=float)
+    if d <= v*v/a:
+        t_acc = np.sqrt(d/a)
+        total = 2*t_acc
+        t = np.clip(t, 0, total)
+        return np.where(t < t_acc, 0.5*a*t**2, d - 0.5*a*(total - t)**2)
+    t_acc = v/a
+    total = d/v + t_acc
+    t = np.clip(t, 0, total)
+    return np.where(
+        t < t_acc, 0.5*a*t**2,
+        np.where(t < total - t_acc, 0.5*v*t_acc + v*(t - t_acc),
+                 d - 0.5*a*(total - t)**2))
+
+
+def move_duration(distance, velocity, acceleration):
+    """Seconds a move of distance steps takes"""
+    d, v, a = abs(float(distance)), float(velocity), float(acceleration)
+    if d <= v*v/a:
+        return 2*np.sqrt(d/a)
+    return d/v + v/a
+
+
+def fly_scan(controller, lj, axis, distance, input_channel, scan_rate=1000.,
+             velocity=None, acceleration=None, checkpoints=True,
+             scans_per_read=None, stop_above=None):
+    """Move an axis by distance steps while streaming the photodiode
+
+    Args:
+        controller (Controller): Controller driving the axis
+        lj (LabJackAnalog): LabJack reading the photodiode
+        axis (int): Motor number (1-4)
+        distance (int): Relative move in steps, the sign gives the direction
+        input_channel (int or str): Photodiode analog input
+        scan_rate (float): Photodiode samples per second
+        velocity (int): Steps per second for the scan, the axis' current VA
+            if None. The old value is restored afterwards
+        acceleration (int): Steps per second squared for the scan, the
+            axis' current AC if None. The old value is restored afterwards
+        checkpoints (bool): Query TP? between stream reads and use the
+            answers to correct the estimated start of the motion
+        scans_per_read (int): Samples per stream read, 20 ms worth if None
+        stop_above (float): Stop the axis (xST) as soon as a sample reaches
+            this power, None scans the whole distance
+
+    Returns:
+        scan (FlyScan): time (controller clock), position (step counter)
+            and power arrays, one entry per sample taken while the axis was
+            moving, up to the stop if stopped early. Overflowed samples are
+            NaN
+    """
+    clock = controller.clock
+    distance = int(round(distance))
+    old_velocity = int(controller.command("{}VA?".format(axis)))
+    old_acceleration = int(controller.command("{}AC?".format(axis)))
+    if velocity is not None:
+        controller.command("{}VA{}".format(axis, int(velocity)))
+    if acceleration is not None:
+        controller.command("{}AC{}".format(axis, int(acceleration)))
+    velocity = old_velocity if velocity is None else int(velocity)
+    acceleration = old_acceleration if acceleration is None else int(acceleration)
+    if scans_per_read is None:
+        scans_per_read = max(1, int(scan_rate / 50))
+
+    try:
+        start_position = controller.get_position(axis)
+        duration = move_duration(distance, velocity, acceleration)
+
+        stream = lj.stream_chunks(input_channel, scan_rate, scans_per_read)
+        chunks = []
+        checks = []
+        try:
+            before = clock.time()
+            chunks.append(next(stream).data[:, 0])
+            rate = lj.stream_scan_rate
+            # the first read returns as soon as its scans are in
+            stream_start = max(before, clock.time() - scans_per_read/rate)
+
+            before = clock.time()
+            controller.command("{}PR{}".format(axis, distance))
+            move_start = 0.5*(before + clock.time())
+            stopped = np.inf
+
+            while clock.time() < move_start + duration + scans_per_read/rate:
+                chunks.append(next(stream).data[:, 0])
+                if stop_above is not None and np.any(chunks[-1] >= stop_above):
+                    # samples after the stop command aren't on the profile
+                    stopped = clock.time()
+                    controller.command("{}ST".format(axis))
+                    break
+                if checkpoints and clock.time() < move_start + duration:
+                    before = clock.time()
+                    position = controller.get_position(axis)
+                    checks.append((0.5*(before + clock.time()), position))
+        finally:
+            stream.close()
+        controller.wait_for_motion_done(axis)
+    finally:
+        if velocity != old_velocity:
+            controller.command("{}VA{}".format(axis, old_velocity))
+        if acceleration != old_acceleration:
+            controller.command("{}AC{}".format(axis, old_acceleration))
+
+    power = np.concatenate(chunks)
+    times = stream_start + np.arange(len(power))/rate
+    direction = 1 if distance >= 0 else -1
+
+    if checks:
+        move_start += _start_correction(checks, start_position, move_start,
+                                        abs(distance), direction, velocity,
+                                        acceleration)
+
+    moving = (times >= move_start) & (times <= min(move_start + duration, stopped))
+    times, power = times[moving], power[moving]
+    position = start_position + direction*trapezoid(
+        times - move_start, abs(distance), velocity, acceleration)
+    return FlyScan(time=times, position=position, power=power)
+
+
+def _start_correction(checks, start_position, move_start, distance, direction,
+                      velocity, acceleration):
+    """Seconds the motion started later than move_start, from TP? answers
+    taken while the axis was moving"""
+    grid = np.linspace(0, move_duration(distance, velocity, acceleration), 1000)
+    profile = trapezoid(grid, distance, velocity, acceleration)
+    lags = []
+    for t, position in checks:
+        done = direction*(position - start_position)
+        if 0 < done < distance:
+            # when the model profile reaches the reported counter
+            lags.append(t - move_start - np.interp(done, profile, grid))
+    if not lags:
+        return 0.
+    return float(np.median(lags))
+
+
+def find_peak(scan, window=None):
+    """Position of the highest power along a fly scan
+
+    The power is smoothed with a moving average, ignoring NaN samples, to
+    find the maximum. A parabola is then fitted to the raw samples of the
+    lobe around it that lies above half the maximum, which uses every
+    sample near the top instead of the single noisiest one.
+
+    Args:
+        scan (FlyScan): From fly_scan
+        window (int): Samples averaged, about 1 % of the scan if None
+
+    Returns:
+        position (float): Step counter of the peak, None if the scan has no
+            valid samples
+    """
+    position = np.asarray(scan.position, dtype=float)
+    power = np.asarray(scan.power, dtype=float)
+    valid = ~np.isnan(power)
+    if not valid.any():
+        return None
+    if window is None:
+        window = max(1, len(power) // 100)
+    kernel = np.ones(window)
+    counts = np.convolve(valid, kernel, mode="same")
+    with np.errstate(invalid="ignore", divide="ignore"):
+        smooth = np.convolve(np.where(valid, power, 0.), kernel, mode="same") / counts
+    smooth[counts == 0] = np.nan
+
+    i = int(np.nanargmax(smooth))
+    half = 0.5*(np.nanmax(smooth) + np.nanmin(smooth))
+    above = ~(smooth < half)
+    left, right = i, i
+    while left > 0 and above[left - 1]:
+        left -= 1
+    while right < len(smooth) - 1 and above[right + 1]:
+        right += 1
+
+    lobe = slice(left, right + 1)
+    x, y = position[lobe][valid[lobe]], power[lobe][valid[lobe]]
+    if len(np.unique(x)) >= 3:
+        a, b, _ = np.polyfit(x - position[i], y, 2)
+        if a < 0:
+            vertex = position[i] - 0.5*b/a
+            if min(x) <= vertex <= max(x):
+                return float(vertex)
+    return float(position[i])
+
+
+def align_axis(controller, lj, axis, span, input_channel, **scan_kwargs):
+    """Fly scan an axis across span steps centred on its current position
+    and move it to the peak
+
+    Args:
+        controller (Controller): Controller driving the axis
+        lj (LabJackAnalog): LabJack reading the photodiode
+        axis (int): Motor number (1-4)
+        span (int): Length of the scan in steps
+        input_channel (int or str): Photodiode analog input
+        **scan_kwargs: Passed on to fly_scan
+
+    Returns:
+        (peak, scan): Step counter of the peak, None if no valid sample,
+            and the FlyScan
+    """
+    centre = controller.get_position(axis)
+    controller.move_to(axis, centre - span // 2)
+    scan = fly_scan(controller, lj, axis, span, input_channel, **scan_kwargs)
+    peak = find_peak(scan)
+    controller.move_to(axis, centre if peak is None else peak)
+    return peak, scan
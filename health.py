@@ -0,0 +1,258 @@
+"""
+Background connection health monitor for the 8742 controller
+
+ControllerHealthMonitor queries MD?, TP? and ERRSTR? for every axis in one
+pipelined round trip every interval seconds and keeps the answers as a
+timestamped HealthSnapshot. Callers that only need to know roughly where
+the motors are, or whether the controller is still there, read the
+snapshot instead of issuing their own blocking queries. The monitor shares
+the controller's lock, so its queries interleave with the optimizer's
+commands without mixing up replies.
+
+A USB error marks the controller disconnected. Every reconnect_interval
+seconds after that the monitor tries Controller.reconnect, so a pulled
+cable or a controller power cycle is noticed and recovered from instead of
+surfacing hours later as a stack trace.
+
+Example:
+
+    >>> health = ControllerHealthMonitor(controller)
+    >>> health.start()
+    >>> health.snapshot().positions
+    >>> health.stop()
+"""
+
+import threading
+import time
+import traceback
+from collections import deque, namedtuple
+
+import usb.core
+
+HealthSnapshot = namedtuple("HealthSnapshot", [
+    "time", "connected", "motion_done", "positions", "errors", "last_error"
+])
+
+
+class ControllerHealthMonitor(object):
+    """Poll the controller's state in the background
+
+    Runs in its own thread with start()/stop(), or call poll() repeatedly to
+    drive it from a loop, e.g. on a simulated clock.
+    """
+
+    def __init__(self, controller, axes=(1, 2, 3, 4), interval=0.5,
+                 reconnect_interval=2., max_errors=100, clock=time):
+        """
+        Args:
+            controller (Controller): Controller to watch
+            axes (iterable): Motor numbers to query
+            interval (float): Seconds between polls
+            reconnect_interval (float): Seconds between reconnection attempts
+                while disconnected
+            max_errors (int): Controller error messages kept
+            clock: Provides time() and sleep(), the time module or a
+                simulated clock
+        """
+        self.controller = controller
+        self.axes = tuple(axes)
+        self.interval = interval
+        self.reconnect_interval = reconnect_interval
+        self.clock = clock
+
+        self.connected = True
+        self.polls = 0
+        self.disconnects = 0
+        self.reconnects = 0
+        self.last_error = None
+
+        self._snapshot = None
+        self._errors = deque(maxlen=max_errors)
+        self._next_reconnect = None
+        self._queries = (
+            ["{}MD?".format(axis) for axis in self.axes]
+            + ["{}TP?".format(axis) for axis in self.axes]
+            + ["ERRSTR?"]
+        )
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def poll(self):
+        """Query the controller once, or try to reconnect if it is gone
+
+        Returns:
+            snapshot (HealthSnapshot): The updated snapshot
+        """
+        if not self.connected:
+            self._try_reconnect()
+        if self.connected:
+            # stamped when the queries go out, a snapshot newer than a move
+            # command was queried after it
+            queried = self.clock.time()
+            try:
+                replies = self.controller.query_pipelined(self._queries)
+            except usb.core.USBError as e:
+                self._disconnected(e)
+            else:
+                self._update(replies, queried)
+        return self.snapshot()
+
+    def _update(self, replies, queried):
+        n = len(self.axes)
+        motion_done = dict(
+            (axis, reply[-1:] == '1') for axis, reply in zip(self.axes, replies[:n])
+        )
+        positions = dict(
+            (axis, int(reply)) for axis, reply in zip(self.axes, replies[n:2*n])
+        )
+        error = replies[-1]
+        with self._lock:
+            if error.split(',')[0].strip() not in ("", "0"):
+                self._errors.append((self.clock.time(), error))
+            self.polls += 1
+            self._snapshot = HealthSnapshot(
+                time=queried,
+                connected=True,
+                motion_done=motion_done,
+                positions=positions,
+                errors=tuple(self._errors),
+                last_error=self.last_error,
+            )
+
+    def _disconnected(self, error):
+        with self._lock:
+            self.connected = False
+            self.disconnects += 1
+            self.last_error = ''.join(
+                traceback.format_exception_only(type(error), error)).strip()
+            self._next_reconnect = self.clock.time() + self.reconnect_interval
+            if self._snapshot is not None:
+                self._snapshot = self._snapshot._replace(
+                    connected=False, last_error=self.last_error)
+
+    def _try_reconnect(self):
+        if self.clock.time() < self._next_reconnect:
+            return
+        try:
+            self.controller.reconnect()
+        except (usb.core.USBError, ValueError) as e:
+            with self._lock:
+                self.last_error = ''.join(
+                    traceback.format_exception_only(type(e), e)).strip()
+                self._next_reconnect = self.clock.time() + self.reconnect_interval
+            return
+        with self._lock:
+            self.connected = True
+            self.reconnects += 1
+
+    def snapshot(self):
+        """Latest state, without talking to the controller
+
+        Returns:
+            snapshot (HealthSnapshot): None before the first successful poll.
+                motion_done and positions map axis to the last answer
+        """
+        with self._lock:
+            return self._snapshot
+
+    def age(self):
+        """Seconds since the last successful poll, None if there was none"""
+        snapshot = self.snapshot()
+        if snapshot is None:
+            return None
+        return self.clock.time() - snapshot.time
+
+    def positions(self, max_age=None):
+        """Motor positions from the snapshot if it is recent enough
+
+        Args:
+            max_age (float): Oldest acceptable snapshot in seconds, 2
+                intervals if None
+
+        Returns:
+            positions (list): Steps from home in the order of axes, queried
+                from the controller if the snapshot is too old
+        """
+        if max_age is None:
+            max_age = 2*self.interval
+        snapshot = self.snapshot()
+        if snapshot is not None and snapshot.connected \
+                and self.clock.time() - snapshot.time <= max_age:
+            return [snapshot.positions[axis] for axis in self.axes]
+        return self.controller.get_positions(self.axes)
+
+    def motion_done(self, axes, since=None, max_age=None):
+        """Motion done of axes from the snapshot if it is recent enough
+
+        Args:
+            axes (iterable): Motor numbers, all of them polled by this monitor
+            since (float): Ignore snapshots queried before this time, e.g.
+                before the move being waited for was commanded
+            max_age (float): Oldest acceptable snapshot in seconds, 2
+                intervals if None
+
+        Returns:
+            done (list): Whether each axis is stopped, None if the snapshot
+                is too old and the caller has to ask the controller
+        """
+        if max_age is None:
+            max_age = 2*self.interval
+        snapshot = self.snapshot()
+        if snapshot is None or not snapshot.connected \
+                or self.clock.time() - snapshot.time > max_age \
+                or (since is not None and snapshot.time < since):
+            return None
+        try:
+            return [snapshot.motion_done[axis] for axis in axes]
+        except KeyError:
+            return None
+
+    def run(self):
+        """Poll until stop() is called"""
+        while not self._stop_event.is_set():
+            start = self.clock.time()
+            try:
+                self.poll()
+            except Exception as e:
+                with self._lock:
+                    self.last_error = ''.join(
+                        traceback.format_exception_only(type(e), e)).strip()
+            self.clock.sleep(max(0., self.interval - (self.clock.time() - start)))
+        self._stop_event.clear()
+
+    def start(self):
+        """Poll in a background thread"""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self.run, name="ControllerHealthMonitor")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        """Stop the background thread"""
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def status(self):
+        """Counters and the latest snapshot for a supervisor
+
+        Returns:
+            status (dict)
+        """
+        with self._lock:
+            snapshot = self._snapshot
+            return {
+                "connected": self.connected,
+                "polls": self.polls,
+                "disconnects": self.disconnects,
+                "reconnects": self.reconnects,
+                "last_error": self.last_error,
+                "last_poll_time": snapshot.time if snapshot else None,
+                "positions": dict(snapshot.positions) if snapshot else None,
+                "motion_done": dict(snapshot.motion_done) if snapshot else None,
+                "controller_errors": list(self._errors),
+            }
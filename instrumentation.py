@@ -0,0 +1,235 @@
+"""
+Optional latency instrumentation of the controller and DAQ hot paths
+
+Controller and LabJackAnalog report every command, USB transfer, sleep and
+LJM read to the module-wide INSTRUMENTATION object. While it is disabled,
+which is the default, each hook costs a single attribute check. Once
+enabled, it keeps per-call latency histograms, counts and error counts keyed
+by category and command mnemonic or channel, and attributes time to the
+optimizer phase (reflect, expand, ...) that was running.
+
+Example:
+
+    >>> with profile():
+    ...     result = minimize(optimizer, objective)
+
+    prints where the time of every phase went on exit, or
+
+    >>> INSTRUMENTATION.enable()
+    >>> ...
+    >>> INSTRUMENTATION.snapshot()
+"""
+
+import bisect
+import functools
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+# log spaced histogram bin edges, 1 us to 100 s
+BIN_EDGES = [10**(e/5.) for e in range(-30, 11)]
+
+# categories that don't contain each other, the per-phase breakdown adds
+# these up and reports the rest of the phase time as "other"
+LEAF_CATEGORIES = ["usb.write", "usb.read", "controller.sleep",
+                   "labjack.analog_in", "labjack.stream_read"]
+
+
+class LatencyStats(object):
+    """Count, error count and latency histogram of one kind of call"""
+
+    __slots__ = ("count", "errors", "total", "minimum", "maximum", "histogram")
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.total = 0.
+        self.minimum = float("inf")
+        self.maximum = 0.
+        self.histogram = [0]*(len(BIN_EDGES) + 1)
+
+    def add(self, seconds, error=False):
+        self.count += 1
+        self.errors += error
+        self.total += seconds
+        self.minimum = min(self.minimum, seconds)
+        self.maximum = max(self.maximum, seconds)
+        self.histogram[bisect.bisect(BIN_EDGES, seconds)] += 1
+
+    def percentile(self, q):
+        """Upper bin edge below which q percent of the calls fall"""
+        if not self.count:
+            return None
+        target = q / 100. * self.count
+        seen = 0
+        for i, n in enumerate(self.histogram):
+            seen += n
+            if seen >= target:
+                return BIN_EDGES[i] if i < len(BIN_EDGES) else self.maximum
+        return self.maximum
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "errors": self.errors,
+            "total": self.total,
+            "mean": self.total / self.count if self.count else None,
+            "min": self.minimum if self.count else None,
+            "max": self.maximum if self.count else None,
+            "p50": self.percentile(50),
+            "p99": self.percentile(99),
+            "histogram": list(self.histogram),
+        }
+
+
+class Instrumentation(object):
+    """Collects latency statistics while enabled"""
+
+    def __init__(self, timer=time.perf_counter):
+        """
+        Args:
+            timer (callable): Returns the current time in seconds, e.g.
+                time.perf_counter or a simulated clock's time
+        """
+        self.enabled = False
+        self.timer = timer
+        self._lock = threading.Lock()
+        self.reset()
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        """Forget all statistics"""
+        with self._lock:
+            self._stats = {}
+            self._phases = {}
+            self._phase = None
+            self._phase_start = self.timer()
+
+    def record(self, category, key, seconds, error=False):
+        """Add one call's latency
+
+        Args:
+            category (str): e.g. "usb.read" or "labjack.analog_in"
+            key (str): Command mnemonic, channel name or ""
+            seconds (float): Latency
+            error (bool): The call raised
+        """
+        with self._lock:
+            stats = self._stats.get((category, key))
+            if stats is None:
+                stats = self._stats[(category, key)] = LatencyStats()
+            stats.add(seconds, error)
+            phase = self._phases.setdefault(self._phase, {})
+            phase[category] = phase.get(category, 0.) + seconds
+
+    @contextmanager
+    def timed(self, category, key=""):
+        """Time the body of a with statement"""
+        start = self.timer()
+        try:
+            yield
+        except BaseException:
+            self.record(category, key, self.timer() - start, error=True)
+            raise
+        self.record(category, key, self.timer() - start)
+
+    def set_phase(self, phase):
+        """Attribute the following calls to phase, e.g. the optimizer phase"""
+        with self._lock:
+            now = self.timer()
+            totals = self._phases.setdefault(self._phase, {})
+            totals["wall"] = totals.get("wall", 0.) + now - self._phase_start
+            self._phase = phase
+            self._phase_start = now
+
+    def snapshot(self):
+        """Copy of the statistics
+
+        Returns:
+            snapshot (dict): "calls" maps "category:key" to the call
+                statistics, "phases" maps each phase to the seconds spent in
+                it ("wall") and in each category
+        """
+        with self._lock:
+            calls = dict(
+                ("{}:{}".format(category, key), stats.to_dict())
+                for (category, key), stats in sorted(self._stats.items())
+            )
+            phases = dict(("-" if p is None else str(p), dict(t))
+                          for p, t in self._phases.items())
+        return {"calls": calls, "phases": phases}
+
+    def report(self):
+        """Human readable per-phase breakdown and call table"""
+        snapshot = self.snapshot()
+        lines = ["{:<12s}{:>10s}".format("phase", "wall [s]") + "".join(
+            "{:>20s}".format(c) for c in LEAF_CATEGORIES + ["other"])]
+        for phase, totals in sorted(snapshot["phases"].items()):
+            wall = totals.get("wall", 0.)
+            leaf = [totals.get(c, 0.) for c in LEAF_CATEGORIES]
+            if not wall and not any(leaf):
+                continue
+            lines.append("{:<12s}{:>10.3f}".format(phase, wall) + "".join(
+                "{:>20.3f}".format(t) for t in leaf + [max(0., wall - sum(leaf))]))
+        lines.append("")
+        lines.append("{:<40s}{:>8s}{:>8s}{:>12s}{:>12s}{:>12s}".format(
+            "call", "count", "errors", "mean [ms]", "p99 [ms]", "max [ms]"))
+        for name, stats in snapshot["calls"].items():
+            lines.append("{:<40s}{:>8d}{:>8d}{:>12.3f}{:>12.3f}{:>12.3f}".format(
+                name, stats["count"], stats["errors"], 1e3*stats["mean"],
+                1e3*stats["p99"], 1e3*stats["max"]))
+        return "\n".join(lines)
+
+
+INSTRUMENTATION = Instrumentation()
+
+
+def instrumented(category, key=None):
+    """Decorator timing a function while INSTRUMENTATION is enabled
+
+    Args:
+        category (str): Statistics category
+        key (callable): key(*args, **kwargs) -> str, "" if None
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not INSTRUMENTATION.enabled:
+                return func(*args, **kwargs)
+            with INSTRUMENTATION.timed(category, key(*args, **kwargs) if key else ""):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+@contextmanager
+def profile(stream=sys.stdout, timer=None):
+    """Enable instrumentation for a block and print the breakdown on exit
+
+    Args:
+        stream: Where to print the report, None to not print
+        timer (callable): Time source for the block, e.g. a simulated
+            clock's time. The current timer if None
+
+    Yields:
+        INSTRUMENTATION, e.g. for a snapshot() at the end
+    """
+    was_enabled, old_timer = INSTRUMENTATION.enabled, INSTRUMENTATION.timer
+    if timer is not None:
+        INSTRUMENTATION.timer = timer
+    INSTRUMENTATION.reset()
+    INSTRUMENTATION.enable()
+    try:
+        yield INSTRUMENTATION
+    finally:
+        INSTRUMENTATION.set_phase(None)
+        INSTRUMENTATION.enabled = was_enabled
+        if stream is not None:
+            stream.write(INSTRUMENTATION.report() + "\n")
+        INSTRUMENTATION.timer = old_timer
@@ -0,0 +1,214 @@
+"""
+Dither lock-in tracking of the coupling peak
+
+Instead of re-running a full optimization whenever the coupling drifts,
+DitherTracker keeps the mirrors on the peak continuously. Every cycle it
+dithers all axes at once by +-amplitude steps around the current pose,
+each axis following its own Walsh code (a square wave of distinct
+sequency), while the photodiode streams. The mean power of each time slot
+is projected onto the codes, a lock-in demodulation done as one matrix
+product, which gives the local gradient along every axis from one cycle.
+The pose is then nudged up the gradient by a bounded step.
+
+The codes are columns 1, 2, 4 and 7 of the 8x8 Sylvester-Hadamard matrix.
+No product of two of them is another of them, so the curvature of the
+peak doesn't leak into the gradient estimates. The dither costs a relative
+coupling loss of about amplitude**2 * sum(sensitivity) / power on average,
+see dither_loss and amplitude_for_loss.
+
+Example:
+
+    >>> tracker = DitherTracker(controller, lj, input_channel=2, amplitude=5)
+    >>> tracker.run(duration=600)
+    >>> tracker.status()["corrections_per_second"]
+"""
+
+import numpy as np
+
+# Sylvester-Hadamard matrix, entry (r, c) is -1 to the number of bits r and
+# c share. Rows are time slots, the columns used are the axes' codes
+HADAMARD = np.array([[(-1)**bin(r & c).count("1") for c in range(8)] for r in range(8)])
+WALSH_CODES = HADAMARD[:, [1, 2, 4, 7]]
+
+
+def slot_means(data, guard):
+    """Mean of each slot's samples after the motion transient
+
+    Args:
+        data (array): (..., slots, samples per slot), NaN for overflows
+        guard (int): Samples skipped at the start of each slot
+
+    Returns:
+        means (array): (..., slots)
+    """
+    return np.nanmean(data[..., guard:], axis=-1)
+
+
+def demodulate(slot_power, amplitude, codes=WALSH_CODES):
+    """Gradient of the power from the slot means of dither cycles
+
+    Args:
+        slot_power (array): (..., slots) mean power in each slot
+        amplitude (float): Dither amplitude in steps
+        codes (array): (slots, axes) dither signs
+
+    Returns:
+        gradient (array): (..., axes) power per step
+    """
+    return np.asarray(slot_power) @ codes / (len(codes)*amplitude)
+
+
+def dither_loss(amplitude, sensitivity, power):
+    """Average relative coupling loss caused by the dither
+
+    Args:
+        amplitude (float): Dither amplitude in steps
+        sensitivity (array): Curvature of the power along each axis, in power
+            per step squared, e.g. AlignmentState.sensitivity
+        power (float): Power on the peak
+    """
+    return amplitude**2 * float(np.sum(sensitivity)) / power
+
+
+def amplitude_for_loss(max_loss, sensitivity, power):
+    """Largest dither amplitude, in steps, whose loss stays below max_loss"""
+    return float(np.sqrt(max_loss*power / np.sum(sensitivity)))
+
+
+class DitherTracker(object):
+    """Track the coupling peak with a multi-axis square wave dither
+
+    Runs until stopped with run(), or one cycle at a time with cycle().
+    """
+
+    def __init__(self, controller, lj, input_channel, axes=(1, 2, 3, 4),
+                 amplitude=5, slot_time=0.05, guard_time=0.025, scan_rate=2000.,
+                 gain=1e4, max_step=10., telemetry=None):
+        """
+        Args:
+            controller (Controller): Controller driving the mirrors
+            lj (LabJackAnalog): LabJack reading the photodiode
+            input_channel (int or str): Photodiode analog input
+            axes (iterable): Up to 4 motor numbers to dither
+            amplitude (int): Dither amplitude in steps, see
+                amplitude_for_loss
+            slot_time (float): Seconds per dither slot, a cycle is 8 slots
+            guard_time (float): Seconds at the start of a slot ignored while
+                the motors move, longer than a 2*amplitude move
+            scan_rate (float): Photodiode samples per second
+            gain (float): Correction step per relative gradient, in steps
+                squared. For a Gaussian peak of 1/e half width w steps,
+                w**2/2 jumps to the peak in one cycle
+            max_step (float): Largest correction per axis and cycle, in steps
+            telemetry (TelemetryWriter): Records every cycle as phase
+                "dither"
+        """
+        self.controller = controller
+        self.lj = lj
+        self.input_channel = input_channel
+        self.axes = tuple(axes)
+        self.amplitude = int(amplitude)
+        self.scan_rate = scan_rate
+        self.gain = gain
+        self.max_step = max_step
+        self.telemetry = telemetry
+        self.clock = controller.clock
+
+        self.codes = WALSH_CODES[:, :len(self.axes)]
+        self.samples_per_slot = max(2, int(round(slot_time*scan_rate)))
+        self.guard = min(self.samples_per_slot - 1, int(np.ceil(guard_time*scan_rate)))
+
+        self.centre = None
+        self.cycles = 0
+        self.last_gradient = None
+        self.last_power = None
+        self._elapsed = 0.
+        self._stream = None
+        self._stopped = False
+
+    def _slot_targets(self, slot):
+        offsets = self.amplitude*self.codes[slot]
+        return dict((axis, int(round(c + o)))
+                    for axis, c, o in zip(self.axes, self.centre, offsets))
+
+    def cycle(self):
+        """Dither through all slots once and correct the pose
+
+        Returns:
+            gradient (array): Power per step along each axis
+        """
+        start = self.clock.time()
+        if self.centre is None:
+            self.centre = np.array(self.controller.get_positions(self.axes), dtype=float)
+        if self._stream is None:
+            self._stream = self.lj.stream_chunks(self.input_channel, self.scan_rate,
+                                                 self.samples_per_slot)
+
+        data = np.empty((len(self.codes), self.samples_per_slot))
+        for slot in range(len(self.codes)):
+            # the move overlaps the start of the slot, covered by the guard
+            self.controller.move_all(self._slot_targets(slot), wait=False)
+            data[slot] = next(self._stream).data[:, 0]
+
+        power = slot_means(data, self.guard)
+        mean = float(np.nanmean(power))
+        gradient = demodulate(power, self.amplitude, self.codes)
+        if np.all(np.isfinite(gradient)) and mean > 0:
+            step = np.clip(self.gain*gradient/mean, -self.max_step, self.max_step)
+            self.centre = self.centre + step
+
+        self.cycles += 1
+        self.last_gradient = gradient
+        self.last_power = mean
+        self._elapsed += self.clock.time() - start
+        if self.telemetry is not None:
+            self.telemetry.record("dither", self.centre, mean, float(np.nanstd(power)),
+                                  samples=data.size, iteration=self.cycles)
+        return gradient
+
+    def run(self, duration=None, cycles=None):
+        """Track until stop(), or for duration seconds or a number of cycles
+
+        The motors are left at the tracked pose.
+        """
+        self._stopped = False
+        end = None if duration is None else self.clock.time() + duration
+        count = 0
+        try:
+            while not self._stopped:
+                if end is not None and self.clock.time() >= end:
+                    break
+                if cycles is not None and count >= cycles:
+                    break
+                self.cycle()
+                count += 1
+        finally:
+            self.close()
+
+    def stop(self):
+        """Make run() return after the current cycle, e.g. from another
+        thread"""
+        self._stopped = True
+
+    def close(self):
+        """Stop the stream and leave the motors at the tracked pose"""
+        if self._stream is not None:
+            self._stream.close()
+            self._stream = None
+        if self.centre is not None:
+            self.controller.move_all(
+                dict((axis, int(round(c))) for axis, c in zip(self.axes, self.centre)))
+
+    def status(self):
+        """Counters for a supervisor
+
+        Returns:
+            status (dict)
+        """
+        return {
+            "cycles": self.cycles,
+            "corrections_per_second": self.cycles/self._elapsed if self._elapsed else None,
+            "centre": None if self.centre is None else self.centre.tolist(),
+            "last_power": self.last_power,
+            "last_gradient": None if self.last_gradient is None else self.last_gradient.tolist(),
+        }
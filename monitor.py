@@ -0,0 +1,289 @@
+"""
+Background coupling monitor with automatic re-coupling
+
+CouplingMonitor samples the photodiode at a fixed interval and keeps a
+rolling mean. When the mean falls below the re-coupling threshold
+(P_thr in with_control.py) it runs a local optimization warm-started from
+the current mirror pose, then goes back to monitoring. Hysteresis keeps it
+from re-triggering on a mean hovering around the threshold: after a
+re-coupling the mean has to recover above the release level first.
+
+Example:
+
+    >>> monitor = CouplingMonitor(controller, lj, input_channel=2,
+    ...                           threshold=0.85*3.14, goal=0.9*3.14)
+    >>> monitor.start()
+    >>> monitor.status()
+    >>> monitor.stop()
+"""
+
+import threading
+import time
+import traceback
+from collections import deque
+
+from alignment_state import AlignmentState, load_state, save_state, warm_start
+from beam_walk import make_whitened_optimizer
+from evaluation import AdaptiveEvaluator, HardwareObjective
+from optimizers import make_optimizer, minimize
+
+MONITORING = "monitoring"
+RECOUPLING = "recoupling"
+STOPPED = "stopped"
+ERROR = "error"
+
+
+class CouplingMonitor(object):
+    """Watch the coupled power and re-couple when it drops
+
+    Runs in its own thread with start()/stop(), or call poll() repeatedly to
+    drive it from a loop, e.g. on a simulated clock.
+    """
+
+    def __init__(self, controller, lj, input_channel, threshold, goal,
+                 release=None, window=20, sample_interval=0.05,
+                 retry_interval=10., algorithm="nelder-mead", step=10.,
+                 max_iter=50, optimizer_kwargs=None, evaluator=None,
+                 settle_time=0.05, state_path=None, telemetry=None, health=None,
+                 cache=None, walk=None, clock=time):
+        """
+        Args:
+            controller (Controller): Picomotor controller driving the mirrors
+            lj (LabJackAnalog): LabJack reading the photodiode
+            input_channel (int or str): Photodiode analog input
+            threshold (float): Re-couple when the rolling mean drops below
+                this power
+            goal (float): Power the re-coupling optimization aims for
+            release (float): Rolling mean needed to re-arm the trigger after
+                a re-coupling, threshold if None
+            window (int): Samples in the rolling mean
+            sample_interval (float): Seconds between samples
+            retry_interval (float): Seconds to wait after a re-coupling that
+                didn't reach the release level before trying again
+            algorithm (str): Optimizer from optimizers.OPTIMIZERS
+            step (float): Initial step of the local optimization, small since
+                it starts close to the optimum. In whitened units if walk is
+                given
+            max_iter (int): Iteration limit of the local optimization
+            optimizer_kwargs (dict): Further optimizer parameters
+            evaluator (AdaptiveEvaluator): Takes the samples and is used by
+                the optimization, a default one on lj and input_channel if
+                None
+            settle_time (float): Passed on to Controller.move_all
+            state_path (str): Alignment state file, see alignment_state. If
+                given, every re-coupling warm-starts from it and updates it
+            telemetry (TelemetryWriter): Records every sample and every
+                re-coupling evaluation, use one with max_bytes set for long
+                runs
+            health (ControllerHealthMonitor): If given, re-couplings start
+                from its cached positions and wait on its motion done
+                snapshot instead of querying the controller
+            cache (EvaluationCache): Used by the optimization, cleared at the
+                start of every re-coupling since the drift that triggered it
+                made the old scores stale
+            walk (BeamWalk): If given, re-couplings search in its whitened
+                coordinates instead of along the motor axes
+            clock: Provides time() and sleep(), the time module or a
+                simulated clock
+        """
+        self.controller = controller
+        self.lj = lj
+        self.input_channel = input_channel
+        self.threshold = threshold
+        self.goal = goal
+        self.release = threshold if release is None else release
+        self.sample_interval = sample_interval
+        self.retry_interval = retry_interval
+        self.algorithm = algorithm
+        self.step = step
+        self.max_iter = max_iter
+        self.optimizer_kwargs = optimizer_kwargs or {}
+        self.evaluator = evaluator or AdaptiveEvaluator(lj, input_channel)
+        self.settle_time = settle_time
+        self.state_path = state_path
+        self.telemetry = telemetry
+        self.health = health
+        self.cache = cache
+        self.walk = walk
+        self.clock = clock
+
+        self.state = STOPPED
+        self.armed = True
+        self.samples = 0
+        self.recouplings = 0
+        self.failed_recouplings = 0
+        self.errors = 0
+        self.last_power = None
+        self.last_result = None
+        self.last_recoupling_time = None
+        self.last_error = None
+
+        self._window = deque(maxlen=window)
+        self._sum = 0.
+        self._retry_at = None
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    @property
+    def rolling_mean(self):
+        if not self._window:
+            return None
+        return self._sum / len(self._window)
+
+    def _add_sample(self, power):
+        if len(self._window) == self._window.maxlen:
+            self._sum -= self._window[0]
+        self._window.append(power)
+        self._sum += power
+        self.samples += 1
+        self.last_power = power
+
+    def _reset_window(self):
+        self._window.clear()
+        self._sum = 0.
+
+    def poll(self):
+        """Take one sample and re-couple if needed
+
+        Returns:
+            result (OptimizationResult): If a re-coupling ran, otherwise None
+        """
+        start = self.clock.time()
+        power = self.evaluator.sample()
+        if self.telemetry is not None:
+            self.telemetry.record("monitor", (), power,
+                                  read_latency=self.clock.time() - start)
+        with self._lock:
+            self._add_sample(power)
+            if self.state in (STOPPED, ERROR):
+                self.state = MONITORING
+            full = len(self._window) == self._window.maxlen
+            mean = self.rolling_mean
+
+        if not full:
+            return None
+        if not self.armed:
+            # hysteresis: wait for the mean to recover before re-arming
+            if mean >= self.release:
+                self.armed = True
+            elif self._retry_at is not None and self.clock.time() >= self._retry_at:
+                self.armed = True
+            return None
+        if mean < self.threshold:
+            return self.recouple()
+        return None
+
+    def recouple(self):
+        """Run a local optimization from the current mirror pose
+
+        Returns:
+            result (OptimizationResult)
+        """
+        with self._lock:
+            self.state = RECOUPLING
+        if self.health is not None:
+            x0 = self.health.positions()
+        else:
+            x0 = self.controller.get_positions()
+        step = self.step
+        optimizer_kwargs = dict(self.optimizer_kwargs)
+        state = load_state(self.state_path) if self.state_path else None
+        if state is not None:
+            step, initial_simplex = warm_start(state, x0, max_step=self.step,
+                                               walk=self.walk)
+            if initial_simplex is not None and self.algorithm == "nelder-mead":
+                optimizer_kwargs["initial_simplex"] = initial_simplex
+
+        if self.walk is None:
+            optimizer = make_optimizer(
+                self.algorithm, x0, step, max_iter=self.max_iter,
+                goal=-self.goal, **optimizer_kwargs
+            )
+        else:
+            optimizer = make_whitened_optimizer(
+                self.walk, self.algorithm, x0, step, max_iter=self.max_iter,
+                goal=-self.goal, **optimizer_kwargs
+            )
+        if self.cache is not None:
+            self.cache.clear()
+        objective = HardwareObjective(self.controller, self.evaluator, cache=self.cache,
+                                      health=self.health, settle_time=self.settle_time)
+        result = minimize(optimizer, objective, clock=self.clock,
+                          telemetry=self.telemetry)
+        self.controller.move_all(result.x, settle_time=self.settle_time,
+                                 health=self.health)
+        if self.state_path:
+            save_state(self.state_path,
+                       AlignmentState.from_run(result, optimizer, self.evaluator))
+
+        with self._lock:
+            self.recouplings += 1
+            self.last_result = result
+            self.last_recoupling_time = self.clock.time()
+            if -result.score < self.release:
+                self.failed_recouplings += 1
+                self._retry_at = self.clock.time() + self.retry_interval
+            else:
+                self._retry_at = None
+            self.armed = False
+            self._reset_window()
+            self.state = MONITORING
+        return result
+
+    def run(self):
+        """Monitor until stop() is called"""
+        while not self._stop_event.is_set():
+            try:
+                self.poll()
+            except Exception as e:
+                with self._lock:
+                    self.errors += 1
+                    self.last_error = ''.join(
+                        traceback.format_exception_only(type(e), e)).strip()
+                    self.state = ERROR
+            self.clock.sleep(self.sample_interval)
+        self._stop_event.clear()
+        with self._lock:
+            self.state = STOPPED
+
+    def start(self):
+        """Monitor in a background thread"""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self.run, name="CouplingMonitor")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        """Stop the background thread, after a running re-coupling finishes"""
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def status(self):
+        """Snapshot of the state and counters for a supervisor
+
+        Returns:
+            status (dict)
+        """
+        with self._lock:
+            result = self.last_result
+            return {
+                "state": self.state,
+                "armed": self.armed,
+                "samples": self.samples,
+                "rolling_mean": self.rolling_mean,
+                "last_power": self.last_power,
+                "threshold": self.threshold,
+                "release": self.release,
+                "recouplings": self.recouplings,
+                "failed_recouplings": self.failed_recouplings,
+                "errors": self.errors,
+                "last_error": self.last_error,
+                "last_recoupling_time": self.last_recoupling_time,
+                "last_recoupling_evaluations": result.evaluations if result else None,
+                "last_recoupling_power": -result.score if result else None,
+            }
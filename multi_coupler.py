@@ -0,0 +1,198 @@
+"""
+Parallel alignment of several fiber couplers
+
+Each Coupler bundles the motors steering one beam, the photodiode behind
+its fiber and the optimizer aligning it. The motors can be on their own
+controller, picked by serial number, on a controller daisy-chained behind
+another one (Controller.at_address), or a subset of the axes of a shared
+controller. align_couplers drives all the optimizers in lockstep through
+their ask/tell interface: every round it starts one move per coupler, waits
+once for all the motors, which run at the same time, then reads each
+coupler's photodiode. The moves dominate an evaluation, so the total time
+follows the slowest coupler rather than the sum of all of them. All reads
+happen in the calling thread, so the couplers can share one LabJack
+handle.
+
+Example:
+
+    >>> lj = LabJackAnalog(identifier="ANY")
+    >>> left = Controller(0x4000, 0x104d, serial_number=find_controllers()[0])
+    >>> right = left.at_address(2)
+    >>> couplers = [
+    ...     Coupler("left", left, AdaptiveEvaluator(lj, 2),
+    ...             NelderMead([0, 0, 0, 0], 50, goal=-0.9*3.14)),
+    ...     Coupler("right", right, AdaptiveEvaluator(lj, 3),
+    ...             NelderMead([0, 0, 0, 0], 50, goal=-0.9*2.5)),
+    ... ]
+    >>> results = align_couplers(couplers)
+    >>> results["left"].x
+"""
+
+from optimizers import Evaluation, History, OptimizationResult
+
+
+class Coupler(object):
+    """One coupler's hardware and optimizer
+
+    Like HardwareObjective it keeps last_measurement, last_move_latency and
+    last_read_latency, so a TelemetryWriter can record its evaluations.
+    """
+
+    def __init__(self, name, controller, evaluator, optimizer, axes=(1, 2, 3, 4),
+                 telemetry=None):
+        """
+        Args:
+            name (str): Key of this coupler's result
+            controller (Controller): Controller driving its mirrors
+            evaluator (AdaptiveEvaluator): Reads its photodiode
+            optimizer (Optimizer): Fresh optimizer, one coordinate per axis
+            axes (iterable): Motor numbers of the optimizer's coordinates
+            telemetry (TelemetryWriter): Records every evaluation of this
+                coupler
+        """
+        self.name = name
+        self.controller = controller
+        self.evaluator = evaluator
+        self.optimizer = optimizer
+        self.axes = tuple(axes)
+        self.telemetry = telemetry
+        self.history = History()
+        self.last_measurement = None
+        self.last_move_latency = None
+        self.last_read_latency = None
+
+        self._poses = []
+        self._scores = []
+        self._phase = None
+        self._iteration = 0
+        self._finished = None
+
+    def _move(self, x=None):
+        """Start the move to x, the next pose if None, without waiting"""
+        if x is None:
+            if len(self._scores) == len(self._poses):
+                self._poses = self.optimizer.ask()
+                self._scores = []
+                self._phase = self.optimizer.phase
+                self._iteration = self.optimizer.iterations
+            x = self._poses[len(self._scores)]
+        self.controller.move_all(dict(zip(self.axes, x)), wait=False)
+
+    def _measure(self, clock, start):
+        """Score the current pose, and tell the optimizer once the batch is
+        complete
+
+        Returns:
+            told (bool): The optimizer was told the batch's scores
+        """
+        x = self._poses[len(self._scores)]
+        read_start = clock.time()
+        references = [-r for r in self.optimizer.references()]
+        self.last_measurement = self.evaluator.measure(references)
+        self.last_read_latency = clock.time() - read_start
+        score = -self.last_measurement.mean
+        self._scores.append(score)
+
+        evaluation = Evaluation(clock.time() - start, x, score, self._phase,
+                                self._iteration)
+        self.history.append(evaluation)
+        if self.telemetry is not None:
+            self.telemetry.record_evaluation(evaluation, self)
+
+        if len(self._scores) < len(self._poses):
+            return False
+        self.optimizer.tell(self._scores)
+        if self.optimizer.done:
+            self._finished = clock.time()
+        return True
+
+    def _result(self, start):
+        optimizer = self.optimizer
+        return OptimizationResult(
+            algorithm=optimizer.name,
+            x=optimizer.best_x,
+            score=optimizer.best_score,
+            evaluations=optimizer.evaluations,
+            iterations=optimizer.iterations,
+            elapsed=(self._finished if self._finished is not None else start) - start,
+            stop_reason=optimizer.stop_reason,
+            history=self.history,
+        )
+
+
+def _moving_axes(couplers):
+    """(controller, axes) pairs, one per controller"""
+    groups = []
+    for coupler in couplers:
+        for controller, axes in groups:
+            if controller is coupler.controller:
+                axes.extend(coupler.axes)
+                break
+        else:
+            groups.append((coupler.controller, list(coupler.axes)))
+    return groups
+
+
+def _wait(couplers, settle_time, poll_interval, timeout):
+    """Wait once for the motors of all couplers, then settle"""
+    # all the motors run at the same time, the round waits for the slowest
+    for controller, axes in _moving_axes(couplers):
+        controller.wait_for_motion_done(sorted(axes), poll_interval=poll_interval,
+                                        timeout=timeout)
+    if settle_time:
+        couplers[0].controller.clock.sleep(settle_time)
+
+
+def align_couplers(couplers, settle_time=0.05, poll_interval=0.01, timeout=30.,
+                   callback=None):
+    """Align several couplers at the same time
+
+    Once every optimizer has stopped, all couplers are moved to their best
+    pose in one more concurrent round, so the mirrors are left at the
+    poses the results report.
+
+    Args:
+        couplers (list): Couplers with fresh optimizers, with distinct
+            names and no motor shared between two of them
+        settle_time (float): Wait after all motors of a round have stopped,
+            before reading the photodiodes
+        poll_interval (float): Seconds between motion done polls
+        timeout (float): Give up on a move after this many seconds
+        callback (callable): Called with the coupler after each of its
+            optimizer's tell()
+
+    Returns:
+        results (dict): Coupler name -> OptimizationResult. elapsed is the
+            time until that coupler's optimizer stopped
+
+    Raises:
+        TimeoutError: if a move doesn't finish within timeout seconds
+    """
+    if not couplers:
+        return {}
+    clock = couplers[0].controller.clock
+    start = clock.time()
+    for coupler in couplers:
+        if coupler.optimizer.done:
+            coupler._finished = start
+
+    active = [coupler for coupler in couplers if not coupler.optimizer.done]
+    while active:
+        round_start = clock.time()
+        for coupler in active:
+            coupler._move()
+        _wait(active, settle_time, poll_interval, timeout)
+        move_latency = clock.time() - round_start
+
+        for coupler in active:
+            coupler.last_move_latency = move_latency
+            if coupler._measure(clock, start) and callback is not None:
+                callback(coupler)
+        active = [coupler for coupler in active if not coupler.optimizer.done]
+
+    best = [coupler for coupler in couplers if coupler.optimizer.best_x is not None]
+    for coupler in best:
+        coupler._move(coupler.optimizer.best_x)
+    if best:
+        _wait(best, settle_time, poll_interval, timeout)
+    return dict((coupler.name, coupler._result(start)) for coupler in couplers)
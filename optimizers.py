@@ -0,0 +1,567 @@
+"""
+Ask/tell optimizers for fiber coupling
+
+The optimizers only propose mirror positions and consume the scores
+measured there, they never touch the hardware. An objective is any
+callable objective(x, references) returning the score at pose x, where
+references are the scores the candidate will be ranked against (used by
+AdaptiveEvaluator to decide how long to average). Scores are minimized,
+so hardware objectives return the negative photodiode power.
+
+Example:
+
+    >>> optimizer = NelderMead(x0=[0, 0, 0, 0], step=50, goal=-0.9*3.14)
+    >>> result = minimize(optimizer, HardwareObjective(controller, evaluator))
+    >>> result.x, result.score, result.evaluations
+
+    or drive the optimizer by hand:
+
+    >>> while not optimizer.done:
+    ...     poses = optimizer.ask()
+    ...     optimizer.tell([objective(x, optimizer.references()) for x in poses])
+"""
+
+import time
+from collections import deque, namedtuple
+
+import numpy as np
+
+from instrumentation import INSTRUMENTATION
+from surrogate import SURROGATE_MODELS, surrogate_optimum
+
+Evaluation = namedtuple("Evaluation", ["time", "x", "score", "phase", "iteration"])
+
+
+class History(object):
+    """Every evaluation of an optimization run, in order"""
+
+    def __init__(self):
+        self.evaluations = []
+
+    def append(self, evaluation):
+        self.evaluations.append(evaluation)
+
+    def __len__(self):
+        return len(self.evaluations)
+
+    def __iter__(self):
+        return iter(self.evaluations)
+
+    def __getitem__(self, index):
+        return self.evaluations[index]
+
+    def times(self):
+        """Time of each evaluation since the start of the run"""
+        return np.array([e.time for e in self.evaluations])
+
+    def positions(self):
+        """Evaluated poses, shape (n_evaluations, dim)"""
+        return np.array([e.x for e in self.evaluations])
+
+    def scores(self):
+        """Score of each evaluation"""
+        return np.array([e.score for e in self.evaluations])
+
+    def best_scores(self):
+        """Best score so far after each evaluation"""
+        return np.minimum.accumulate(self.scores())
+
+    def evaluations_to_reach(self, score):
+        """Number of evaluations until the score was first reached
+
+        Returns:
+            n (int): 1-based evaluation count, None if never reached
+        """
+        hits = np.flatnonzero(self.scores() <= score)
+        if not len(hits):
+            return None
+        return int(hits[0]) + 1
+
+    def time_to_reach(self, score):
+        """Time since the start of the run until the score was first reached
+
+        Returns:
+            t (float): None if the score was never reached
+        """
+        n = self.evaluations_to_reach(score)
+        if n is None:
+            return None
+        return self.evaluations[n - 1].time
+
+
+class OptimizationResult(object):
+    """Outcome of an optimization run"""
+
+    def __init__(self, algorithm, x, score, evaluations, iterations, elapsed,
+                 stop_reason, history):
+        self.algorithm = algorithm
+        self.x = x
+        self.score = score
+        self.evaluations = evaluations
+        self.iterations = iterations
+        self.elapsed = elapsed
+        self.stop_reason = stop_reason
+        self.history = history
+
+    def __repr__(self):
+        return ("OptimizationResult(algorithm={!r}, score={}, evaluations={}, "
+                "iterations={}, elapsed={:.3f}, stop_reason={!r})").format(
+                    self.algorithm, self.score, self.evaluations,
+                    self.iterations, self.elapsed, self.stop_reason)
+
+
+class Optimizer(object):
+    """Base class of the ask/tell optimizers
+
+    ask() returns a list of poses to evaluate, tell() takes their scores in
+    the same order. A batch has more than one pose when the algorithm
+    doesn't need the scores in between, e.g. the initial simplex.
+
+    The run stops after max_iter iterations or max_evaluations evaluations
+    (0 or None disables either), or once the best score has been at or below
+    goal for goal_iterations consecutive iterations.
+    """
+
+    name = None
+
+    def __init__(self, x0, step, max_iter=100, max_evaluations=None,
+                 goal=None, goal_iterations=3):
+        """
+        Args:
+            x0 (array): Starting pose in motor steps
+            step (float): Initial look-around radius in motor steps
+            max_iter (int): Stop after this many iterations
+            max_evaluations (int): Stop after this many evaluations
+            goal (float): Score that counts as coupled
+            goal_iterations (int): Iterations in a row at the goal before
+                stopping
+        """
+        self.x0 = np.array(x0, dtype=float)
+        self.dim = len(self.x0)
+        self.step = float(step)
+        self.max_iter = max_iter
+        self.max_evaluations = max_evaluations
+        self.goal = goal
+        self.goal_iterations = goal_iterations
+
+        self.iterations = 0
+        self.evaluations = 0
+        self.best_x = None
+        self.best_score = np.inf
+        self.phase = None
+        self.done = False
+        self.stop_reason = None
+        self._pending = None
+        self._goal_count = 0
+
+    def ask(self):
+        """Poses to evaluate next
+
+        Returns:
+            poses (list): Arrays of motor positions
+        """
+        if self.done:
+            raise RuntimeError("{} optimizer is done ({})".format(
+                self.name, self.stop_reason))
+        if self._pending is None:
+            self._pending = [np.array(x, dtype=float) for x in self._ask()]
+        return list(self._pending)
+
+    def tell(self, scores):
+        """Report the scores of the poses returned by the last ask()
+
+        Args:
+            scores (list): One score per pose, lower is better
+        """
+        poses = self._pending
+        if poses is None or len(scores) != len(poses):
+            raise ValueError("Expected {} scores for the last ask()".format(
+                0 if poses is None else len(poses)))
+        self._pending = None
+
+        for x, score in zip(poses, scores):
+            self.evaluations += 1
+            if score < self.best_score:
+                self.best_x = x
+                self.best_score = score
+        self._tell(poses, [float(s) for s in scores])
+
+        if (not self.done and self.max_evaluations
+                and self.evaluations >= self.max_evaluations):
+            self._stop("max_evaluations")
+
+    def references(self):
+        """Scores the next candidate will be ranked against"""
+        return []
+
+    def _ask(self):
+        raise NotImplementedError
+
+    def _tell(self, poses, scores):
+        raise NotImplementedError
+
+    def _end_iteration(self):
+        """Book-keeping shared by all algorithms after a completed iteration"""
+        if self.max_iter and self.iterations >= self.max_iter:
+            self._stop("max_iter")
+            return
+        self.iterations += 1
+
+        if self.goal is not None:
+            if self.best_score <= self.goal:
+                self._goal_count += 1
+            else:
+                self._goal_count = 0
+            if self._goal_count >= self.goal_iterations:
+                self._stop("goal")
+
+    def _stop(self, reason):
+        self.done = True
+        self.stop_reason = reason
+
+
+class NelderMead(Optimizer):
+    """Nelder-Mead simplex search
+
+    Same steps as the original with_control.py loop: the initial simplex is
+    x0 plus one vertex step away along each axis, followed by reflection,
+    expansion, contraction and reduction. One iteration is one of those
+    steps. ask() returns the whole initial simplex and the whole reduced
+    simplex as a single batch.
+
+    With a surrogate model, each iteration first fits it to the recent
+    evaluations and, if the fit is trustworthy, tries its predicted optimum
+    (phase "surrogate"). A success replaces the worst vertex and ends the
+    iteration. Otherwise the iteration goes on with the reflection, and the
+    surrogate waits for dim + 1 new evaluations before it is tried again.
+    """
+
+    name = "nelder-mead"
+
+    def __init__(self, x0, step, alpha=1., gamma=2., rho=-0.5, sigma=0.5,
+                 initial_simplex=None, surrogate=None, surrogate_window=40,
+                 surrogate_kwargs=None, **kwargs):
+        """
+        Args:
+            alpha, gamma, rho, sigma (float): Reflection, expansion,
+                contraction and reduction parameters
+            initial_simplex (array): dim + 1 vertices to start from instead of
+                the axis aligned simplex around x0, e.g. the final simplex of
+                an earlier run
+            surrogate (str): Surrogate model, "gaussian" or "quadratic", see
+                surrogate.surrogate_optimum. None for plain Nelder-Mead
+            surrogate_window (int): Most recent evaluations the surrogate is
+                fitted to
+            surrogate_kwargs (dict): Further surrogate_optimum parameters
+            **kwargs: x0, step and the stopping criteria of Optimizer
+        """
+        super(NelderMead, self).__init__(x0, step, **kwargs)
+        if surrogate is not None and surrogate not in SURROGATE_MODELS:
+            raise ValueError("Unknown surrogate model {!r}, choose from {}".format(
+                surrogate, ", ".join(SURROGATE_MODELS)))
+        self.alpha = alpha
+        self.gamma = gamma
+        self.rho = rho
+        self.sigma = sigma
+        self.initial_simplex = None
+        if initial_simplex is not None:
+            self.initial_simplex = np.array(initial_simplex, dtype=float)
+            if self.initial_simplex.shape != (self.dim + 1, self.dim):
+                raise ValueError("initial_simplex must have shape ({}, {})".format(
+                    self.dim + 1, self.dim))
+
+        # simplex as a list of [x, score], sorted best first
+        self.simplex = []
+        self._centroid = None
+        self._reflected = None
+
+        self.surrogate = surrogate
+        self.surrogate_kwargs = surrogate_kwargs or {}
+        self.surrogate_steps = 0
+        self.surrogate_successes = 0
+        self._evaluated = deque(maxlen=surrogate_window)
+        self._surrogate_wait = 0
+
+    def _surrogate_pose(self):
+        """Predicted optimum of the surrogate, None to do a simplex step"""
+        if self.surrogate is None or self._surrogate_wait > 0:
+            return None
+        poses = np.array([x for x, _ in self._evaluated])
+        scores = np.array([s for _, s in self._evaluated])
+        x = surrogate_optimum(poses, scores, self.surrogate, **self.surrogate_kwargs)
+        # a pose on the same steps as the best vertex gains nothing
+        if x is None or np.max(np.abs(x - self.simplex[0][0])) < 1:
+            return None
+        return x
+
+    def _ask(self):
+        if self.phase is None:
+            self.phase = "init"
+            if self.initial_simplex is not None:
+                return list(self.initial_simplex)
+            poses = [self.x0]
+            for i in range(self.dim):
+                x = self.x0.copy()
+                x[i] += self.step
+                poses.append(x)
+            return poses
+
+        worst = self.simplex[-1][0]
+        if self.phase == "reflect":
+            x = self._surrogate_pose()
+            if x is not None:
+                self.phase = "surrogate"
+                self.surrogate_steps += 1
+                return [x]
+            self._centroid = np.mean([x for x, _ in self.simplex[:-1]], axis=0)
+            return [self._centroid + self.alpha*(self._centroid - worst)]
+        if self.phase == "expand":
+            return [self._centroid + self.gamma*(self._centroid - worst)]
+        if self.phase == "contract":
+            return [self._centroid + self.rho*(self._centroid - worst)]
+        if self.phase == "reduce":
+            x1 = self.simplex[0][0]
+            return [x1 + self.sigma*(x - x1) for x, _ in self.simplex]
+
+    def _tell(self, poses, scores):
+        if self.surrogate is not None:
+            self._evaluated.extend(zip(poses, scores))
+            self._surrogate_wait -= len(poses)
+
+        if self.phase == "init":
+            self.simplex = [[x, s] for x, s in zip(poses, scores)]
+            return self._next_iteration()
+
+        if self.phase == "reduce":
+            self.simplex = [[x, s] for x, s in zip(poses, scores)]
+            return self._next_iteration()
+
+        x, score = poses[0], scores[0]
+        if self.phase == "surrogate":
+            if score < self.simplex[-1][1]:
+                self.surrogate_successes += 1
+                self.simplex[-1] = [x, score]
+                return self._next_iteration()
+            self._surrogate_wait = self.dim + 1
+            self.phase = "reflect"
+            return
+
+        if self.phase == "reflect":
+            # if new score lays between best and second worst, keep it
+            if self.simplex[0][1] <= score < self.simplex[-2][1]:
+                self.simplex[-1] = [x, score]
+                return self._next_iteration()
+            if score < self.simplex[0][1]:
+                self._reflected = [x, score]
+                self.phase = "expand"
+            else:
+                self.phase = "contract"
+            return
+
+        if self.phase == "expand":
+            # keep the better of the expanded and the reflected point
+            if score < self._reflected[1]:
+                self.simplex[-1] = [x, score]
+            else:
+                self.simplex[-1] = self._reflected
+            return self._next_iteration()
+
+        if self.phase == "contract":
+            if score < self.simplex[-1][1]:
+                self.simplex[-1] = [x, score]
+                return self._next_iteration()
+            self.phase = "reduce"
+
+    def _next_iteration(self):
+        self.simplex.sort(key=lambda v: v[1])
+        self.phase = "reflect"
+        self._end_iteration()
+
+    def references(self):
+        if self.phase == "expand":
+            return [self._reflected[1]]
+        if self.phase == "contract":
+            return [self.simplex[-1][1]]
+        return [s for _, s in self.simplex]
+
+
+class PatternSearch(Optimizer):
+    """Compass (coordinate pattern) search
+
+    Polls x +- step along one axis at a time and moves as soon as a poll
+    improves the score, repeating a successful direction. After a full
+    round of 2*dim failed polls the step is multiplied by shrink, and the
+    run stops once it falls below min_step. One iteration is one poll.
+    """
+
+    name = "pattern"
+
+    def __init__(self, x0, step, shrink=0.5, min_step=1., **kwargs):
+        """
+        Args:
+            shrink (float): Step reduction factor after a failed round
+            min_step (float): Stop once the step is smaller than this, in
+                motor steps
+            **kwargs: x0, step and the stopping criteria of Optimizer
+        """
+        super(PatternSearch, self).__init__(x0, step, **kwargs)
+        self.shrink = shrink
+        self.min_step = min_step
+
+        self.x = self.x0.copy()
+        self.score = None
+        self.current_step = self.step
+        self._directions = [(i, sign) for i in range(self.dim) for sign in (1, -1)]
+        self._index = 0
+        self._failures = 0
+
+    def _ask(self):
+        if self.score is None:
+            self.phase = "init"
+            return [self.x]
+        self.phase = "poll"
+        axis, sign = self._directions[self._index]
+        x = self.x.copy()
+        x[axis] += sign*self.current_step
+        return [x]
+
+    def _tell(self, poses, scores):
+        x, score = poses[0], scores[0]
+        if self.phase == "init":
+            self.score = score
+            return self._end_iteration()
+
+        if score < self.score:
+            self.x, self.score = x, score
+            self._failures = 0
+        else:
+            self._index = (self._index + 1) % len(self._directions)
+            self._failures += 1
+            if self._failures >= len(self._directions):
+                self._failures = 0
+                self.current_step *= self.shrink
+                if self.current_step < self.min_step:
+                    return self._stop("min_step")
+        self._end_iteration()
+
+    def references(self):
+        return [] if self.score is None else [self.score]
+
+
+class SPSA(Optimizer):
+    """Simultaneous perturbation stochastic approximation
+
+    Each iteration evaluates x +- c_k*delta for a random +-1 vector delta and
+    steps against the resulting gradient estimate, so the cost per
+    iteration is two evaluations whatever the dimension. Gains follow
+    a_k = a/(k + 1 + A)**0.602 and c_k = c/(k + 1)**0.101. If a is not
+    given, it is set from the first gradient estimate so that the first
+    move is about step long. Moves are clipped to step per axis so that a
+    single noisy estimate can't throw the beam off the fiber.
+    """
+
+    name = "spsa"
+
+    def __init__(self, x0, step, a=None, c=None, A=None, seed=None, **kwargs):
+        """
+        Args:
+            a (float): Step gain, calibrated on the first iteration if None
+            c (float): Perturbation size in motor steps, step/2 if None
+            A (float): Stability constant, a tenth of max_iter if None
+            seed (int): Seed of the perturbation generator
+            **kwargs: x0, step and the stopping criteria of Optimizer
+        """
+        super(SPSA, self).__init__(x0, step, **kwargs)
+        self.a = a
+        self.c = self.step / 2. if c is None else c
+        self.A = (0.1*(self.max_iter or 100)) if A is None else A
+        self.rng = np.random.default_rng(seed)
+
+        self.x = self.x0.copy()
+        self._delta = None
+        self._ck = None
+
+    def _ask(self):
+        self.phase = "perturb"
+        k = self.iterations
+        self._ck = self.c / (k + 1)**0.101
+        self._delta = self.rng.choice([-1., 1.], size=self.dim)
+        return [self.x + self._ck*self._delta, self.x - self._ck*self._delta]
+
+    def _tell(self, poses, scores):
+        gradient = (scores[0] - scores[1]) / (2*self._ck*self._delta)
+        largest = np.max(np.abs(gradient))
+        if self.a is None and largest > 0:
+            self.a = self.step * (self.A + 1)**0.602 / largest
+        if self.a is not None:
+            ak = self.a / (self.iterations + 1 + self.A)**0.602
+            self.x = self.x - np.clip(ak*gradient, -self.step, self.step)
+        self._end_iteration()
+
+
+OPTIMIZERS = {
+    NelderMead.name: NelderMead,
+    PatternSearch.name: PatternSearch,
+    SPSA.name: SPSA,
+}
+
+
+def make_optimizer(algorithm, x0, step, **kwargs):
+    """Create an optimizer by name, one of OPTIMIZERS"""
+    try:
+        cls = OPTIMIZERS[algorithm]
+    except KeyError:
+        raise ValueError("Unknown algorithm {!r}, choose from {}".format(
+            algorithm, ', '.join(sorted(OPTIMIZERS))))
+    return cls(x0, step, **kwargs)
+
+
+def minimize(optimizer, objective, clock=time, callback=None, telemetry=None,
+             scheduler=None):
+    """Run an optimizer against an objective until it stops
+
+    Args:
+        optimizer (Optimizer): Fresh optimizer
+        objective (callable): objective(x, references) -> score
+        clock: Provides time(), the time module or a simulated clock
+        callback (callable): Called with the optimizer after every tell()
+        telemetry (TelemetryWriter): Records every evaluation as it happens
+        scheduler (MotionScheduler): Picks the order in which the poses of
+            a batch are evaluated. The optimizer is told the scores in the
+            order it asked for them either way
+
+    Returns:
+        OptimizationResult
+    """
+    history = History()
+    start = clock.time()
+    while not optimizer.done:
+        poses = optimizer.ask()
+        phase = optimizer.phase
+        if INSTRUMENTATION.enabled:
+            INSTRUMENTATION.set_phase(phase)
+        iteration = optimizer.iterations
+        scores = [None]*len(poses)
+        order = range(len(poses)) if scheduler is None else scheduler.order(poses)
+        for i in order:
+            x = poses[i]
+            score = objective(x, optimizer.references())
+            scores[i] = score
+            evaluation = Evaluation(clock.time() - start, x, score, phase, iteration)
+            history.append(evaluation)
+            if telemetry is not None:
+                telemetry.record_evaluation(evaluation, objective)
+        optimizer.tell(scores)
+        if callback is not None:
+            callback(optimizer)
+
+    return OptimizationResult(
+        algorithm=optimizer.name,
+        x=optimizer.best_x,
+        score=optimizer.best_score,
+        evaluations=optimizer.evaluations,
+        iterations=optimizer.iterations,
+        elapsed=clock.time() - start,
+        stop_reason=optimizer.stop_reason,
+        history=history,
+    )
@@ -0,0 +1,218 @@
+"""
+Motion-aware ordering of the poses of a batch
+
+Nelder-Mead asks for its whole initial and reduced simplex at once, and
+the other optimizers ask for several poses per iteration too. The scores
+only go back to the optimizer once the whole batch is measured, so the
+order in which the hardware visits the poses is free. MotionScheduler
+picks the order that takes the least motor time, estimated from the
+trapezoidal velocity profile of every axis (its VA and AC settings) plus a
+penalty for every change of direction, which costs backlash. The axes of a
+move run in parallel, so a move takes as long as its slowest axis. Poses
+an EvaluationCache will answer don't move the motors and go first.
+
+minimize evaluates a batch in the scheduler's order and tells the
+optimizer the scores in the order it asked for them, so the optimization
+itself is unchanged.
+
+Example:
+
+    >>> scheduler = MotionScheduler(controller)
+    >>> result = minimize(optimizer, objective, scheduler=scheduler)
+"""
+
+import itertools
+
+import numpy as np
+
+from fly_scan import move_duration
+
+
+class MotionCostModel(object):
+    """Seconds the motors need to get from one pose to another"""
+
+    def __init__(self, velocity, acceleration, reversal_time=0.):
+        """
+        Args:
+            velocity (array): Steps per second of each axis (VA)
+            acceleration (array): Steps per second squared of each axis (AC)
+            reversal_time (float or array): Seconds added for every change of
+                direction of an axis, about its backlash over its velocity
+        """
+        self.velocity = np.asarray(velocity, dtype=float)
+        self.acceleration = np.asarray(acceleration, dtype=float)
+        self.reversal_time = np.broadcast_to(
+            np.asarray(reversal_time, dtype=float), self.velocity.shape)
+
+    @classmethod
+    def from_controller(cls, controller, axes=(1, 2, 3, 4), reversal_time=0.):
+        """Cost model with the current VA and AC settings of axes"""
+        axes = list(axes)
+        replies = controller.query_pipelined(
+            ["{}VA?".format(axis) for axis in axes]
+            + ["{}AC?".format(axis) for axis in axes])
+        values = [int(reply) for reply in replies]
+        return cls(values[:len(axes)], values[len(axes):], reversal_time)
+
+    def move_time(self, start, end, directions=None):
+        """Seconds for the move from start to end
+
+        Args:
+            start, end (array): Poses, one coordinate per axis
+            directions (array): Direction (1, -1 or 0 if unknown) of each
+                axis' last move
+
+        Returns:
+            (seconds, directions): Duration of the move and the directions
+                of the axes after it
+        """
+        delta = np.asarray(end, dtype=float) - np.asarray(start, dtype=float)
+        step = np.sign(np.round(delta))
+        if directions is None:
+            directions = np.zeros(len(delta))
+        times = [move_duration(d, v, a) if s else 0.
+                 for d, v, a, s in zip(delta, self.velocity, self.acceleration, step)]
+        times = np.array(times) + self.reversal_time*((step*directions) < 0)
+        return float(np.max(times, initial=0.)), np.where(step != 0, step, directions)
+
+    def path_time(self, start, poses, directions=None):
+        """Seconds to visit poses in order, starting at start
+
+        Returns:
+            (seconds, directions): As for move_time, after the last pose
+        """
+        total = 0.
+        for pose in poses:
+            seconds, directions = self.move_time(start, pose, directions)
+            total += seconds
+            start = pose
+        return total, directions
+
+
+def order_poses(start, poses, cost, directions=None, max_exhaustive=7):
+    """Visiting order of poses that takes the least motion time
+
+    Every order is tried for up to max_exhaustive poses, larger batches are
+    ordered greedily by the nearest next pose in time.
+
+    Args:
+        start (array): Current pose
+        poses (list): Poses to visit
+        cost (MotionCostModel): Motion time model
+        directions (array): Direction of each axis' last move, see
+            MotionCostModel.move_time
+        max_exhaustive (int): Largest batch searched exhaustively
+
+    Returns:
+        order (list): Indices into poses
+    """
+    n = len(poses)
+    if n < 2:
+        return list(range(n))
+    if n <= max_exhaustive:
+        return list(min(
+            itertools.permutations(range(n)),
+            key=lambda order: cost.path_time(start, [poses[i] for i in order],
+                                             directions)[0]))
+
+    order = []
+    remaining = list(range(n))
+    while remaining:
+        times = [cost.move_time(start, poses[i], directions) for i in remaining]
+        best = int(np.argmin([seconds for seconds, _ in times]))
+        directions = times[best][1]
+        start = poses[remaining[best]]
+        order.append(remaining.pop(best))
+    return order
+
+
+class MotionScheduler(object):
+    """Orders the batches of an optimizer for a controller's motors
+
+    Keeps track of the pose and move directions the last batch left the
+    motors in, so they are only read from the controller once.
+    """
+
+    def __init__(self, controller, axes=None, cost=None, reversal_time=0.02,
+                 max_exhaustive=7, cache=None):
+        """
+        Args:
+            controller (Controller): Controller driving the mirrors, as
+                passed to HardwareObjective
+            axes (iterable): Motor numbers the pose coordinates drive, motors
+                1 to len(x) if None, as in HardwareObjective
+            cost (MotionCostModel): Read from the controller's VA and AC
+                settings on first use if None
+            reversal_time (float): Seconds charged for a change of direction
+                when the cost model is read from the controller
+            max_exhaustive (int): See order_poses
+            cache (EvaluationCache): The cache of the objective, if it has
+                one
+        """
+        self.controller = controller
+        self.axes = None if axes is None else tuple(axes)
+        self.cost = cost
+        self.reversal_time = reversal_time
+        self.max_exhaustive = max_exhaustive
+        self.cache = cache
+
+        self.batches = 0
+        self.planned_time = 0.
+        self.unordered_time = 0.
+        self._pose = None
+        self._directions = None
+
+    def order(self, poses):
+        """Visiting order of a batch
+
+        Args:
+            poses (list): Poses asked for by the optimizer
+
+        Returns:
+            order (list): Indices into poses
+        """
+        if not len(poses):
+            return []
+        axes = self.axes or tuple(range(1, len(poses[0]) + 1))
+        if self.cost is None:
+            self.cost = MotionCostModel.from_controller(self.controller, axes,
+                                                        self.reversal_time)
+        if self._pose is None:
+            self._pose = np.array(self.controller.get_positions(axes), dtype=float)
+
+        cached = []
+        if self.cache is not None:
+            cached = [i for i, x in enumerate(poses) if x in self.cache]
+        moves = [i for i in range(len(poses)) if i not in cached]
+        if not moves:
+            return cached
+        visits = [poses[i] for i in moves]
+        order = [moves[i] for i in order_poses(self._pose, visits, self.cost,
+                                               self._directions, self.max_exhaustive)]
+        planned, directions = self.cost.path_time(
+            self._pose, [poses[i] for i in order], self._directions)
+        self.batches += 1
+        self.planned_time += planned
+        self.unordered_time += self.cost.path_time(self._pose, visits, self._directions)[0]
+        self._pose = np.array(poses[order[-1]], dtype=float)
+        self._directions = directions
+        return cached + order
+
+    def reset(self):
+        """Read the pose from the controller again before the next batch,
+        e.g. after the motors were moved by something else"""
+        self._pose = None
+        self._directions = None
+
+    def status(self):
+        """Estimated motion time of the batches in the scheduled order and
+        in the order the optimizer asked for them
+
+        Returns:
+            status (dict)
+        """
+        return {
+            "batches": self.batches,
+            "planned_time": self.planned_time,
+            "unordered_time": self.unordered_time,
+        }
@@ -0,0 +1,779 @@
+"""
+Offline stand-ins for the picomotor controller and the LabJack
+
+SimulatedPicomotorDevice replaces the usb.core device found by
+Controller._connect and speaks the 8742 command set over fake endpoints.
+SimulatedLJM replaces the labjack ljm module used by LabJackAnalog.
+CouplingModel computes the power coupled into the fiber from the physical
+mirror pose. Everything runs on a VirtualClock, so waiting for a move or
+for stream data advances simulated time instead of sleeping, and thousands
+of alignment runs finish in seconds.
+
+Example:
+
+    >>> bench = SimulatedBench(misalignment=[120, -80, 60, 30], seed=1)
+    >>> bench.controller.move_all([100, -50, 50, 0])
+    >>> bench.lj.analog_in(2)
+    >>> bench.clock.time()
+"""
+
+import array
+import math
+import re
+
+import numpy as np
+import usb.core
+from labjack import ljm
+
+from New_Focus_8742 import Controller
+from LabJackAnalog import LabJackAnalog
+
+SIMULATED_COMMAND_REGEX = re.compile(
+    r"\s*(?:([0-9]+)>)?\s*([0-9]?)\s*([A-Za-z]+\??)\s*([+-]?[0-9]*)\s*$"
+)
+ERROR_MESSAGES = {
+    0: "NO ERROR DETECTED",
+    6: "COMMAND DOES NOT EXIST",
+    7: "PARAMETER OUT OF RANGE",
+    9: "AXIS NUMBER OUT OF RANGE",
+}
+
+
+class VirtualClock(object):
+    """Simulated time with the time() and sleep() interface of the time
+    module"""
+
+    def __init__(self, start=0.):
+        self.now = float(start)
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        if seconds > 0:
+            self.now += seconds
+
+    def advance_to(self, t):
+        """Move time forward to t, never backward"""
+        self.now = max(self.now, t)
+
+
+class SimulatedMotor(object):
+    """One open-loop picomotor
+
+    The step counter (what TP? reports) follows a trapezoidal velocity
+    profile. The physical position it drives differs from the counter by
+    the direction dependent step size, backlash after every reversal and a
+    random step size jitter, like a real picomotor.
+    """
+
+    def __init__(self, clock, motor_type="3", velocity=2000, acceleration=100000,
+                 forward_scale=1., reverse_scale=1., backlash=0, nonuniformity=0.,
+                 rng=None):
+        """
+        Args:
+            clock (VirtualClock): Time base
+            motor_type (str): QM? reply, see New_Focus_8742.MOTOR_TYPE
+            velocity (int): Steps per second (VA)
+            acceleration (int): Steps per second squared (AC)
+            forward_scale, reverse_scale (float): Physical displacement of one
+                step in the + and - direction
+            backlash (int): Steps lost after every change of direction
+            nonuniformity (float): Relative standard deviation of the size of
+                a single step
+            rng (numpy.random.Generator): Random source for the jitter
+        """
+        self.clock = clock
+        self.motor_type = motor_type
+        self.velocity = velocity
+        self.acceleration = acceleration
+        self.forward_scale = forward_scale
+        self.reverse_scale = reverse_scale
+        self.backlash = backlash
+        self.nonuniformity = nonuniformity
+        self.rng = np.random.default_rng() if rng is None else rng
+
+        self._t0 = clock.time()
+        self._start = 0.
+        self._distance = 0.
+        # VA and AC take effect on the next move, not the current one
+        self._velocity = float(velocity)
+        self._acceleration = float(acceleration)
+        self._direction = 1
+        self._phys_start = 0.
+        self._phys_end = 0.
+        self._slack = 0.
+        self._lost = 0.
+
+        # total steps commanded and number of direction changes
+        self.travel = 0.
+        self.reversals = 0
+
+    def _travel(self, t):
+        """Steps done since the start of the current move at time(s) t"""
+        d, v, a = self._distance, self._velocity, self._acceleration
+        tau = np.asarray(t, dtype=float) - self._t0
+        if d <= v*v/a:
+            t_acc = math.sqrt(d/a)
+            total = 2*t_acc
+            tau = np.clip(tau, 0, total)
+            return np.where(tau < t_acc, 0.5*a*tau**2, d - 0.5*a*(total - tau)**2)
+        t_acc = v/a
+        total = d/v + t_acc
+        tau = np.clip(tau, 0, total)
+        return np.where(
+            tau < t_acc, 0.5*a*tau**2,
+            np.where(tau < total - t_acc, 0.5*v*t_acc + v*(tau - t_acc),
+                     d - 0.5*a*(total - tau)**2))
+
+    def duration(self):
+        """Length of the current move in seconds"""
+        d, v, a = self._distance, self._velocity, self._acceleration
+        if d <= v*v/a:
+            return 2*math.sqrt(d/a)
+        return d/v + v/a
+
+    def counter_at(self, t):
+        return self._start + self._direction*self._travel(t)
+
+    def physical_at(self, t):
+        effective = self._distance - self._lost
+        if effective <= 0:
+            return self._phys_end + 0*np.asarray(t, dtype=float)
+        # the first steps after a reversal only take up the play
+        fraction = np.clip(self._travel(t) - self._lost, 0, None) / effective
+        return self._phys_start + (self._phys_end - self._phys_start)*fraction
+
+    @property
+    def position(self):
+        """Step counter now"""
+        return int(round(float(self.counter_at(self.clock.time()))))
+
+    @property
+    def physical(self):
+        """Physical position now, in nominal steps"""
+        return float(self.physical_at(self.clock.time()))
+
+    def done(self):
+        return self.clock.time() >= self._t0 + self.duration()
+
+    def move_to(self, target):
+        now = self.clock.time()
+        start = float(self.counter_at(now))
+        phys = float(self.physical_at(now))
+        steps = abs(target - start)
+        direction = self._direction
+        if steps:
+            direction = 1 if target > start else -1
+
+        self.travel += steps
+        # take up the mechanical play after a reversal
+        if direction != self._direction:
+            self.reversals += 1
+            self._slack = self.backlash
+        effective = max(0., steps - self._slack)
+        self._slack = max(0., self._slack - steps)
+
+        scale = self.forward_scale if direction > 0 else self.reverse_scale
+        if self.nonuniformity and effective:
+            scale *= 1 + self.nonuniformity*self.rng.normal() / math.sqrt(effective)
+
+        self._t0 = now
+        self._start = start
+        self._distance = steps
+        self._velocity = float(self.velocity)
+        self._acceleration = float(self.acceleration)
+        self._direction = direction
+        self._phys_start = phys
+        self._phys_end = phys + direction*effective*scale
+        self._lost = steps - effective
+
+    def move_relative(self, steps):
+        self.move_to(float(self.counter_at(self.clock.time())) + steps)
+
+    def stop(self):
+        now = self.clock.time()
+        start = float(self.counter_at(now))
+        phys = float(self.physical_at(now))
+        self._t0 = now
+        self._start = start
+        self._distance = 0.
+        self._lost = 0.
+        self._phys_start = self._phys_end = phys
+
+    def set_home(self, position=0):
+        """Redefine the current counter value, the mirror doesn't move"""
+        self.stop()
+        self._start = float(position)
+
+
+class _Endpoint(object):
+    """Fake usb.core.Endpoint"""
+
+    def __init__(self, device, address):
+        self.device = device
+        self.bEndpointAddress = address
+
+    def write(self, data, timeout=None):
+        return self.device._write(data)
+
+    def read(self, size, timeout=None):
+        return self.device._read(size)
+
+
+class SimulatedPicomotorDevice(object):
+    """Stand-in for the 8742 usb.core.Device
+
+    Pass it to Controller(..., dev=device). Understands PA, PR, MV, ST, AB,
+    MD?, TP?, DH, VA, AC, QM?, VE?, ERRSTR?, TE?, SC? and the no-op setup
+    commands, with several commands per line separated by ';'. Every
+    transfer costs usb_latency seconds of simulated time. Commands prefixed
+    with the address of a slave added with add_slave go to that slave.
+    """
+
+    def __init__(self, clock=None, n_motors=4, usb_latency=0.5e-3, seed=None,
+                 serial_number="SIM0", address=1, **motor_kwargs):
+        """
+        Args:
+            clock (VirtualClock): Time base, a new one if None
+            n_motors (int): Motors connected
+            usb_latency (float): Seconds per USB write or read
+            seed (int): Seed of the step size jitter
+            serial_number (str): Reported USB serial number
+            address (int): RS-485 address of this controller
+            **motor_kwargs: Passed on to every SimulatedMotor
+        """
+        self.clock = VirtualClock() if clock is None else clock
+        self.usb_latency = usb_latency
+        self.serial_number = serial_number
+        self.address = address
+        rng = np.random.default_rng(seed)
+        self.motors = dict(
+            (m, SimulatedMotor(self.clock, rng=rng, **motor_kwargs))
+            for m in range(1, n_motors + 1)
+        )
+        self.connected = True
+        self.errors = []
+        self.transfers = 0
+        self.slaves = {}
+        self._replies = bytearray()
+        self._endpoints = [_Endpoint(self, 0x02), _Endpoint(self, 0x81)]
+
+    # usb.core.Device interface used by Controller._connect
+    def set_configuration(self):
+        self._check_connected()
+
+    def get_active_configuration(self):
+        self._check_connected()
+        return {(0, 0): self._endpoints}
+
+    def disconnect(self):
+        """Simulate pulling the USB cable"""
+        self.connected = False
+        del self._replies[:]
+
+    def add_slave(self, address, n_motors=4, seed=None, **motor_kwargs):
+        """Daisy-chain another controller behind this one
+
+        Args:
+            address (int): Its RS-485 address
+            n_motors (int): Motors connected to it
+            seed (int): Seed of its step size jitter
+            **motor_kwargs: Passed on to every SimulatedMotor
+
+        Returns:
+            slave (SimulatedPicomotorDevice): Its motors are in slave.motors
+        """
+        slave = SimulatedPicomotorDevice(
+            self.clock, n_motors=n_motors, usb_latency=0., seed=seed,
+            serial_number=None, address=address, **motor_kwargs
+        )
+        # replies travel back over this controller's USB link
+        slave._replies = self._replies
+        self.slaves[address] = slave
+        return slave
+
+    def reconnect(self):
+        self.connected = True
+
+    def positions(self, t=None):
+        """Physical mirror pose at time(s) t, shape (..., n_motors)"""
+        if t is None:
+            t = self.clock.time()
+        return np.stack(
+            [self.motors[m].physical_at(t) for m in sorted(self.motors)], axis=-1
+        )
+
+    def _check_connected(self):
+        if not self.connected:
+            raise usb.core.USBError("No such device", errno=19)
+
+    def _write(self, data):
+        self._check_connected()
+        self.clock.sleep(self.usb_latency)
+        self.transfers += 1
+        if not isinstance(data, str):
+            data = bytes(data).decode("ascii")
+        for line in data.split('\r'):
+            for command in line.split(';'):
+                if command.strip():
+                    self._execute(command)
+        return len(data)
+
+    def _read(self, size):
+        self._check_connected()
+        self.clock.sleep(self.usb_latency)
+        self.transfers += 1
+        if not self._replies:
+            raise usb.core.USBTimeoutError("Operation timed out", errno=110)
+        reply = self._replies[:size]
+        del self._replies[:size]
+        return array.array('B', reply)
+
+    def _reply(self, value):
+        self._replies.extend("{}\r\n".format(value).encode("ascii"))
+
+    def _error(self, code, axis=None):
+        self.errors.append(code if axis is None else axis*100 + code)
+
+    def _execute(self, command):
+        m = SIMULATED_COMMAND_REGEX.match(command)
+        if not m:
+            return self._error(6)
+        address, axis, mnemonic, parameter = m.groups()
+        if address and int(address) != self.address:
+            slave = self.slaves.get(int(address))
+            if slave is None:
+                return self._error(6)
+            return slave._execute(command.split('>', 1)[1])
+        mnemonic = mnemonic.upper()
+        axis = int(axis) if axis else None
+        if axis is not None and axis not in self.motors:
+            return self._error(9)
+        motors = [self.motors[axis]] if axis else list(self.motors.values())
+        try:
+            value = int(parameter) if parameter.lstrip('+-') else None
+        except ValueError:
+            return self._error(7, axis)
+
+        if mnemonic in ("VE?", "*IDN?"):
+            self._reply("New_Focus 8742 v2.2 08/01/13")
+        elif mnemonic == "SC?":
+            self._reply(sum(1 << a for a in [self.address] + list(self.slaves)))
+        elif mnemonic == "QM?":
+            self._reply(motors[0].motor_type)
+        elif mnemonic == "MD?":
+            self._reply(int(all(motor.done() for motor in motors)))
+        elif mnemonic == "TP?":
+            self._reply(motors[0].position)
+        elif mnemonic == "VA?":
+            self._reply(motors[0].velocity)
+        elif mnemonic == "AC?":
+            self._reply(motors[0].acceleration)
+        elif mnemonic in ("TE?", "ERRSTR?"):
+            code = self.errors.pop(0) if self.errors else 0
+            if mnemonic == "TE?":
+                self._reply(code)
+            else:
+                self._reply("{}, {}".format(code, ERROR_MESSAGES.get(code % 100, "ERROR")))
+        elif mnemonic == "PA" and value is not None and axis:
+            motors[0].move_to(value)
+        elif mnemonic == "PR" and value is not None and axis:
+            motors[0].move_relative(value)
+        elif mnemonic == "MV" and axis:
+            motors[0].move_relative(-10**9 if parameter.startswith('-') else 10**9)
+        elif mnemonic in ("ST", "AB"):
+            for motor in motors:
+                motor.stop()
+        elif mnemonic == "DH":
+            for motor in motors:
+                motor.set_home(value or 0)
+        elif mnemonic == "VA" and value is not None and 1 <= value <= 2000:
+            for motor in motors:
+                motor.velocity = value
+        elif mnemonic == "AC" and value is not None and 1 <= value <= 200000:
+            for motor in motors:
+                motor.acceleration = value
+        elif mnemonic in ("RS", "SM", "RCL", "MC", "SA", "JON", "JOF"):
+            pass
+        elif mnemonic in ("PA", "PR", "MV", "VA", "AC"):
+            self._error(7, axis)
+        else:
+            self._error(6, axis)
+
+
+class CouplingModel(object):
+    """Power coupled into a single mode fiber through two steering mirrors
+
+    Axes 1/2 tilt the far mirror in x/y, axes 3/4 the near mirror. The beam
+    offset and angle at the coupler follow from the lever arms, and the
+    coupled power is the Gaussian mode overlap
+    exp(-offset**2/w0**2 - angle**2/theta0**2) with theta0 = wavelength/(pi w0).
+    The optimal pose drifts linearly and as a random walk, and the source
+    power can wander, both in simulated time.
+    """
+
+    def __init__(self, peak=3.14, optimum=(0., 0., 0., 0.), step_angle=1.4e-6,
+                 lever_arms=(0.4, 0.1), waist=1e-3, wavelength=1.1e-6,
+                 drift_rate=0., drift_noise=0., source_noise=0., seed=None):
+        """
+        Args:
+            peak (float): Photodiode voltage at perfect coupling
+            optimum (array): Physical pose of perfect coupling, in steps
+            step_angle (float or array): Beam deflection per step per axis,
+                in radians
+            lever_arms (tuple): Distances from the far and the near mirror to
+                the coupler, in meters
+            waist (float): Mode field radius at the coupler, in meters
+            wavelength (float): In meters
+            drift_rate (float or array): Linear drift of the optimum, in steps
+                per second
+            drift_noise (float or array): Random walk of the optimum, in steps
+                per square root second
+            source_noise (float): Random walk of the relative source power,
+                per square root second
+            seed (int): Seed of the drift random walks
+        """
+        self.peak = peak
+        self.optimum = np.array(optimum, dtype=float)
+        self.step_angle = np.broadcast_to(np.asarray(step_angle, dtype=float), (4,))
+        self.lever_arms = lever_arms
+        self.waist = waist
+        self.theta0 = wavelength / (math.pi * waist)
+        self.drift_rate = np.broadcast_to(np.asarray(drift_rate, dtype=float), (4,))
+        self.drift_noise = np.broadcast_to(np.asarray(drift_noise, dtype=float), (4,))
+        self.source_noise = source_noise
+        self.rng = np.random.default_rng(seed)
+
+        self._t = 0.
+        self._walk = np.zeros(4)
+        self._source = 1.
+
+    def _advance(self, t):
+        """Step the random walks forward to time t"""
+        dt = t - self._t
+        if dt <= 0:
+            return
+        if self.drift_noise.any():
+            self._walk = self._walk + self.drift_noise*math.sqrt(dt)*self.rng.normal(size=4)
+        if self.source_noise:
+            self._source *= math.exp(self.source_noise*math.sqrt(dt)*self.rng.normal())
+        self._t = t
+
+    def optimum_at(self, t):
+        """Pose of perfect coupling at time t"""
+        self._advance(t)
+        return self.optimum + self.drift_rate*t + self._walk
+
+    def source_at(self, t):
+        """Relative source power at time(s) t"""
+        self._advance(np.max(t))
+        return self._source + 0*np.asarray(t, dtype=float)
+
+    def efficiency(self, error):
+        """Coupling efficiency for a pose error (..., 4) in steps"""
+        angle = np.asarray(error, dtype=float) * self.step_angle
+        far, near = self.lever_arms
+        theta_x = angle[..., 0] + angle[..., 2]
+        theta_y = angle[..., 1] + angle[..., 3]
+        offset_x = far*angle[..., 0] + near*angle[..., 2]
+        offset_y = far*angle[..., 1] + near*angle[..., 3]
+        return np.exp(-(offset_x**2 + offset_y**2) / self.waist**2
+                      - (theta_x**2 + theta_y**2) / self.theta0**2)
+
+    def power(self, pose, t):
+        """Photodiode voltage for physical pose(s) (..., 4) at time(s) t"""
+        t = np.asarray(t, dtype=float)
+        optimum = self.optimum_at(float(np.max(t)))
+        # within one read, drift is only the linear part
+        optimum = optimum + self.drift_rate*(t[..., None] - np.max(t))
+        return self.peak * self.source_at(t) * self.efficiency(pose - optimum)
+
+
+class SimulatedLJM(object):
+    """Stand-in for the labjack ljm module
+
+    Pass it to LabJackAnalog(..., backend=SimulatedLJM(...)). Analog inputs
+    are fed by channel sources, callables mapping an array of times to
+    voltages, plus Gaussian noise. Every command-response call costs
+    read_latency seconds of simulated time, and eStreamRead blocks (advances
+    the clock) until a full read of scans is available. Stream-out buffers
+    play on their DAC target during a stream, one value per scan; feed an
+    input from output_at to loop a DAC back.
+    """
+
+    LJMError = ljm.LJMError
+
+    def __init__(self, clock=None, noise=0., read_latency=1e-3, seed=None):
+        """
+        Args:
+            clock (VirtualClock): Time base, a new one if None
+            noise (float): Default standard deviation of the input noise, in
+                volts
+            read_latency (float): Seconds per command-response call
+            seed (int): Seed of the input noise
+        """
+        self.clock = VirtualClock() if clock is None else clock
+        self.noise = noise
+        self.read_latency = read_latency
+        self.rng = np.random.default_rng(seed)
+        self.sources = {}
+        self.outputs = {}
+        self.calls = 0
+        self._handles = set()
+        self._next_handle = 1
+        self._stream = None
+        # stream-out index -> target name, buffer and loop size
+        self._stream_out = {}
+
+    def add_channel(self, name, source, noise=None):
+        """Feed an analog input
+
+        Args:
+            name (str): e.g. "AIN2"
+            source (callable): source(times) -> volts
+            noise (float): Noise of this input, the default noise if None
+        """
+        self.sources[name] = (source, self.noise if noise is None else noise)
+
+    def _sample(self, names, times):
+        """Readings of the named inputs at the given times, shape
+        (len(times), len(names))"""
+        data = np.zeros((len(times), len(names)))
+        for i, name in enumerate(names):
+            if name in self.sources:
+                source, noise = self.sources[name]
+                data[:, i] = source(times)
+                if noise:
+                    data[:, i] += self.rng.normal(0, noise, len(times))
+        return data
+
+    def output_at(self, name, times):
+        """Value of an output at the given time(s), following a running
+        stream-out that targets it"""
+        times = np.asarray(times, dtype=float)
+        value = self.outputs.get(name, 0.) + 0*times
+        stream = self._stream
+        if stream is None:
+            return value
+        for target, values in stream["outs"]:
+            if target == name:
+                # scans are due at start + k/rate, tolerate rounding
+                scan = np.floor((times - stream["start"]) * stream["rate"] + 1e-6).astype(int)
+                value = np.where(scan >= 0, values[np.maximum(scan, 0) % len(values)], value)
+        return value
+
+    def _write_stream_out(self, name, value):
+        """Stream-out configuration register writes, False for other names"""
+        m = re.match(r"STREAM_OUT([0-9]+)_([A-Z_0-9]+)$", name)
+        if not m:
+            return False
+        out = self._stream_out.setdefault(int(m.group(1)), {
+            "target": None, "buffer": [], "loop_size": 0})
+        register = m.group(2)
+        if register == "ENABLE" and value:
+            out["buffer"] = []
+        elif register == "TARGET":
+            out["target"] = self.addressesToNames([int(value)])[0]
+        elif register == "LOOP_SIZE":
+            out["loop_size"] = int(value)
+        elif register == "BUFFER_F32":
+            out["buffer"].extend(float(v) for v in value)
+        return True
+
+    def _check(self, handle):
+        if handle not in self._handles:
+            raise ljm.LJMError(1224, errorString="LJME_DEVICE_NOT_OPEN")
+
+    def _command(self, handle):
+        self._check(handle)
+        self.calls += 1
+        self.clock.sleep(self.read_latency)
+
+    # ljm module interface
+    def openS(self, deviceType="ANY", connectionType="ANY", identifier="ANY"):
+        handle = self._next_handle
+        self._next_handle += 1
+        self._handles.add(handle)
+        return handle
+
+    def close(self, handle):
+        self._check(handle)
+        self._handles.discard(handle)
+
+    def namesToAddresses(self, numFrames, names, aNames=None):
+        addresses = []
+        for name in names[:numFrames]:
+            m = re.match(r"([A-Z_]+?)([0-9]+)$", name)
+            if not m or m.group(1) not in ADDRESS_BASE:
+                raise ljm.LJMError(1294, errorString="LJME_INVALID_NAME " + name)
+            stride = ADDRESS_STRIDE.get(m.group(1), 2)
+            addresses.append(ADDRESS_BASE[m.group(1)] + stride*int(m.group(2)))
+        return addresses, [3]*len(addresses)
+
+    def addressesToNames(self, addresses):
+        names = []
+        for address in addresses:
+            base = max(b for b in ADDRESS_BASE.values() if b <= address)
+            prefix = [p for p, b in ADDRESS_BASE.items() if b == base][0]
+            stride = ADDRESS_STRIDE.get(prefix, 2)
+            names.append("{}{}".format(prefix, (address - base) // stride))
+        return names
+
+    def eReadName(self, handle, name):
+        self._command(handle)
+        return float(self._sample([name], np.array([self.clock.time()]))[0, 0])
+
+    def eReadNames(self, handle, numFrames, aNames):
+        self._command(handle)
+        return list(self._sample(aNames[:numFrames], np.array([self.clock.time()]))[0])
+
+    def eReadAddresses(self, handle, numFrames, aAddresses, aDataTypes):
+        return self.eReadNames(handle, numFrames, self.addressesToNames(aAddresses[:numFrames]))
+
+    def eWriteName(self, handle, name, value):
+        self._command(handle)
+        if not self._write_stream_out(name, value):
+            self.outputs[name] = value
+
+    def eWriteNameArray(self, handle, name, numValues, aValues):
+        self._command(handle)
+        if not self._write_stream_out(name, aValues[:numValues]):
+            self.outputs[name] = aValues[numValues - 1]
+
+    def eWriteNames(self, handle, numFrames, aNames, aValues):
+        self._command(handle)
+        for name, value in zip(aNames[:numFrames], aValues):
+            self.outputs[name] = value
+
+    def eStreamStart(self, handle, scansPerRead, numAddresses, aScanList, scanRate):
+        self._command(handle)
+        names = self.addressesToNames(aScanList[:numAddresses])
+        outs = []
+        for name in names:
+            if name.startswith("STREAM_OUT"):
+                out = self._stream_out[int(name[len("STREAM_OUT"):])]
+                values = np.array(out["buffer"][:out["loop_size"] or None])
+                outs.append((out["target"], values))
+        self._stream = {
+            "names": [name for name in names if not name.startswith("STREAM_OUT")],
+            "outs": outs,
+            "scans_per_read": scansPerRead,
+            "rate": float(scanRate),
+            "start": self.clock.time(),
+            "scans": 0,
+        }
+        return scanRate
+
+    def eStreamRead(self, handle):
+        self._check(handle)
+        stream = self._stream
+        if stream is None:
+            raise ljm.LJMError(2620, errorString="LJME_STREAM_NOT_RUNNING")
+        n, rate = stream["scans_per_read"], stream["rate"]
+        ready = stream["start"] + (stream["scans"] + n) / rate
+        # block until the scans have been acquired
+        self.clock.advance_to(ready)
+        times = stream["start"] + (stream["scans"] + np.arange(n)) / rate
+        stream["scans"] += n
+        device_backlog = int((self.clock.time() - ready) * rate)
+        data = self._sample(stream["names"], times)
+        return list(data.ravel()), device_backlog, 0
+
+    def eStreamStop(self, handle):
+        self._command(handle)
+        if self._stream is not None:
+            for target, _ in self._stream["outs"]:
+                self.outputs[target] = float(self.output_at(target, self.clock.time()))
+        self._stream = None
+
+
+ADDRESS_BASE = {
+    "AIN": 0,
+    "DAC": 1000,
+    "FIO": 2000,
+    "EIO": 2008,
+    "CIO": 2016,
+    "MIO": 2020,
+    "STREAM_OUT": 4800,
+    "TDAC": 30000,
+}
+# registers per channel number, 2 for the 32 bit ones
+ADDRESS_STRIDE = {
+    "STREAM_OUT": 1,
+}
+
+
+class SimulatedBench(object):
+    """Controller and LabJackAnalog wired to a simulated coupling setup
+
+    Attributes:
+        clock (VirtualClock): Shared time base
+        device (SimulatedPicomotorDevice): The fake controller hardware
+        model (CouplingModel): Fiber coupling physics
+        ljm (SimulatedLJM): The fake LJM library
+        controller (Controller): Real Controller class on the fake device
+        lj (LabJackAnalog): Real LabJackAnalog class on the fake LJM
+    """
+
+    def __init__(self, misalignment=(0., 0., 0., 0.), input_channel=2,
+                 noise=0.005, usb_latency=0.5e-3, read_latency=1e-3, seed=None,
+                 motor_kwargs=None, clock=None, ljm=None, reference_channel=None,
+                 reference_level=1., **model_kwargs):
+        """
+        Args:
+            misalignment (array): Optimal pose relative to the starting pose,
+                in steps
+            input_channel (int): Analog input the photodiode is wired to
+            noise (float): Photodiode noise in volts
+            usb_latency (float): Seconds per controller USB transfer
+            read_latency (float): Seconds per LJM command-response call
+            seed (int): Seed of all random sources
+            motor_kwargs (dict): Passed on to every SimulatedMotor
+            clock (VirtualClock): Time base, a new one if None
+            ljm (SimulatedLJM): LabJack to wire the photodiode to, a new one
+                if None. Benches sharing a clock and a SimulatedLJM model
+                several couplers read by one LabJack
+            reference_channel (int): Analog input of a photodiode on a
+                pickoff of the source, which reads reference_level times the
+                relative source power. None leaves it unwired
+            reference_level (float): Reference reading at nominal source power
+            **model_kwargs: Passed on to CouplingModel
+        """
+        rng = np.random.default_rng(seed)
+        seeds = rng.integers(2**31, size=3)
+
+        self.clock = VirtualClock() if clock is None else clock
+        self.device = SimulatedPicomotorDevice(
+            self.clock, usb_latency=usb_latency, seed=seeds[0],
+            serial_number="SIM{}".format(seeds[0]), **(motor_kwargs or {})
+        )
+        self.model = CouplingModel(optimum=misalignment, seed=seeds[1], **model_kwargs)
+        if ljm is None:
+            ljm = SimulatedLJM(self.clock, noise=noise, read_latency=read_latency,
+                               seed=seeds[2])
+        self.ljm = ljm
+        self.input_channel = input_channel
+        self.ljm.add_channel("AIN{}".format(input_channel), self.coupled_power,
+                             noise=noise)
+        self.reference_channel = reference_channel
+        if reference_channel is not None:
+            self.ljm.add_channel("AIN{}".format(reference_channel),
+                                 lambda t: reference_level*self.model.source_at(t),
+                                 noise=noise)
+
+        self.controller = Controller(idProduct=0x4000, idVendor=0x104d,
+                                     dev=self.device, clock=self.clock,
+                                     verbose=False)
+        self.lj = LabJackAnalog(backend=self.ljm)
+
+    def coupled_power(self, t):
+        """Noise free photodiode voltage at time(s) t"""
+        return self.model.power(self.device.positions(t), t)
+
+    def efficiency(self):
+        """True coupling efficiency right now"""
+        t = self.clock.time()
+        return float(self.model.efficiency(
+            self.device.positions(t) - self.model.optimum_at(t)
+        ))
@@ -0,0 +1,165 @@
+"""
+Surrogate model of the coupling peak from the evaluation history
+
+Near the optimum the coupled power is close to a Gaussian of the pose,
+so its logarithm is a quadratic. fit_quadratic fits a full quadratic, 15
+coefficients in 4-D, to recent evaluations by one weighted least squares
+solve. surrogate_optimum turns such a fit into a proposed pose when it is
+trustworthy, enough points and a well conditioned design. Two mirrors
+steering one beam leave a long valley in the pose space, along which the
+fitted curvature is barely resolved and may even come out with the wrong
+sign. The proposal is therefore a trust region step: the peak of the
+fit if it lies within reach of the sampled poses, otherwise the best pose
+of the fit on the edge of that region.
+NelderMead(..., surrogate="gaussian") tries that pose before each
+simplex step and keeps simplex stepping when there is none or it
+doesn't pay off.
+
+Example:
+
+    >>> history = result.history
+    >>> x = surrogate_optimum(history.positions(), history.scores())
+"""
+
+from collections import namedtuple
+
+import numpy as np
+
+SURROGATE_MODELS = ("gaussian", "quadratic")
+
+# f(x) = constant + gradient.(x - center) + (x - center).hessian.(x - center)/2
+QuadraticFit = namedtuple("QuadraticFit", [
+    "center", "constant", "gradient", "hessian", "condition", "rms"
+])
+
+
+def quadratic_design(dx):
+    """Design matrix of a full quadratic, columns 1, dx and the products
+    dx_i*dx_j for i <= j
+
+    Args:
+        dx (array): (n, dim) offsets from the expansion point
+
+    Returns:
+        design (array): (n, 1 + dim + dim*(dim + 1)/2)
+    """
+    dx = np.asarray(dx, dtype=float)
+    i, j = np.triu_indices(dx.shape[1])
+    return np.column_stack([np.ones(len(dx)), dx, dx[:, i]*dx[:, j]])
+
+
+def n_coefficients(dim):
+    """Number of coefficients of a full quadratic in dim dimensions"""
+    return 1 + dim + dim*(dim + 1) // 2
+
+
+def fit_quadratic(x, y, center, weights=None):
+    """Weighted least squares quadratic around center
+
+    The offsets are scaled per axis before the solve so the condition
+    number reflects the geometry of the poses, not their units.
+
+    Args:
+        x (array): (n, dim) poses
+        y (array): (n,) values
+        center (array): Expansion point
+        weights (array): (n,) weights, inverse variances of y
+
+    Returns:
+        fit (QuadraticFit): None if the poses don't determine every
+            coefficient
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    center = np.asarray(center, dtype=float)
+    dim = x.shape[1]
+    if len(x) < n_coefficients(dim):
+        return None
+    dx = x - center
+    scale = np.max(np.abs(dx), axis=0)
+    if np.any(scale == 0):
+        return None
+
+    design = quadratic_design(dx / scale)
+    w = np.ones(len(y)) if weights is None else np.sqrt(np.asarray(weights, dtype=float))
+    coefficients, _, rank, singular = np.linalg.lstsq(design*w[:, None], y*w, rcond=None)
+    if rank < design.shape[1]:
+        return None
+
+    gradient = coefficients[1:dim + 1] / scale
+    hessian = np.zeros((dim, dim))
+    i, j = np.triu_indices(dim)
+    hessian[i, j] = coefficients[dim + 1:]
+    hessian = (hessian + hessian.T) / np.outer(scale, scale)
+    rms = float(np.sqrt(np.mean((design @ coefficients - y)**2)))
+    return QuadraticFit(center, float(coefficients[0]), gradient, hessian,
+                        float(singular[0] / singular[-1]), rms)
+
+
+def trust_region_step(gradient, hessian, radius):
+    """Step maximizing gradient.d + d.hessian.d/2 subject to |d| <= radius
+
+    Solves (lam - hessian) d = gradient with the smallest lam >= 0 that
+    makes the matrix positive definite and keeps d within the radius, the
+    Levenberg-Marquardt form of the trust region step.
+    """
+    curvature, vectors = np.linalg.eigh(-np.asarray(hessian, dtype=float))
+    g = vectors.T @ np.asarray(gradient, dtype=float)
+
+    def step(lam):
+        return vectors @ (g / (curvature + lam))
+
+    low = max(0., -np.min(curvature))
+    if low == 0 and np.min(curvature) > 0 and np.linalg.norm(step(0.)) <= radius:
+        return step(0.)
+    high = low + np.linalg.norm(g) / radius
+    # |step(lam)| decreases with lam above low
+    for _ in range(60):
+        lam = 0.5*(low + high)
+        if np.linalg.norm(step(lam)) > radius:
+            low = lam
+        else:
+            high = lam
+    return step(high)
+
+
+def surrogate_optimum(poses, scores, model="gaussian", max_condition=1e4,
+                      max_extrapolation=1.5, min_power_fraction=0.05):
+    """Pose of the peak of a surrogate fitted to evaluations
+
+    Args:
+        poses (array): (n, dim) evaluated poses
+        scores (array): (n,) their scores, the negative power
+        model (str): "gaussian" fits log(power) weighted by power**2, which
+            is exact for a Gaussian peak with constant noise. "quadratic"
+            fits the power itself
+        max_condition (float): Largest condition number of the scaled
+            design matrix accepted
+        max_extrapolation (float): Trust region radius around the best pose,
+            in units of the median distance of the fitted poses from it
+        min_power_fraction (float): Poses below this fraction of the best
+            power are ignored, they are far out in the wings where neither
+            model holds and their logarithm is mostly noise
+
+    Returns:
+        x (array): Predicted optimum, None if the fit isn't trustworthy
+    """
+    if model not in SURROGATE_MODELS:
+        raise ValueError("Unknown surrogate model {!r}, choose from {}".format(
+            model, ", ".join(SURROGATE_MODELS)))
+    poses = np.asarray(poses, dtype=float)
+    power = -np.asarray(scores, dtype=float)
+    if not len(poses) or np.max(power) <= 0:
+        return None
+    center = poses[np.argmax(power)]
+
+    keep = power > min_power_fraction*np.max(power)
+    poses, power = poses[keep], power[keep]
+    if model == "gaussian":
+        fit = fit_quadratic(poses, np.log(power), center, weights=power**2)
+    else:
+        fit = fit_quadratic(poses, power, center)
+    if fit is None or fit.condition > max_condition:
+        return None
+    reach = np.median(np.linalg.norm(poses - center, axis=1))
+    return center + trust_region_step(fit.gradient, fit.hessian, max_extrapolation*reach)
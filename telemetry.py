@@ -0,0 +1,226 @@
+"""
+Append-only binary telemetry of every evaluation
+
+Each evaluation is one fixed-size record (RECORD_DTYPE): timestamp,
+optimizer phase, iteration, four-axis position, power mean and per-sample
+standard deviation, sample count, move latency and read latency. Records
+are buffered in a preallocated array and written in chunks, so memory use
+stays constant however long the run, and a crash loses at most one chunk
+or flush_interval seconds. Files can be rotated by size for monitors that
+run for days. read_telemetry memory-maps a file straight into a NumPy
+record array without copying.
+
+Example:
+
+    >>> with TelemetryWriter("telemetry.bin") as telemetry:
+    ...     result = minimize(optimizer, objective, telemetry=telemetry)
+    >>> records = read_telemetry("telemetry.bin")
+    >>> records["power_mean"], records["position"][:, 0]
+"""
+
+import os
+import struct
+import time
+
+import numpy as np
+
+MAGIC = b"ACTELEM"
+FILE_VERSION = 1
+HEADER = struct.Struct("<7sBI52x")
+HEADER_SIZE = HEADER.size
+N_AXES = 4
+
+RECORD_DTYPE = np.dtype([
+    ("time", "<f8"),
+    ("position", "<f8", (N_AXES,)),
+    ("power_mean", "<f8"),
+    ("power_std", "<f8"),
+    ("move_latency", "<f8"),
+    ("read_latency", "<f8"),
+    ("iteration", "<u4"),
+    ("samples", "<u2"),
+    ("phase", "u1"),
+    ("_pad", "u1"),
+])
+
+PHASES = ["other", "init", "reflect", "expand", "contract", "reduce", "poll",
+          "perturb", "monitor", "scan", "surrogate", "dither"]
+PHASE_CODES = dict((name, code) for code, name in enumerate(PHASES))
+
+
+class TelemetryWriter(object):
+    """Buffered writer of fixed-size telemetry records
+
+    Pass it to optimizers.minimize(..., telemetry=writer) to record every
+    evaluation, or call record() directly.
+    """
+
+    def __init__(self, path, chunk_records=256, flush_interval=5.,
+                 max_bytes=None, backups=10, clock=time):
+        """
+        Args:
+            path (str): File to append to, created with a header if new
+            chunk_records (int): Records buffered before a write
+            flush_interval (float): Also write the buffer when the oldest
+                buffered record is older than this, in seconds
+            max_bytes (int): Rotate the file once it is larger than this,
+                None never rotates
+            backups (int): Rotated files kept as path.1 (newest) to
+                path.<backups> (oldest)
+            clock: Provides time(), the time module or a simulated clock
+        """
+        self.path = path
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.clock = clock
+        self.records_written = 0
+
+        self._buffer = np.zeros(chunk_records, dtype=RECORD_DTYPE)
+        self._count = 0
+        self._first_time = None
+        self._file = None
+        self._open()
+
+    def _open(self):
+        new = not os.path.exists(self.path) or os.path.getsize(self.path) == 0
+        if not new:
+            _check_header(self.path)
+        self._file = open(self.path, "ab")
+        if new:
+            self._file.write(HEADER.pack(MAGIC, FILE_VERSION, RECORD_DTYPE.itemsize))
+            self._file.flush()
+
+    def record(self, phase, position, power_mean, power_std=np.nan, samples=1,
+               move_latency=np.nan, read_latency=np.nan, iteration=0,
+               timestamp=None):
+        """Append one record
+
+        Args:
+            phase (str): One of PHASES, anything else is stored as "other"
+            position (array): Motor positions, padded with NaN to 4 axes
+            power_mean (float): Mean photodiode power
+            power_std (float): Per-sample standard deviation of the power
+            samples (int): Photodiode samples averaged
+            move_latency (float): Seconds spent moving to position
+            read_latency (float): Seconds spent reading the power
+            iteration (int): Optimizer iteration
+            timestamp (float): clock.time() if None
+        """
+        now = self.clock.time() if timestamp is None else timestamp
+        row = self._buffer[self._count]
+        row["time"] = now
+        row["phase"] = PHASE_CODES.get(phase, 0)
+        row["iteration"] = iteration
+        position = np.asarray(position, dtype=float)
+        row["position"][:] = np.nan
+        row["position"][:len(position)] = position
+        row["power_mean"] = power_mean
+        row["power_std"] = power_std
+        row["samples"] = min(samples, 0xffff)
+        row["move_latency"] = move_latency
+        row["read_latency"] = read_latency
+        self._count += 1
+
+        if self._first_time is None:
+            self._first_time = now
+        if (self._count == len(self._buffer)
+                or now - self._first_time >= self.flush_interval):
+            self.flush()
+
+    def record_evaluation(self, evaluation, objective=None):
+        """Append an optimizers.Evaluation, with the measurement details of
+        a HardwareObjective if given"""
+        measurement = getattr(objective, "last_measurement", None)
+        if measurement is not None:
+            power_mean = measurement.mean
+            power_std = measurement.sem*np.sqrt(measurement.n)
+            samples = measurement.n
+        else:
+            power_mean, power_std, samples = -evaluation.score, np.nan, 1
+        move_latency = getattr(objective, "last_move_latency", None)
+        read_latency = getattr(objective, "last_read_latency", None)
+        self.record(
+            evaluation.phase, evaluation.x, power_mean, power_std, samples,
+            np.nan if move_latency is None else move_latency,
+            np.nan if read_latency is None else read_latency,
+            evaluation.iteration,
+        )
+
+    def flush(self):
+        """Write the buffered records"""
+        if self._count:
+            self._file.write(self._buffer[:self._count].tobytes())
+            self.records_written += self._count
+            self._count = 0
+            self._first_time = None
+        self._file.flush()
+        if self.max_bytes and self._file.tell() >= self.max_bytes:
+            self.rotate()
+
+    def rotate(self):
+        """Move the current file to path.1, shifting older ones, and start a
+        new file"""
+        self._file.close()
+        for i in range(self.backups - 1, 0, -1):
+            older = "{}.{}".format(self.path, i)
+            if os.path.exists(older):
+                os.replace(older, "{}.{}".format(self.path, i + 1))
+        if self.backups:
+            os.replace(self.path, "{}.1".format(self.path))
+        else:
+            os.unlink(self.path)
+        self._open()
+
+    def close(self):
+        if self._file is not None and not self._file.closed:
+            self.flush()
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _check_header(path):
+    with open(path, "rb") as f:
+        magic, version, record_size = HEADER.unpack(f.read(HEADER_SIZE))
+    if magic != MAGIC or version != FILE_VERSION or record_size != RECORD_DTYPE.itemsize:
+        raise ValueError("{} is not a version {} telemetry file".format(path, FILE_VERSION))
+
+
+def read_telemetry(path):
+    """Memory-map a telemetry file
+
+    A trailing partial record, e.g. from a crash during a write, is ignored.
+
+    Returns:
+        records (numpy.memmap): Read-only record array with RECORD_DTYPE
+            fields, phase_names() converts the phase codes
+    """
+    _check_header(path)
+    n = (os.path.getsize(path) - HEADER_SIZE) // RECORD_DTYPE.itemsize
+    if n == 0:
+        return np.zeros(0, dtype=RECORD_DTYPE)
+    return np.memmap(path, dtype=RECORD_DTYPE, mode="r", offset=HEADER_SIZE,
+                     shape=(n,))
+
+
+def rotated_files(path):
+    """The file at path and its rotated backups, oldest first"""
+    files = []
+    i = 1
+    while os.path.exists("{}.{}".format(path, i)):
+        files.append("{}.{}".format(path, i))
+        i += 1
+    files.reverse()
+    if os.path.exists(path):
+        files.append(path)
+    return files
+
+
+def phase_names(records):
+    """Phase names of an array of records"""
+    return np.array(PHASES)[records["phase"]]
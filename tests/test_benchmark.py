@@ -0,0 +1,20 @@
+import copy
+
+from benchmark import compare, run_benchmark, scenario_matrix, summarize
+
+
+def test_compare_flags_regression():
+    scenarios = scenario_matrix(misalignments=(300.,), noises=(0.005,),
+                                algorithms=[("nelder-mead", {})], repeats=3)
+    summary = summarize(run_benchmark(scenarios, workers=1))
+    name, = summary
+    assert compare(summary, summary) == []
+
+    slower = copy.deepcopy(summary)
+    slower[name]["evaluations_to_goal"]["median"] *= 1.5
+    slower[name]["success_rate"] -= 0.5
+    regressions = compare(summary, slower)
+
+    assert sorted(metric for _, metric, _, _ in regressions) == \
+        ["evaluations_to_goal", "success_rate"]
+    assert all(entry == name for entry, _, _, _ in regressions)
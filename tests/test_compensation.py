@@ -0,0 +1,18 @@
+import pytest
+
+from compensation import calibrate_axis
+from simulation import SimulatedBench
+
+
+@pytest.mark.parametrize("backlash", [0, 20, 60])
+def test_calibrate_axis_recovers_backlash(backlash):
+    bench = SimulatedBench(seed=2, noise=0.002,
+                           motor_kwargs=dict(backlash=backlash, reverse_scale=0.9))
+
+    calibration = calibrate_axis(bench.controller, bench.lj, 1, bench.input_channel,
+                                 velocity=400)
+
+    assert calibration.backlash == pytest.approx(backlash, abs=5)
+    assert calibration.reverse_scale == pytest.approx(0.9, abs=0.02)
+    # left on the peak
+    assert bench.efficiency() > 0.95
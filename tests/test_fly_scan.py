@@ -0,0 +1,17 @@
+import pytest
+
+from fly_scan import find_peak, fly_scan
+from simulation import SimulatedBench
+
+
+@pytest.mark.parametrize("distance", [800, -800])
+def test_fly_scan_finds_peak(distance):
+    bench = SimulatedBench(misalignment=[120., 0., 0., 0.], seed=3, noise=0.005)
+    bench.controller.move_to(1, 120 - distance//2)
+
+    scan = fly_scan(bench.controller, bench.lj, 1, distance, bench.input_channel,
+                    velocity=500)
+
+    assert len(scan.power) > 100
+    assert bench.controller.get_position(1) == 120 + distance//2
+    assert find_peak(scan) == pytest.approx(120., abs=5)
@@ -0,0 +1,24 @@
+import numpy as np
+import pytest
+
+from evaluation import AdaptiveEvaluator, HardwareObjective
+from optimizers import make_optimizer, minimize
+from simulation import SimulatedBench
+
+
+@pytest.mark.parametrize("algorithm", ["nelder-mead", "pattern", "spsa"])
+def test_minimize_reaches_goal(algorithm):
+    bench = SimulatedBench(misalignment=[200., -150., 100., -50.], seed=1)
+    goal = -0.9*bench.model.peak
+    objective = HardwareObjective(bench.controller,
+                                  AdaptiveEvaluator(bench.lj, bench.input_channel),
+                                  settle_time=0.05)
+    optimizer = make_optimizer(algorithm, np.zeros(4), 50., max_iter=200, goal=goal)
+
+    result = minimize(optimizer, objective, clock=bench.clock)
+
+    assert result.stop_reason == "goal"
+    assert result.score <= goal
+    assert result.history.evaluations_to_reach(goal) <= result.evaluations
+    bench.controller.move_all(result.x)
+    assert bench.efficiency() > 0.85
@@ -0,0 +1,26 @@
+import numpy as np
+
+from evaluation import AdaptiveEvaluator, HardwareObjective
+from optimizers import NelderMead, minimize
+from simulation import SimulatedBench
+from telemetry import TelemetryWriter, phase_names, read_telemetry
+
+
+def test_telemetry_round_trip(tmp_path):
+    bench = SimulatedBench(misalignment=[100., -50., 30., 20.], seed=4)
+    path = str(tmp_path / "telemetry.bin")
+    telemetry = TelemetryWriter(path, chunk_records=8, clock=bench.clock)
+    objective = HardwareObjective(bench.controller,
+                                  AdaptiveEvaluator(bench.lj, bench.input_channel))
+    optimizer = NelderMead(np.zeros(4), 50., max_iter=30)
+
+    result = minimize(optimizer, objective, clock=bench.clock, telemetry=telemetry)
+    telemetry.close()
+    records = read_telemetry(path)
+
+    assert len(records) == len(result.history) == telemetry.records_written
+    np.testing.assert_allclose(records["position"], result.history.positions())
+    np.testing.assert_allclose(records["power_mean"], -result.history.scores(),
+                               rtol=1e-6)
+    assert list(phase_names(records)) == [e.phase for e in result.history]
+    assert np.all(np.diff(records["time"]) >= 0)
@@ -1,19 +1,23 @@
-import copy
 import os
 import numpy as np
-import serial
-import matplotlib.pyplot as plt
 import time as time
 from New_Focus_8742 import Controller
-from labjack import ljm                       # labjack
 import LabJackAnalog as LJA
+from evaluation import AdaptiveEvaluator, EvaluationCache, HardwareObjective
+from optimizers import make_optimizer, minimize
+from monitor import CouplingMonitor
+from alignment_state import AlignmentState, load_state, save_state, warm_start
+from telemetry import TelemetryWriter
+from instrumentation import profile
+from health import ControllerHealthMonitor
+from acquisition import acquire, signal_present
+from compensation import CompensatedController, load_calibration
+from scheduling import MotionScheduler
+from beam_walk import load_beam_walk, make_whitened_optimizer
 
 
 if __name__ == "__main__":
     # test
-    import math
-    import numpy as np
-    import matplotlib.pyplot as plt
     print('\n\n')
     print('#'*80)
     print('#\tPython controller for NewFocus Picomotor Controller')
@@ -38,27 +42,42 @@ if __name__ == "__main__":
 
 # Initialize the controller
 controller = Controller(idProduct=idProduct, idVendor=idVendor)
-controller.show_command()
+# poll MD?, TP? and ERRSTR? in the background and reconnect if USB drops
+health = ControllerHealthMonitor(controller)
+health.start()
 
-# Initialize the LabJack
-# first two lines open and close the LJ, to get rid of errors.
-lj = LJA.LabJackAnalog(identifier="ANY")
-lj.close()
+# Initialize the LabJack, opened once: LabJackAnalog reads through its own
+# handle, and autocoupling.py runs this alignment headless from a config file
 lj = LJA.LabJackAnalog(identifier="ANY")
-handle = ljm.openS("ANY", "ANY", "ANY")
 
 print('684_labjack loaded')
 
 # Use AIN2 channel to read the voltage from photodetector
 input_channel = 2
+# photodetector on a pickoff of the laser, e.g. 3, read in the same scan to
+# divide out laser power fluctuations. None to use the fiber output alone
+reference_channel = None
+reference_level = 1.                    # its reading at the nominal laser power
 
 # Set initial coupling power and the threshold for re-coupling power
 # initial coupling power(in watt), if use photo detector this should be voltage
 P_max = 3.14
 P_thr = P_max*0.85                      # Threshold for start re-coupling
+monitor_after_alignment = False         # keep re-coupling below P_thr until Ctrl-C
+state_file = 'alignment_state.json'     # what the last run learned, for a warm start
+output_folder = '.'                     # telemetry and coupling history go here
+telemetry_max_bytes = 100*1024**2       # rotate the telemetry file above this size
+profile_run = False                     # print where the time of each phase went
+acquisition_threshold = 0.03*P_max      # below this the beam is lost, search for it first
+acquisition_width = 2000                # side of the square searched on mirror 1, in steps
+calibration_file = 'axis_calibration.json'  # backlash and step sizes from compensation.calibrate
+approach_direction = 1                  # end every move forward, None to move straight
+beam_walk_file = 'beam_walk.json'       # mirror pair coordinates from beam_walk.calibrate_beam_walk
+beam_walk_loss = 0.2                    # power lost by the initial step in those coordinates
 time_start = time.time()                # record the starting time
 
-# Set Nelder-Mead function parameters
+# Set optimizer parameters
+algorithm = 'nelder-mead'               # 'nelder-mead', 'pattern' or 'spsa'
 step = 50                               # initial step
 V_int = P_max
 no_improve_thr = 0.9
@@ -69,180 +88,175 @@ alpha = 1.  # Reflection param
 gamma = 2.  # Expansion param
 rho = -0.5  # Contraction param
 sigma = 0.5  # Reduction param
+surrogate = 'gaussian'  # try the peak of a Gaussian fit to recent evaluations, None to not
+settle_time = 0.05  # wait after the motors stop before reading the power
+min_samples = 3  # photodiode samples always averaged per evaluation
+max_samples = 30  # upper bound on samples per evaluation
+cache_max_age = 60.  # seconds a measured pose is scored without measuring it again
 '''
+    @param algorithm (str): optimizer from optimizers.OPTIMIZERS
     @param V_int(float): initial voltage read from photo detector
     @param step (float): look-around radius in initial step
     @no_improv_thr,  no_improv_break (float, int): break after no_improv_break iterations with
             an improvement lower than no_improv_thr
     @max_iter (int): always break after this number of iterations.
             Set it to 0 to loop indefinitely.
-    @alpha, gamma, rho, sigma (floats): parameters of the algorithm
+    @alpha, gamma, rho, sigma (floats): parameters of the Nelder-Mead algorithm
             (see Wikipedia page for reference)
+    @surrogate (str): 'gaussian' or 'quadratic' model fitted to the recent
+            evaluations, whose peak Nelder-Mead tries before each step
+    @settle_time (float): seconds to wait once a move is reported done
+    @min_samples, max_samples (int): bounds on the photodiode samples averaged
+            per evaluation, more are taken only while the power can't yet be
+            ranked against the current simplex
     return: tuple (best parameter array, best score)
 '''
+evaluator = AdaptiveEvaluator(lj, input_channel, min_samples=min_samples,
+                              max_samples=max_samples,
+                              reference_channel=reference_channel,
+                              reference_level=reference_level)
+# signal lost: raster the far mirror until the photodiode sees light again,
+# then let the optimizer take over from there. This moves the raw controller,
+# so it comes before the compensated positions are taken
+if not signal_present(lj, input_channel, acquisition_threshold):
+    acquisition = acquire(controller, lj, input_channel, acquisition_threshold,
+                          width=acquisition_width)
+    print(acquisition)
+    if not acquisition.found:
+        print("no signal within {} steps, align by hand".format(acquisition_width//2))
+        health.stop()
+        controller.close()
+        lj.close()
+        raise SystemExit(1)
 
-# Start Nelder-Mead loop
-# Set the current position as home position for all axis
-controller.command("1DH")
-controller.command("2DH")
-controller.command("3DH")
-controller.command("4DH")
+# with a calibration, positions are compensated for backlash and the
+# different forward and reverse step sizes
+calibration = load_calibration(calibration_file)
+if calibration is None:
+    mirrors = controller
+else:
+    mirrors = CompensatedController(controller, calibration, approach=approach_direction)
+# poses measured recently, e.g. the best vertex of a reduction, aren't revisited
+cache = EvaluationCache(max_age=cache_max_age)
+objective = HardwareObjective(mirrors, evaluator, cache=cache, health=health,
+                              settle_time=settle_time)
+# visit the poses of a batch, e.g. the initial simplex, in the quickest order
+scheduler = MotionScheduler(mirrors, cache=cache)
+# with a beam walk calibration, search in combined moves of both mirrors
+# that each cost the same power instead of along the four motor axes
+walk = load_beam_walk(beam_walk_file)
+if walk is not None:
+    # the step is in the whitened coordinates from here on
+    step = walk.step_for_loss(beam_walk_loss)
 
-# Start all four axis at home position
-x_start = np.array([0., 0., 0., 0.])
-# record the starting time
-time_start = time.time()
-# init
-dim = len(x_start)
-##
-# read the inverse first power
-prev_best = -1*lj.analog_in(input_channel)
-no_improv = 0
-res = [[x_start, prev_best]]
-best_his = [prev_best]
-print("the initial coupling efficiency is: "+str(-prev_best / V_int))
-x_his = []
-
-# get 4 test points, with the (0,0,0,0) one we get 5 initial test points
-for i in range(dim):
-    x = copy.copy(x_start)
-    x[i] = x[i] + step
-    for j in range(1, dim+1):
-        # move the current axis to test position
-        controller.command(str(j)+"PA"+str(x[j-1]))
-        time.sleep(0.5)
-    score = -1*lj.analog_in(input_channel)  # read the inverse testing power
-    res.append([x, score])
-
-# simplex iter
-iters = 0
-while True:
-    # order
-    # sort by power from minimum to maximum
-    res.sort(key=lambda x: x[1])
-    # the mimimum power within 5 testing points
-    best = res[0][1]
-    # position of the miminum point
-    x_best = res[0][0]
-    best_his.append(best)
-    x_his.append(x_best)
-    print('...best so far:', -res[0][1] / V_int)
-
-    # break after max_iter
-    if max_iter and iters >= max_iter:
-        break
-    iters += 1
-
-    # break if all no_improv_break iterations(10) satisfy the goal efficiency
-    if best > -1 * V_int * no_improve_thr:                   # goal efficiency: 0.9 V_int
-        no_improv = 0
-        prev_best = best
+# Start optimization
+algorithm_params = {
+    'nelder-mead': dict(alpha=alpha, gamma=gamma, rho=rho, sigma=sigma,
+                        surrogate=surrogate),
+}
+state = load_state(state_file)
+if state is None:
+    # cold start: set the current position as home position for all axis
+    controller.command("1DH")
+    controller.command("2DH")
+    controller.command("3DH")
+    controller.command("4DH")
+    if mirrors is not controller:
+        mirrors.reset()
+    # Start all four axis at home position
+    x_start = np.array([0., 0., 0., 0.])
+else:
+    # warm start: the last run left the mirrors at its best pose, start with a
+    # simplex shaped like the one it ended with
+    if mirrors is controller:
+        x_start = np.array(health.positions(), dtype=float)
     else:
-        no_improv += 1
-    if no_improv >= no_improv_break:
-        break
-
-    # centroid                                            #calculate the center of all points except the maximum one
-    x0 = [0.] * dim
-    for tup in res[:-1]:
-        for i, c in enumerate(tup[0]):
-            x0[i] += c / (len(res)-1)
-
-    # reflection
-    xr = x0 + alpha*(x0 - res[-1][0])
-    for j in range(1, dim+1):
-        # move the current axis to reflection position
-        controller.command(str(j)+"PA"+str(xr[j-1]))
-        time.sleep(0.5)
-    # read the inverse power at reflection position
-    rscore = -1*lj.analog_in(input_channel)
-    # if new power lays between min and max, keep the new point
-    if res[0][1] <= rscore < res[-2][1]:
-        del res[-1]
-        res.append([xr, rscore])
-        continue
-
-    # expansion
-    if rscore < res[0][1]:
-        xe = x0 + gamma*(x0 - res[-1][0])
-        for j in range(1, dim+1):
-            # move the current axis to expansion position
-            controller.command(str(j)+"PA"+str(xe[j-1]))
-            time.sleep(0.5)
-        # read the inverse power at expansion position
-        escore = -1*lj.analog_in(input_channel)
-        if escore < rscore:                                  # if the new point is better, keep it
-            del res[-1]
-            res.append([xe, escore])
-            continue
-        # if the new point is worse, keep the original(reflection) one
-        else:
-            del res[-1]
-            res.append([xr, rscore])
-            continue
-
-    # contraction
-    xc = x0 + rho*(x0 - res[-1][0])
-    for j in range(1, dim+1):
-        # move the current axis to contraction position
-        controller.command(str(j)+"PA"+str(xc[j-1]))
-        time.sleep(0.5)
-    # read the inverse power at contraction position
-    cscore = -1*lj.analog_in(input_channel)
-    # if the new point is better, keep it
-    if cscore < res[-1][1]:
-        del res[-1]
-        res.append([xc, cscore])
-        continue
-
-    # reduction
-    x1 = res[0][0]
-    nres = []
-    for tup in res:
-        redx = x1 + sigma*(tup[0] - x1)
-        for j in range(1, dim+1):
-            # move the current axis to reduction position to every point
-            controller.command(str(j)+"PA"+str(redx[j-1]))
-            time.sleep(0.5)
-        # read the inverse power at reduction position to every point
-        score = -1*lj.analog_in(input_channel)
-        nres.append([redx, score])
-    res = nres
-
-# record the ending time
-time_end = time.time()
-# sort by power from minimum to maximum
-res.sort(key=lambda x: x[1])
-print(res)
-# position of the miminum point
-x_best_final = res[0][0]
-for j in range(1, dim+1):
-    # move the current axis to final position to every point
-    controller.command(str(j)+"PA"+str(x_best_final[j-1]))
-    time.sleep(0.5)
-
-score_final = -1*lj.analog_in(input_channel)
+        x_start = np.array(mirrors.get_positions(), dtype=float)
+    step, initial_simplex = warm_start(state, x_start, max_step=step, walk=walk)
+    if initial_simplex is not None and algorithm == 'nelder-mead':
+        algorithm_params[algorithm]['initial_simplex'] = initial_simplex
+    if state.noise:
+        # don't trust a spread much smaller than the noise seen last time
+        evaluator.noise_floor = 0.5*state.noise
+    print("warm start from {} with step {:.1f}".format(state_file, step))
+
+if walk is None:
+    optimizer = make_optimizer(algorithm, x_start, step, max_iter=max_iter,
+                               goal=-V_goal, goal_iterations=no_improv_break,
+                               **algorithm_params.get(algorithm, {}))
+else:
+    optimizer = make_whitened_optimizer(walk, algorithm, x_start, step,
+                                        max_iter=max_iter, goal=-V_goal,
+                                        goal_iterations=no_improv_break,
+                                        **algorithm_params.get(algorithm, {}))
+
+
+def report(optimizer):
+    print('...best so far:', -optimizer.best_score / V_int)
+
+
+telemetry = TelemetryWriter(os.path.join(output_folder, 'telemetry.bin'),
+                            max_bytes=telemetry_max_bytes)
+if profile_run:
+    with profile():
+        result = minimize(optimizer, objective, callback=report, telemetry=telemetry,
+                          scheduler=scheduler)
+else:
+    result = minimize(optimizer, objective, callback=report, telemetry=telemetry,
+                      scheduler=scheduler)
+print(result)
+print("the initial coupling efficiency is: "+str(-result.history[0].score / V_int))
+
+# move all axes to final position, the power there was measured already
+x_best_final = result.x
+mirrors.move_all(x_best_final, settle_time=settle_time, health=health)
+score_final = objective(x_best_final)
 print("the final efficiency is:", -score_final/V_int)
+print("photodiode samples per evaluation:", evaluator.mean_samples)
+print("evaluation cache:", cache.status())
 # Set the current position as home position for all axis
 controller.command("1DH")
 controller.command("2DH")
 controller.command("3DH")
 controller.command("4DH")
+if mirrors is not controller:
+    mirrors.reset()
+cache.clear()
+# save what this run learned, the best pose is home from now on
+state = AlignmentState.from_run(result, optimizer, evaluator)
+state.best_pose = [0.]*len(x_start)
+save_state(state_file, state)
 # plot
-time_run = np.linspace(0, time_end - time_start, len(best_his))
-N_C = -1*np.array(best_his)/V_int
+import matplotlib.pyplot as plt
+time_run = result.history.times()
+N_C = -1*result.history.best_scores()/V_int
 plt.plot(time_run, N_C, 'b.-')
 plt.axhline(y=no_improve_thr, color='r', linestyle='-')
 plt.ylabel("normalized coupling efficiency")
 plt.xlabel("time/s")
 plt.show()
 
-# save scan data
-
-full_folder = 'C:\Chicago RA\\CeNTREX\\auto alignment\\Nelder-Mead method'
-# os.mkdir(full_folder)
-filename_data = full_folder + "\\data10.txt"
-#np.savetxt(filename, np.transpose([x_forward, B_forward]), header = "x \t B_for[V]")
+# save scan data, every evaluation is already in the telemetry file
+filename_data = os.path.join(output_folder, "data10.txt")
 np.savetxt(filename_data, N_C)
-filename_time = full_folder + "\\time10.txt"
+filename_time = os.path.join(output_folder, "time10.txt")
 np.savetxt(filename_time, time_run)
+
+# keep the fiber coupled, re-optimizing whenever the power drops below P_thr
+if monitor_after_alignment:
+    # the health monitor's positions are raw step counters
+    monitor = CouplingMonitor(mirrors, lj, input_channel, threshold=P_thr,
+                              goal=V_goal, evaluator=evaluator,
+                              settle_time=settle_time, state_path=state_file,
+                              telemetry=telemetry, cache=cache,
+                              health=health if mirrors is controller else None,
+                              walk=walk)
+    try:
+        monitor.run()
+    except KeyboardInterrupt:
+        print(monitor.status())
+health.stop()
+print(health.status())
+telemetry.close()
+controller.close()
+lj.close()